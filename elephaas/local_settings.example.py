@@ -11,8 +11,14 @@ COMMANDS = {
     'reload': '{COMMANDS[base]} reload',
     'promote': '{COMMANDS[base]} promote',
     'init': 'pg_createcluster {version[0]}.{version[1]} {inst.herd.base_name} -D {pgdata} -p {inst.herd.db_port}',
+    'controldata': '/usr/lib/postgresql/{version[0]}.{version[1]}/bin/pg_controldata {pgdata}',
 }
 
+# Slow actions can be queued for the haas_worker process rather than
+# holding up the browser. Remove this to run everything immediately.
+
+ASYNC_ACTIONS = ('rebuild', 'promote', 'demote')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
@@ -54,6 +54,7 @@ INSTALLED_APPS = (
 
 MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'haas.middleware.CostMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -91,6 +92,159 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
 
+# Remote commands are sent over pooled SSH connections, one per host. These
+# control how many sessions may share a connection, how long an unused
+# connection is kept, and how often keepalives are sent (all in seconds).
+# SSH_MAX_SESSIONS should not exceed MaxSessions on the managed servers.
+
+SSH_MAX_SESSIONS = 8
+SSH_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE = 30
+
+# Every request and background job counts the SQL queries, SSH commands,
+# handshakes and file transfers it causes, and how long they took. Totals
+# for the process are published at /metrics for Prometheus, to staff users,
+# requests bearing METRICS_TOKEN, and the addresses in METRICS_ALLOWED_IPS.
+# Addresses are only safe to list when clients connect directly: behind a
+# reverse proxy on the same host, every request comes from 127.0.0.1. If
+# METRICS_FOOTER is enabled, admin pages show what they cost at the bottom.
+# None follows DEBUG.
+
+METRICS_ALLOWED_IPS = ()
+METRICS_TOKEN = None
+METRICS_FOOTER = None
+
+# Rather than pausing for a fixed time, we poll instances until they're
+# ready. These are the longest we will wait (in seconds) for an instance to
+# accept connections after starting, and for a replica to replay all WAL
+# from its old primary before being promoted during failover.
+
+WAIT_READY_TIMEOUT = 120
+WAIT_CATCHUP_TIMEOUT = 60
+
+# The haas_collect command keeps is_online and xlog_pos current by polling
+# every instance. PG_CONNECT is added to the host and port of each instance
+# to build its libpq connection string. The collector runs a pass every
+# COLLECTOR_INTERVAL seconds, waits at most COLLECTOR_TIMEOUT seconds for
+# an instance to answer or a query to finish, and queries COLLECTOR_THREADS
+# instances at once. COLLECTOR_TIMEOUT must be whole seconds.
+
+PG_CONNECT = 'user=postgres dbname=postgres connect_timeout=5'
+COLLECTOR_INTERVAL = 10
+COLLECTOR_TIMEOUT = 3
+COLLECTOR_THREADS = 50
+
+# The collector also records every WAL position it sees as lag history. Raw
+# samples are kept in daily partitions for LAG_RAW_RETENTION_DAYS, and are
+# rolled up by minute, hour, and day. Minute and hour rollups are kept for
+# the days listed here; daily rollups are kept forever.
+
+LAG_RAW_RETENTION_DAYS = 2
+LAG_MINUTE_RETENTION_DAYS = 14
+LAG_HOUR_RETENTION_DAYS = 180
+
+# DR failovers are queued at high priority. A worker dedicated to them, run
+# with --actions failover, fails over up to FAILOVER_WORKERS herds at once.
+# Each phase of a failover is timed, and flagged on the progress
+# page when it takes longer than the seconds budgeted here.
+
+FAILOVER_WORKERS = 20
+FAILOVER_BUDGET = {
+    'stop': 30,
+    'catchup': 60,
+    'promote': 30,
+    'dns': 10,
+    'repoint': 60,
+}
+
+# Herd vhosts are CNAMEs moved with dynamic DNS updates. By default, the
+# zone and nameservers are those of the local resolver; set DNS_ZONE and
+# DNS_NAMESERVERS to override them. Moves requested within DNS_BATCH_WINDOW
+# seconds of each other are sent as a single update, and every nameserver
+# must answer with the new target within DNS_VERIFY_TIMEOUT seconds.
+
+DNS_ZONE = None
+DNS_NAMESERVERS = None
+DNS_TTL = 300
+DNS_TIMEOUT = 5
+DNS_BATCH_WINDOW = 0.5
+DNS_VERIFY_TIMEOUT = 30
+
+# Superusers may run SQL on many instances at once. SQL_TIMEOUT is the
+# default statement timeout in seconds, and SQL_WORKERS limits how many
+# instances are queried at once. Rows are fetched SQL_FETCH_SIZE at a time,
+# and the admin displays them in pages of at most SQL_MAX_ROWS, split evenly
+# between the instances; use the CSV export to get them all at once.
+
+SQL_TIMEOUT = 60
+SQL_WORKERS = 20
+SQL_FETCH_SIZE = 500
+SQL_MAX_ROWS = 5000
+
+# Actions on several instances run concurrently. FANOUT_WORKERS limits how
+# many run at once overall, and FANOUT_PER_SERVER limits how many may run
+# against any single server.
+
+FANOUT_WORKERS = 20
+FANOUT_PER_SERVER = 2
+
+# Scanning a server looks for Postgres data directories up to
+# DISCOVERY_DEPTH levels beneath each of DISCOVERY_PATHS, as well as the
+# data directory of every known herd and instance.
+
+DISCOVERY_PATHS = ['/var/lib/postgresql']
+DISCOVERY_DEPTH = 3
+
+# Replica rebuilds copy the data directory with this many concurrent rsync
+# streams. Set to 1 to use a single rsync for the whole directory. The work
+# is divided into REBUILD_BUCKETS parts, and an interrupted rebuild resumes
+# without copying any part that was already finished.
+
+REBUILD_STREAMS = 4
+REBUILD_BUCKETS = 32
+
+# Rebuilds stream rsync output to their job as it runs, rather than waiting
+# for rsync to finish. RSYNC_PROGRESS asks rsync to report overall progress,
+# which needs rsync 3.1 or newer on every server. The last JOB_OUTPUT_LINES
+# lines are saved to the job at most every JOB_OUTPUT_INTERVAL seconds.
+
+RSYNC_PROGRESS = True
+JOB_OUTPUT_LINES = 10
+JOB_OUTPUT_INTERVAL = 2
+
+# Rebuilds and demotions copy data from the upstream master. No server may
+# be the source of more than REBUILD_PER_SOURCE of these copies at once, or
+# the destination of more than REBUILD_PER_TARGET. Copies with rsync need an
+# exclusive backup on the master, though, so only one of those runs per
+# master regardless. REBUILD_BWLIMIT is the total bandwidth in KB per second
+# all copies from one server may use, and 0 means no limit.
+
+REBUILD_PER_SOURCE = 2
+REBUILD_PER_TARGET = 2
+REBUILD_BWLIMIT = 0
+
+# Rebuilds may copy data from another replica of the same master rather
+# than the master itself, if the replica is online and no more than
+# REBUILD_PEER_MAX_LAG bytes behind. Replicas must accept replication
+# connections from each other for this to work.
+
+REBUILD_FROM_PEERS = False
+REBUILD_PEER_MAX_LAG = 16 * 1024 * 1024
+
+# In herds using replication slots, the collector drops any inactive slot
+# holding back more than SLOT_MAX_RETAINED bytes of WAL on its upstream.
+# The replica it belonged to will need a rebuild once it returns.
+
+SLOT_MAX_RETAINED = 32 * 1024 * 1024 * 1024
+
+# Actions listed here are queued as background jobs instead of running
+# inside the web request. Jobs are executed by the haas_worker management
+# command, so at least one worker must be running if this is enabled.
+# Available actions: start, stop, restart, reload, promote, demote, and
+# rebuild. DR failovers always run right away as a tracked batch.
+
+ASYNC_ACTIONS = ()
+
 # There are some settings that should not be saved to source control. Those
 # settings are in the local settings file, and this application will not run
 # without them. These are things like database connection settings, secret
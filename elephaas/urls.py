@@ -18,5 +18,6 @@ if ('django.contrib.auth.backends.ModelBackend'
 
 urlpatterns = [
     url(r'^$', views.index, name='index'),
+    url(r'^metrics$', views.metrics, name='metrics'),
     url(r'^admin/', include(admin.site.urls)),
 ]
@@ -1,6 +1,33 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+
+from haas.metrics import registry
 
 # Create your views here.
 
 def index(request):
     return render(request, 'index.html')
+
+
+def metrics(request):
+    """
+    Publish the metrics of this process for Prometheus
+
+    Only staff users, requests bearing the METRICS_TOKEN setting, and the
+    addresses listed in the METRICS_ALLOWED_IPS setting may read them.
+    """
+
+    token = settings.METRICS_TOKEN
+    bearer = request.META.get('HTTP_AUTHORIZATION', '')
+
+    if not (request.user.is_staff or
+        token and constant_time_compare(bearer, 'Bearer %s' % token) or
+        request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+    ):
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -2,4 +2,5 @@ from haas.admin.dr import *
 from haas.admin.environment import *
 from haas.admin.herd import *
 from haas.admin.instance import *
+from haas.admin.job import *
 from haas.admin.server import *
@@ -1,9 +1,15 @@
 from django.contrib import admin, messages
+from django.conf import settings
 from django.conf.urls import url
+from django.core.urlresolvers import reverse
 from django.shortcuts import render
+from django.utils.html import format_html
 
-from haas.models import Instance
-from haas.utility import PGUtility
+from haas.models import Instance, Job
+from haas.executor import FanOut
+from haas.jobs import HERD_ACTIONS, TRANSFER_ACTIONS, enqueue, run_task, \
+    transfer_limits
+from haas.nameserver import refresh_herds
 
 __all__ = ['HAASAdmin', 'SharedInstanceAdmin',]
 
@@ -28,6 +34,33 @@ class HAASAdmin(admin.ModelAdmin):
         ]
         return my_urls + urls
 
+    def refresh_vhosts(self, request, herd_ids):
+        """
+        Point the vhosts of several herds at their primaries, and report
+
+        :param herd_ids: IDs of the herds to refresh.
+        """
+
+        try:
+            herds, missing, errors = refresh_herds(list(herd_ids))
+        except Exception, e:
+            self.message_user(request, str(e), messages.ERROR)
+            return
+
+        for herd in missing:
+            self.message_user(request, "%s has no primary!" % herd,
+                messages.WARNING
+            )
+
+        for vhost, error in errors.items():
+            self.message_user(request, error, messages.ERROR)
+
+        if herds:
+            self.message_user(request, "Pointed %d vhost(s) at their " \
+                "primaries." % len(herds)
+            )
+
+
     def help(self, request):
         """
         Display the Proper Help Template Corresponding to the Active Module
@@ -43,6 +76,76 @@ class HAASAdmin(admin.ModelAdmin):
 
 class SharedInstanceAdmin(HAASAdmin):
 
+    def dispatch_action(self, request, action, instances, priority=0):
+        """
+        Run a named task on several instances, or queue it for later
+
+        Any action listed in the ASYNC_ACTIONS setting is submitted to the
+        background job queue, and the user gets a link to follow along.
+        Everything else is executed right away, with one message for every
+        instance that was affected. Immediate actions run on all instances
+        at once, limited to FANOUT_PER_SERVER concurrent actions on any
+        single server. Actions that copy data from a master are limited by
+        the REBUILD_PER_SOURCE and REBUILD_PER_TARGET settings instead.
+        Promotions and demotions run one at a time within each herd, since
+        each checks the state of the rest of the herd first.
+
+        :param action: Name of a task registered in haas.jobs.
+        :param instances: Iterable of Instance objects to act upon.
+        :param priority: Priority of queued jobs.
+        """
+
+        if action in settings.ASYNC_ACTIONS:
+            instances = list(instances)
+            batch = enqueue(action, instances, request.user,
+                priority=priority
+            )
+            self.message_batch(request, batch,
+                'Queued %d %s job(s).' % (len(instances), action)
+            )
+            return
+
+        if hasattr(instances, 'select_related'):
+            instances = instances.select_related('herd__environment', 'server',
+                'master'
+            )
+
+        if action in TRANSFER_ACTIONS:
+            executor = FanOut(limits=transfer_limits())
+        else:
+            executor = FanOut.per_server()
+
+        if action in HERD_ACTIONS:
+            executor.limits.append((lambda inst: inst.herd_id, 1))
+
+        results = executor.map(lambda inst: run_task(action, inst), instances)
+
+        for inst, (level, message), e in results:
+            self.message_user(request, message, level)
+
+
+    def message_batch(self, request, batch, message):
+        """
+        Tell the user about a batch of jobs, with a link to its progress
+
+        :param batch: Batch identifier of the submitted jobs.
+        :param message: Description of what was submitted.
+        """
+
+        self.message_user(request, format_html(
+            '{0} <a href="{1}">Track progress</a>.', message,
+            self.batch_url(batch)
+        ))
+
+
+    def batch_url(self, batch):
+        """
+        Get the address of the progress page for a batch of jobs
+        """
+
+        return reverse('admin:haas_job_changelist') + 'batch/%s/' % batch
+
+
     def rebuild_instances(self, request, queryset):
         """
         Rebuild all transmitted PostgreSQL replication instances from master
@@ -53,19 +156,14 @@ class SharedInstanceAdmin(HAASAdmin):
         # through rsync + ssh.
 
         if request.POST.get('post') == 'yes':
-
-            for inst_id in request.POST.getlist(admin.ACTION_CHECKBOX_NAME):
-                inst = Instance.objects.get(pk=inst_id)
-
-                try:
-                    util = PGUtility(inst)
-                    util.master_sync()
-
-                except Exception, e:
-                    self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                    continue
-
-                self.message_user(request, "%s rebuilt!" % inst)
+            try:
+                priority = int(request.POST.get('priority', 0))
+            except ValueError:
+                priority = 0
+
+            self.dispatch_action(request, 'rebuild', Instance.objects.filter(
+                pk__in=request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+            ), priority)
             return
 
         # Now go to the confirmation form. It's very basic, and only serves
@@ -75,6 +173,8 @@ class SharedInstanceAdmin(HAASAdmin):
                 {'queryset' : queryset,
                  'opts': self.model._meta,
                  'crumb_title': self.rebuild_instances.short_description,
+                 'queued': 'rebuild' in settings.ASYNC_ACTIONS,
+                 'priorities': Job.PRIORITY_CHOICES,
                  'action_checkbox_name': admin.ACTION_CHECKBOX_NAME,
                 }
         )
@@ -1,24 +1,19 @@
-import os
-import dns.query
-import dns.resolver
-import dns.update
-
-from time import sleep
-
 from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
 from django.shortcuts import render
 
-from haas.models import DisasterRecovery, Instance
+from haas.jobs import enqueue
+from haas.models import DisasterRecovery, Instance, Job
 from haas.admin.base import HAASAdmin, SharedInstanceAdmin
-from haas.utility import PGUtility
 
 __all__ = ['DRAdmin']
 
 class DRAdmin(SharedInstanceAdmin):
-    actions = ['failover_pair', 'rebuild_instances']
+    actions = ['failover_pair', 'rebuild_instances', 'refresh_dns']
     list_display = ('herd', 'container', 'mb_lag', 'vhost')
     list_filter = ('herd__environment',)
     search_fields = ('herd__herd_name', 'server__hostname', 'vhost')
+    list_select_related = ('server', 'herd__environment')
 
     list_display_links = None
     can_delete = False
@@ -55,20 +50,13 @@ class DRAdmin(SharedInstanceAdmin):
         """
         Promote a Herd Follower to Leader Status
 
-        This process is fairly complicated, and comes in several parts:
-
-        1. Stop the current primary node. This ensures only the secondary
-           can accept new data.
-        2. Promote the top follower to read/write status. This essentially
-           makes it the new leader of the herd.
-        3. Assign the follower as the new stream source to the old primary.
-           This officially swaps the roles of the two nodes. Note that the
-           new follower is still out of sync with the new leader. This will
-           require a separate node rebuild step to rectify.
-        4. Move the declared virtual host to the new leader.
-        5. Reassign all replicas to follow the new leader. We do this last
-           because it relies on DNS propagation, and pushing a reload after
-           that step implies a reconnection.
+        After confirmation, each selected pair is queued as a failover job
+        at the highest priority, so the next free worker takes it ahead of
+        anything else. Failovers never run in the web server itself, where
+        a restart would abandon them halfway. The user is sent straight to
+        a progress page showing every herd, and how long each phase of its
+        failover took. See haas.failover.failover_pair for the full
+        procedure.
         """
 
         # Go to the confirmation form. As usual, this is fairly important,
@@ -84,84 +72,47 @@ class DRAdmin(SharedInstanceAdmin):
                     }
             )
 
-        # Since the form has been submitted, start swapping DR pairs.
-
-        for dr_id in request.POST.getlist(admin.ACTION_CHECKBOX_NAME):
-            newb = Instance.objects.get(pk=dr_id)
-            sage = newb.master
-
-            # Start with the transfer: stop -> promote -> alter.
-            # Add in a short pause between to allow xlog propagation.
-
-            try:
-                sage_util = PGUtility(sage)
-                newb_util = PGUtility(newb)
-
-                sage_util.stop()
-                sleep(5)
-                newb_util.promote()
+        # Since the form has been submitted, queue the DR pairs. Every herd
+        # fails over independently, so workers run them all at once, and
+        # the whole event takes as long as the slowest herd. Only one pair
+        # per herd makes sense, so any extras are ignored.
 
-                sage.master = newb
-                sage.save()
+        pairs = {}
 
-            except Exception, e:
-                self.message_user(request,
-                    "%s : %s" % (e, newb), messages.ERROR
+        for inst in Instance.objects.filter(
+            pk__in=request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+        ).select_related('herd', 'server'):
+            if inst.herd_id in pairs:
+                self.message_user(request, "%s already selected for %s!" % (
+                    pairs[inst.herd_id].server.hostname, inst.herd),
+                    messages.WARNING
                 )
                 continue
+            pairs[inst.herd_id] = inst
 
-            # Now update the DNS. We'll just use the basic dnspython
-            # module and load it with nameserver defaults. That should
-            # be more than enough to propagate this change.
+        batch = enqueue('failover', pairs.values(), request.user,
+            priority=max(p for p, label in Job.PRIORITY_CHOICES)
+        )
+        self.message_user(request,
+            'Queued failover of %d herd(s).' % len(pairs)
+        )
 
-            try:
-                def_dns = dns.resolver.get_default_resolver()
+        return HttpResponseRedirect(self.batch_url(batch))
 
-                new_dns = dns.update.Update(str(def_dns.domain).rstrip('.'))
-                new_dns.delete(str(newb.herd.vhost), 'cname')
-                new_dns.add(
-                    str(newb.herd.vhost), '300', 'cname',
-                    str(newb.server.hostname)
-                )
-
-                for ns in def_dns.nameservers:
-                    dns.query.tcp(new_dns, ns)
-
-            except Exception, e:
-                self.message_user(request,
-                    "%s : %s" % (e, newb), messages.ERROR
-                )
-                continue
-
-            # Now we should get the list of all replica instances in this
-            # herd, which should include the old primary. We just need to
-            # update the recovery.conf file and reload the instance.
-
-            try:
-                herd = Instance.objects.filter(
-                    master_id__isnull = False,
-                    herd_id = newb.herd_id
-                )
+    failover_pair.short_description = "Fail Over to Listed Replica"
 
-                for member in herd:
-                    member.master = newb
-                    member.save()
 
-                    util = PGUtility(member)
-                    util.update_stream_config()
-                    util.reload()                
+    def refresh_dns(self, request, queryset):
+        """
+        Point the vhost of every selected pair at its herd primary
 
-            except Exception, e:
-                self.message_user(request,
-                    "%s : %s" % (e, newb), messages.ERROR
-                )
-                continue
+        This is meant for cleaning up after a failover where the DNS step
+        failed. All vhosts are changed with a single DNS update.
+        """
 
-            self.message_user(request,
-                "%s now active on %s!" % (newb.herd, newb.server.hostname)
-            )
+        self.refresh_vhosts(request, set(inst.herd_id for inst in queryset))
 
-    failover_pair.short_description = "Fail Over to Listed Replica"
+    refresh_dns.short_description = "Refresh DNS for Selected Herds"
 
 
 admin.site.register(DisasterRecovery, DRAdmin)
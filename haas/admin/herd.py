@@ -1,14 +1,99 @@
 from django.contrib import admin
+from django.conf.urls import url
+from django.shortcuts import get_object_or_404, render
 
-from haas.models import Herd
+from haas.models import Herd, Instance
 from haas.admin.base import HAASAdmin
 
 __all__ = ['HerdAdmin']
 
 class HerdAdmin(HAASAdmin):
+    actions = ['refresh_dns']
     exclude = ('created_dt', 'modified_dt')
     list_display = ('herd_name', 'db_port', 'vhost', 'pgdata')
     search_fields = ('herd_name', 'herd_descr', 'db_port', 'vhost')
     list_filter = ('environment', 'db_port')
 
+
+    def get_urls(self):
+        urls = super(HerdAdmin, self).get_urls()
+        my_urls = [
+            url(r'^(\d+)/topology/$', self.admin_site.admin_view(self.topology)),
+        ]
+        return my_urls + urls
+
+
+    def topology(self, request, herd_id):
+        """
+        Show the replication tree of one herd
+
+        Every primary is listed with the replicas streaming from it nested
+        underneath, along with how far each replica trails its own
+        upstream. Instances feeding more replicas than the herd allows are
+        flagged. So are instances caught in a replication loop, since they
+        can't be placed anywhere in the tree.
+        """
+
+        herd = get_object_or_404(Herd, pk=herd_id)
+        members = list(Instance.objects.filter(herd=herd).select_related(
+            'server'
+        ).order_by('server__hostname'))
+
+        children = {}
+        for inst in members:
+            children.setdefault(inst.master_id, []).append(inst)
+
+        known = set(inst.pk for inst in members)
+        rows = []
+        placed = set()
+
+        def walk(inst, depth, upstream):
+            lag = None
+            if upstream and upstream.xlog_pos is not None and \
+                inst.xlog_pos is not None:
+                lag = round((upstream.xlog_pos - inst.xlog_pos) /
+                    1024.0 / 1024.0, 2
+                )
+
+            followers = children.get(inst.pk, [])
+            rows.append(dict(
+                instance = inst,
+                depth = depth,
+                indent = depth * 2,
+                lag = lag,
+                feeds = len(followers),
+                over = herd.max_fanout and len(followers) > herd.max_fanout,
+            ))
+            placed.add(inst.pk)
+
+            for follower in followers:
+                walk(follower, depth + 1, inst)
+
+        for inst in members:
+            if inst.master_id is None or inst.master_id not in known:
+                walk(inst, 0, None)
+
+        context = dict(
+           self.admin_site.each_context(request),
+           opts = self.model._meta,
+           herd = herd,
+           rows = rows,
+           orphans = [inst for inst in members if inst.pk not in placed],
+        )
+        return render(request, 'admin/haas/herd/topology.html', context)
+
+
+    def refresh_dns(self, request, queryset):
+        """
+        Point the vhost of every selected herd at its current primary
+
+        All vhosts are changed with a single DNS update, which is sent to
+        every nameserver at once.
+        """
+
+        self.refresh_vhosts(request, queryset.values_list('pk', flat=True))
+
+    refresh_dns.short_description = "Refresh DNS for Selected Herds"
+
+
 admin.site.register(Herd, HerdAdmin)
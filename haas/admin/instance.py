@@ -1,10 +1,20 @@
 from django.contrib import admin, messages
-from django.shortcuts import render
+from django.conf import settings
+from django.conf.urls import url
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import format_html, format_html_join
+
+from datetime import timedelta
 
 import psycopg2
 import socket
 
-from haas.models import Instance
+from haas.discovery import probe_server
+from haas.models import Instance, LagRollup
+from haas.sqlrunner import SQLRunner
 from haas.utility import PGUtility
 from haas.admin.base import HAASAdmin, SharedInstanceAdmin
 
@@ -34,10 +44,22 @@ class PrimaryInstanceFilter(admin.SimpleListFilter):
         return queryset
 
 
+# Each lag chart range maps to the rollup resolution that covers it with a
+# few hundred points at most.
+
+LAG_RANGES = [
+    ('6h', timedelta(hours=6), '1m'),
+    ('1d', timedelta(days=1), '1m'),
+    ('7d', timedelta(days=7), '1h'),
+    ('30d', timedelta(days=30), '1h'),
+    ('1y', timedelta(days=365), '1d'),
+]
+
+
 class InstanceAdmin(SharedInstanceAdmin):
     actions = ['start_instances', 'stop_instances', 'restart_instances',
         'reload_instances', 'promote_instances', 'demote_instances',
-        'rebuild_instances',
+        'rebuild_instances', 'run_sql',
     ]
     exclude = ('created_dt', 'modified_dt')
     list_display = ('herd', 'get_server', 'get_port', 'version', 
@@ -47,7 +69,7 @@ class InstanceAdmin(SharedInstanceAdmin):
         PrimaryInstanceFilter, 'version'
     )
     search_fields = ('herd__herd_name', 'server__hostname', 'version')
-    readonly_fields = ('master',)
+    list_select_related = ('server', 'herd__environment', 'master')
 
 
     def mb_lag(self, instance):
@@ -78,6 +100,69 @@ class InstanceAdmin(SharedInstanceAdmin):
     get_port.admin_order_field = 'herd__db_port'
 
 
+    def get_urls(self):
+        urls = super(InstanceAdmin, self).get_urls()
+        my_urls = [
+            url(r'^(\d+)/lag/$', self.admin_site.admin_view(self.lag_history)),
+        ]
+        return my_urls + urls
+
+
+    def lag_history(self, request, instance_id):
+        """
+        Chart replication lag of one instance over time
+
+        The chart is drawn from rollups alone, never raw samples, so even a
+        year of history is a few hundred rows. Longer ranges use coarser
+        rollups.
+        """
+
+        inst = get_object_or_404(Instance.objects.select_related(
+            'herd__environment', 'server'), pk=instance_id
+        )
+
+        ranges = dict((name, (span, res)) for name, span, res in LAG_RANGES)
+        chosen = request.GET.get('range', '1d')
+        if chosen not in ranges:
+            chosen = '1d'
+
+        span, resolution = ranges[chosen]
+        end = timezone.now()
+        start = end - span
+
+        rollups = list(LagRollup.objects.filter(
+            instance=inst, resolution=resolution, bucket_ts__gte=start
+        ).values_list('bucket_ts', 'avg_lag', 'max_lag'))
+
+        # Scale everything to the chart area here, so the template only
+        # needs to print the SVG coordinates.
+
+        width, height = 800, 200
+        peak = max([r[2] or 0 for r in rollups] + [1])
+        seconds = span.total_seconds()
+
+        def point(ts, lag):
+            x = (ts - start).total_seconds() / seconds * width
+            y = height - float(lag or 0) / peak * height
+            return '%.1f,%.1f' % (x, y)
+
+        context = dict(
+           self.admin_site.each_context(request),
+           opts = self.model._meta,
+           instance = inst,
+           ranges = [name for name, span, res in LAG_RANGES],
+           chosen = chosen,
+           resolution = resolution,
+           width = width,
+           height = height,
+           peak_mb = round(peak / 1024.0 / 1024.0, 2),
+           avg_points = ' '.join(point(ts, avg) for ts, avg, mx in rollups),
+           max_points = ' '.join(point(ts, mx) for ts, avg, mx in rollups),
+           samples = len(rollups),
+        )
+        return render(request, 'admin/haas/instance/lag.html', context)
+
+
     def get_form(self, request, obj=None, **kwargs):
         form = super(InstanceAdmin, self).get_form(request, obj, **kwargs)
 
@@ -104,23 +189,43 @@ class InstanceAdmin(SharedInstanceAdmin):
         """
 
         # First, check the online status. We want this to be as fresh as
-        # possible, so we might as well grab it now.
+        # possible, so we might as well grab it now. A single probe of the
+        # server tells us that, the version, and whether the instance exists
+        # at all. If the probe doesn't work on this server, we ask for each
+        # of those separately.
+
+        pgdata = (obj.local_pgdata or obj.herd.pgdata).rstrip('/')
+        cluster = None
+
+        try:
+            for found in probe_server(obj.server, [pgdata]):
+                if found['pgdata'] == pgdata:
+                    cluster = found
+        except Exception:
+            pass
 
         obj.is_online = False
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        check = sock.connect_ex((obj.server.hostname, obj.herd.db_port))
+        if cluster:
+            obj.is_online = cluster['is_online']
+            obj.version = obj.version or cluster['version']
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            check = sock.connect_ex((obj.server.hostname, obj.herd.db_port))
 
-        if check == 0:
-            obj.is_online = True
+            if check == 0:
+                obj.is_online = True
 
         # Then, since herds are organized such that each herd follows a single
         # primary node, we can auto-declare that this is a replica or not.
-        # If we search and find a primary for this herd, that instance will
-        # become our master.
+        # If we search and find a primary for this herd, that instance or
+        # one of its replicas will become our master, unless one was chosen
+        # explicitly for cascading replication.
 
         util = PGUtility(obj)
-        obj.master = util.get_herd_primary()
+
+        if not obj.master:
+            obj.master = util.get_upstream()
         obj.version = util.get_version()
 
         if obj.master and not obj.version:
@@ -135,12 +240,25 @@ class InstanceAdmin(SharedInstanceAdmin):
         # just because it didn't fully work.
 
         try:
-            util.init_missing()
+            if not cluster:
+                util.init_missing()
         except Exception, e:
             self.message_user(request, "Instance init: %s" % str(e),
                 messages.WARNING
             )
 
+        # An existing replica moved to a new upstream has to be told, or it
+        # will keep streaming from the old one.
+
+        if change and obj.master and 'master' in form.changed_data:
+            try:
+                util.update_stream_config()
+                util.reload()
+            except Exception, e:
+                self.message_user(request, "Stream config: %s" % str(e),
+                    messages.WARNING
+                )
+
 
     def start_instances(self, request, queryset):
         """
@@ -149,22 +267,7 @@ class InstanceAdmin(SharedInstanceAdmin):
         Skip already running services.
         """
 
-        for inst in queryset:
-            if inst.is_online:
-                self.message_user(request, "%s is already running." % inst,
-                    messages.WARNING
-                )
-                continue
-
-            try:
-                util = PGUtility(inst)
-                util.start()
-
-            except Exception, e:
-                self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                continue
-
-            self.message_user(request, "%s started!" % inst)
+        self.dispatch_action(request, 'start', queryset)
 
     start_instances.short_description = "Start Selected Instances"
 
@@ -176,22 +279,7 @@ class InstanceAdmin(SharedInstanceAdmin):
         Skip already stopped services.
         """
 
-        for inst in queryset:
-            if not inst.is_online:
-                self.message_user(request, "%s is already stopped." % inst,
-                    messages.WARNING
-                )
-                continue
-
-            try:
-                util = PGUtility(inst)
-                util.stop()
-
-            except Exception, e:
-                self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                continue
-
-            self.message_user(request, "%s stopped!" % inst)
+        self.dispatch_action(request, 'stop', queryset)
 
     stop_instances.short_description = "Stop Selected Instances"
 
@@ -202,19 +290,9 @@ class InstanceAdmin(SharedInstanceAdmin):
         """
 
         if request.POST.get('post') == 'yes':
-
-            for inst_id in request.POST.getlist(admin.ACTION_CHECKBOX_NAME):
-                inst = Instance.objects.get(pk=inst_id)
-
-                try:
-                    util = PGUtility(inst)
-                    util.promote()
-
-                except Exception, e:
-                    self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                    continue
-
-                self.message_user(request, "%s promoted to read/write!" % inst)
+            self.dispatch_action(request, 'promote', Instance.objects.filter(
+                pk__in=request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+            ))
             return
 
         # Now go to the confirmation form. It's very basic, and only serves
@@ -257,23 +335,9 @@ class InstanceAdmin(SharedInstanceAdmin):
             # to demote each. It should perform the check logic that ensures
             # we always have at least one remaining master in the herd.
 
-            for inst_id in request.POST.getlist(admin.ACTION_CHECKBOX_NAME):
-                inst = Instance.objects.get(pk=inst_id)
-
-                #util = PGUtility(inst)
-                #result = util.demote()
-
-                try:
-                    util = PGUtility(inst)
-                    result = util.demote()
-
-                except Exception, e:
-                    self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                    continue
-
-                host=inst.server.hostname
-                herd=inst.herd
-                self.message_user(request, "%s demoted to %s replica!" % (host, herd))
+            self.dispatch_action(request, 'demote', Instance.objects.filter(
+                pk__in=request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+            ))
             return
 
         # For the confirmation piece, we should remove any streaming replicas,
@@ -334,17 +398,7 @@ class InstanceAdmin(SharedInstanceAdmin):
         unline start, we don't skip running ones.
         """
 
-        for inst in queryset:
-            try:
-                util = PGUtility(inst)
-                util.stop()
-                util.start()
-
-            except Exception, e:
-                self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
-                continue
-
-            self.message_user(request, "%s restarted!" % inst)
+        self.dispatch_action(request, 'restart', queryset)
 
     restart_instances.short_description = "Restart Selected Instances"
 
@@ -356,19 +410,188 @@ class InstanceAdmin(SharedInstanceAdmin):
         This is provided as a way of reloading configuration files.
         """
 
-        for inst in queryset:
+        self.dispatch_action(request, 'reload', queryset)
+
+    reload_instances.short_description = "Reload Selected Instances"
+
+
+    def get_actions(self, request):
+        """
+        Only offer arbitrary SQL to superusers
+        """
+
+        actions = super(InstanceAdmin, self).get_actions(request)
+
+        if not request.user.is_superuser:
+            actions.pop('run_sql', None)
+
+        return actions
+
+
+    def run_sql(self, request, queryset):
+        """
+        Execute a SQL statement on all selected instances at once
+
+        Results are streamed back as each instance produces them, either as
+        a CSV download of every row, or as pages of at most SQL_MAX_ROWS
+        rows. Since a statement could do anything at all, this is only
+        available to superusers.
+        """
+
+        if not request.user.is_superuser:
+            return
+
+        statement = request.POST.get('statement', '').strip()
+
+        if request.POST.get('post') == 'yes' and statement:
+            instances = Instance.objects.filter(
+                pk__in=request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+            ).select_related('herd__environment', 'server')
+
             try:
-                util = PGUtility(inst)
-                util.reload()
+                timeout = int(request.POST.get('timeout'))
+            except (TypeError, ValueError):
+                timeout = None
+
+            if request.POST.get('format') == 'csv':
+                runner = SQLRunner(statement, timeout)
+                response = StreamingHttpResponse(runner.run_csv(instances),
+                    content_type='text/csv'
+                )
+                response['Content-Disposition'] = \
+                    'attachment; filename="elephaas-sql.csv"'
+                return response
 
-            except Exception, e:
-                self.message_user(request, "%s : %s" % (e, inst), messages.ERROR)
+            # Every page shows the same window of rows from each instance,
+            # sized so the whole page holds at most SQL_MAX_ROWS.
+
+            try:
+                page = max(int(request.POST.get('page')), 0)
+            except (TypeError, ValueError):
+                page = 0
+
+            per_instance = max(settings.SQL_MAX_ROWS / max(len(instances), 1),
+                1
+            )
+
+            runner = SQLRunner(statement, timeout, offset=page * per_instance,
+                limit=per_instance
+            )
+
+            return StreamingHttpResponse(
+                self.__sql_page(request, runner, instances, page)
+            )
+
+        return render(request, 'admin/haas/instance/sql.html',
+                {'queryset' : queryset,
+                 'statement': statement,
+                 'timeout': settings.SQL_TIMEOUT,
+                 'opts': self.model._meta,
+                 'action_checkbox_name': admin.ACTION_CHECKBOX_NAME,
+                }
+        )
+
+    run_sql.short_description = "Run SQL on Selected Instances"
+
+
+    def __sql_page(self, request, runner, instances, page):
+        """
+        Produce one page of SQL results piece by piece as rows arrive
+
+        The page template is rendered once, and split where the results go.
+        Rows are grouped by their columns, since instances may not all
+        return the same ones. Rows with the columns seen first are shown as
+        they arrive, and any others follow in tables of their own, each
+        with its own header. Once every instance is done, links to the
+        neighboring pages follow, if there are any.
+        """
+
+        page_html = render_to_string('admin/haas/instance/sql_result.html',
+            dict(
+                self.admin_site.each_context(request),
+                opts = self.model._meta,
+                statement = runner.statement,
+            ),
+            request=request
+        )
+        head, tail = page_html.split('<!-- results -->')
+
+        yield head
+
+        shown = 0
+        errors = 0
+        first = None
+        others = []
+        held = {}
+
+        def header(columns):
+            return format_html(
+                u'<tr><th>Container</th><th>Port</th>{}</tr>\n',
+                format_html_join(u'', u'<th>{}</th>',
+                    ((c,) for c in columns)
+                )
+            )
+
+        for inst, row, e in runner.run(instances):
+            if e:
+                errors += 1
+                yield format_html(
+                    u'<tr class="errornote"><td>{}</td><td>{}</td>'
+                    u'<td colspan="{}">{}</td></tr>\n',
+                    inst.server.hostname, inst.herd.db_port,
+                    len(first or [None]), e
+                )
                 continue
 
-            self.message_user(request, "%s config files reloaded!" % inst)
+            columns = tuple(runner.columns[inst.pk])
+            html = format_html(u'<tr><td>{}</td><td>{}</td>{}</tr>\n',
+                inst.server.hostname, inst.herd.db_port,
+                format_html_join(u'', u'<td>{}</td>', ((v,) for v in row))
+            )
+            shown += 1
+
+            if first is None:
+                first = columns
+                yield header(columns)
 
-    reload_instances.short_description = "Reload Selected Instances"
+            if columns == first:
+                yield html
+                continue
 
+            if columns not in held:
+                others.append(columns)
+            held.setdefault(columns, []).append(html)
 
-admin.site.register(Instance, InstanceAdmin)
+        yield u'</table>\n'
+
+        for columns in others:
+            yield u'<table width="100%">\n' + header(columns)
+            for html in held[columns]:
+                yield html
+            yield u'</table>\n'
+
+        yield format_html(u'<p>{} rows, {} errors.</p>', shown, errors)
 
+        if runner.truncated:
+            yield format_html(u'<p>{} instances returned more rows than '
+                u'are shown, from a statement that would run again for the '
+                u'next page. Export as CSV to see all of them.</p>',
+                len(runner.truncated)
+            )
+
+        if page or runner.more:
+            yield render_to_string('admin/haas/instance/sql_pages.html', {
+                    'instances': instances,
+                    'statement': runner.statement,
+                    'timeout': runner.timeout,
+                    'previous': page - 1 if page else None,
+                    'next': page + 1 if runner.more else None,
+                    'action_checkbox_name': admin.ACTION_CHECKBOX_NAME,
+                },
+                request=request
+            )
+
+        yield tail
+
+
+admin.site.register(Instance, InstanceAdmin)
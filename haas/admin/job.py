@@ -0,0 +1,178 @@
+import json
+
+from django.contrib import admin
+from django.conf.urls import url
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
+
+from datetime import timedelta
+
+from haas.models import Job, TraceSpan
+from haas.admin.base import HAASAdmin
+
+__all__ = ['JobAdmin']
+
+class JobAdmin(HAASAdmin):
+    actions = None
+    list_display = ('job_id', 'action', 'instance', 'status', 'priority',
+        'progress', 'message', 'owner', 'created_dt', 'finished_dt'
+    )
+    list_filter = ('status', 'action', 'priority', 'owner')
+    list_select_related = ('instance__herd__environment', 'source__server')
+    search_fields = ('batch', 'message', 'instance__server__hostname',
+        'instance__herd__herd_name'
+    )
+    readonly_fields = [f.name for f in Job._meta.fields]
+
+
+    def has_add_permission(self, request):
+        return False
+
+
+    def get_urls(self):
+        urls = super(JobAdmin, self).get_urls()
+        my_urls = [
+            url(r'^progress/$', self.admin_site.admin_view(self.progress)),
+            url(r'^batch/(?P<batch>[0-9a-f]+)/$',
+                self.admin_site.admin_view(self.batch)
+            ),
+            url(r'^(\d+)/trace/$', self.admin_site.admin_view(self.trace)),
+        ]
+        return my_urls + urls
+
+
+    def progress(self, request):
+        """
+        Report the current state of a batch of jobs as JSON
+
+        This is what the batch page polls to update itself. Jobs can be
+        requested by batch, or by a comma-separated list of job IDs. Any
+        phase timings the jobs recorded are included, as is the latest
+        output of long commands, such as rsync progress.
+        """
+
+        jobs = Job.objects.select_related('instance__herd__environment',
+            'instance__server'
+        )
+
+        if request.GET.get('batch'):
+            jobs = jobs.filter(batch=request.GET['batch'])
+        else:
+            ids = request.GET.get('ids', '').split(',')
+            jobs = jobs.filter(pk__in=[i for i in ids if i.isdigit()])
+
+        result = []
+        started = finished = None
+
+        for job in jobs.order_by('job_id'):
+            if job.started_dt:
+                started = min(started or job.started_dt, job.started_dt)
+            if job.finished_dt:
+                finished = max(finished or job.finished_dt, job.finished_dt)
+
+            try:
+                phases = json.loads(job.detail).get('phases', [])
+            except ValueError:
+                phases = []
+
+            result.append({
+                'job_id': job.job_id,
+                'action': job.action,
+                'instance': unicode(job.instance) if job.instance else '',
+                'server': job.instance.server.hostname if job.instance else '',
+                'status': job.status,
+                'progress': job.progress,
+                'message': job.message,
+                'phases': phases,
+                'output': job.output,
+            })
+
+        done = all(j['status'] in ('done', 'failed') for j in result)
+
+        # The batch is only as fast as its slowest job, so report how long
+        # it has taken from the first start to the last finish.
+
+        elapsed = None
+        if started:
+            end = finished if done and finished else timezone.now()
+            elapsed = round((end - started).total_seconds(), 1)
+
+        return JsonResponse({'jobs': result, 'done': done,
+            'elapsed': elapsed
+        })
+
+
+    def batch(self, request, batch):
+        """
+        Display a self-updating progress page for one batch of jobs
+        """
+
+        context = dict(
+           self.admin_site.each_context(request),
+           opts = self.model._meta,
+           batch = batch,
+        )
+        return render(request, 'admin/haas/job/batch.html', context)
+
+
+
+    def trace(self, request, job_id):
+        """
+        Show every traced phase of one job as a waterfall
+
+        Phases are nested under the phase that started them, and each gets
+        a bar placed on a timeline spanning the whole job. Phases that are
+        still running extend to the present.
+        """
+
+        job = get_object_or_404(Job, pk=job_id)
+        spans = list(TraceSpan.objects.filter(job=job))
+        now = timezone.now()
+
+        def ended(span):
+            if span.seconds is None:
+                return now
+            return span.started_dt + timedelta(seconds=span.seconds)
+
+        children = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+
+        rows = []
+
+        if spans:
+            first = min(s.started_dt for s in spans)
+            total = max(
+                (max(ended(s) for s in spans) - first).total_seconds(), 0.001
+            )
+
+        def walk(span, depth):
+            offset = (span.started_dt - first).total_seconds()
+            length = (ended(span) - span.started_dt).total_seconds()
+
+            rows.append(dict(
+                span = span,
+                indent = depth * 2,
+                offset = round(offset, 1),
+                left = round(100 * offset / total, 2),
+                width = max(round(100 * length / total, 2), 0.2),
+            ))
+
+            for child in children.get(span.pk, []):
+                walk(child, depth + 1)
+
+        for span in children.get(None, []):
+            walk(span, 0)
+
+        context = dict(
+           self.admin_site.each_context(request),
+           opts = self.model._meta,
+           job = job,
+           rows = rows,
+           total = round(total, 1) if spans else 0,
+        )
+        return render(request, 'admin/haas/job/trace.html', context)
+
+
+admin.site.register(Job, JobAdmin)
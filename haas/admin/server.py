@@ -1,6 +1,7 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django import forms
 
+from haas.discovery import scan_servers
 from haas.models import Server
 from haas.utility import execute_remote_cmd
 from haas.admin.base import HAASAdmin
@@ -32,6 +33,50 @@ class ServerAdmin(HAASAdmin):
     list_display = ('hostname', 'environment')
     list_filter = ('environment',)
     search_fields = ('hostname', )
+    list_select_related = ('environment',)
     form = ServerForm
+    actions = ['scan_servers']
+
+
+    def scan_servers(self, request, queryset):
+        """
+        Register or refresh every instance found on the selected servers
+
+        Each server is probed with a single remote command, and all of them
+        at once. Clusters that don't match exactly one herd are listed so
+        an admin can create the herd, or register them by hand. So are
+        clusters that would be a second primary in their herd.
+        """
+
+        report = scan_servers(queryset.select_related('environment'))
+
+        for server, e in report['failed']:
+            self.message_user(request, "%s : %s" % (e, server.hostname),
+                messages.ERROR
+            )
+
+        for server, cluster in report['unknown']:
+            self.message_user(request, "No herd matches %s:%s (%s, %s)" % (
+                server.hostname, cluster['port'], cluster['pgdata'],
+                cluster['version']
+                ), messages.WARNING
+            )
+
+        for server, cluster, herd in report['conflicts']:
+            self.message_user(request, "%s:%s (%s) is not a replica, but " \
+                "%s already has a primary" % (server.hostname,
+                cluster['port'], cluster['pgdata'], herd
+                ), messages.WARNING
+            )
+
+        self.message_user(request, "Registered %d and refreshed %d " \
+            "instances on %d servers." % (
+                len(report['created']), len(report['refreshed']),
+                len(queryset) - len(report['failed'])
+            )
+        )
+
+    scan_servers.short_description = "Scan Selected Servers for Instances"
+
 
 admin.site.register(Server, ServerAdmin)
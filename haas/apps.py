@@ -3,3 +3,12 @@ from django.apps import AppConfig
 class HAASApp(AppConfig):
     name = 'haas'
     verbose_name = 'Elephant Herd as a Service'
+
+    def ready(self):
+
+        # Check every remote command template now, so a typo in COMMANDS
+        # stops us from starting rather than failing halfway through a
+        # bulk action.
+
+        from haas.cmdtemplate import compile_commands
+        compile_commands()
@@ -0,0 +1,345 @@
+import threading
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from haas.executor import FanOut
+from haas.jobs import claim, enqueue, run_job, run_task
+from haas.models import Environment, Herd, Instance, Job, Server
+from haas.utility import execute_remote_cmd
+
+
+__all__ = ['SCENARIOS', 'Result', 'seed_fleet', 'bench_changelist',
+    'bench_connect', 'bench_action', 'bench_rebuild', 'bench_failover',
+]
+
+class Result(object):
+    """
+    Timings of every item handled by one benchmark scenario
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.failed = []
+        self.elapsed = 0.0
+        self.queries = None
+
+
+    def timed(self, func):
+        """
+        Wrap a function so every call to it is timed
+
+        :param func: Function of a single item.
+
+        :return: Function recording how long each call took.
+        """
+
+        def run(item):
+            started = time.time()
+            try:
+                return func(item)
+            finally:
+                self.latencies.append(time.time() - started)
+
+        return run
+
+
+    def percentile(self, pct):
+        """
+        Get the item latency below which pct percent of items finished
+
+        :param pct: Percentile, from 0 to 100.
+
+        :return: Latency in seconds, or 0 if nothing was timed.
+        """
+
+        if not self.latencies:
+            return 0.0
+
+        ordered = sorted(self.latencies)
+        return ordered[int(round(pct / 100.0 * (len(ordered) - 1)))]
+
+
+    @property
+    def errors(self):
+        """
+        Number of items that failed
+        """
+
+        return len(self.failed)
+
+
+    @property
+    def rate(self):
+        """
+        Items handled per second, over the whole scenario
+        """
+
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+
+def _fan_out(result, executor, func, items):
+    """
+    Run a function on items with a FanOut, and record the results
+
+    :param result: Result to record timings and errors in.
+    :param executor: FanOut to run the function with.
+    :param func: Function of a single item.
+    :param items: List of items to run it on.
+
+    :return: The result, for convenience.
+    """
+
+    started = time.time()
+    results = executor.map(result.timed(func), items)
+    result.elapsed = time.time() - started
+    result.failed = [(item, e) for item, r, e in results if e]
+
+    return result
+
+
+def _task(action):
+    """
+    Get a function running a task on one instance, which raises if it fails
+    """
+
+    def run(inst):
+        level, message = run_task(action, inst)
+
+        if level == messages.ERROR:
+            raise Exception(message)
+
+    return run
+
+
+def seed_fleet(fleet, herds, replicas, servers):
+    """
+    Create a benchmark inventory, and a matching fake fleet
+
+    Every herd gets its own port, and a primary with several replicas,
+    each on a different server. Members of a herd are spread over
+    consecutive servers, so all servers carry about the same number of
+    instances. Everything starts out online.
+
+    :param fleet: FakeFleet to add every instance to.
+    :param herds: Number of herds to create.
+    :param replicas: Replicas of every herd primary.
+    :param servers: Number of servers, at least one more than replicas.
+
+    :return: Number of instances created.
+    """
+
+    servers = max(servers, replicas + 1)
+
+    env = Environment.objects.create(env_name='bench',
+        env_descr='Benchmark fleet'
+    )
+
+    Server.objects.bulk_create([
+        Server(environment=env, hostname='bench-%05d' % i)
+        for i in range(servers)
+    ])
+
+    Herd.objects.bulk_create([
+        Herd(environment=env, herd_name='bench%05d' % i,
+            base_name='bench%05d' % i, herd_descr='', db_port=10000 + i,
+            pgdata='/var/lib/postgresql/%s/bench%05d' % (fleet.version, i),
+            vhost='bench%05d-db' % i
+        )
+        for i in range(herds)
+    ])
+
+    hosts = list(Server.objects.filter(environment=env).order_by('hostname'))
+    herd_list = list(Herd.objects.filter(environment=env).order_by(
+        'herd_name'
+    ))
+
+    def member(index, m, master=None):
+        herd = herd_list[index]
+        server = hosts[(index * (replicas + 1) + m) % servers]
+
+        fleet.add_cluster(server.hostname, herd.base_name, herd.db_port,
+            online=True, recovery=bool(master)
+        )
+
+        return Instance(herd=herd, server=server, version=fleet.version,
+            is_online=True, master=master
+        )
+
+    Instance.objects.bulk_create([
+        member(i, 0) for i in range(herds)
+    ])
+
+    primaries = dict(
+        (inst.herd_id, inst) for inst in Instance.objects.filter(
+            herd__environment=env
+        )
+    )
+
+    Instance.objects.bulk_create([
+        member(i, m, primaries[herd_list[i].pk])
+        for i in range(herds) for m in range(1, replicas + 1)
+    ])
+
+    return herds * (replicas + 1)
+
+
+def bench_changelist(pages):
+    """
+    Render pages of the instance list in the admin
+
+    Every request is made by a superuser, which is the worst case for
+    permission checks. The number of queries of the costliest page is
+    recorded as well.
+
+    :param pages: Number of pages to render.
+    """
+
+    result = Result('changelist')
+
+    User.objects.filter(username='bench').delete()
+    User.objects.create_superuser('bench', 'bench@localhost', 'bench')
+
+    client = Client()
+    client.login(username='bench', password='bench')
+    url = reverse('admin:haas_instance_changelist')
+
+    def render(page):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, {'p': page})
+
+        result.queries = max(result.queries, len(queries))
+
+        if response.status_code != 200:
+            raise Exception('Page %d: HTTP %d' % (page, response.status_code))
+
+    started = time.time()
+
+    for page in range(pages):
+        try:
+            result.timed(render)(page)
+        except Exception, e:
+            result.failed.append((page, e))
+
+    result.elapsed = time.time() - started
+
+    return result
+
+
+def bench_connect():
+    """
+    Run one trivial command on every server at once
+
+    This is the first contact with each host, so it's mostly the cost of
+    the SSH handshake. Scenarios that follow reuse pooled connections.
+    """
+
+    return _fan_out(Result('connect'), FanOut(),
+        lambda host: execute_remote_cmd(host, 'echo Hello World'),
+        list(Server.objects.values_list('hostname', flat=True))
+    )
+
+
+def bench_action(action):
+    """
+    Run an action on every instance, as the admin does
+
+    :param action: Name of a task that needs no source, such as start.
+    """
+
+    instances = list(Instance.objects.select_related('herd__environment',
+        'server', 'master'
+    ))
+
+    return _fan_out(Result(action), FanOut.per_server(), _task(action),
+        instances
+    )
+
+
+def bench_rebuild(count):
+    """
+    Rebuild several replicas through the job queue, as a worker does
+
+    The rebuilds are queued, then claimed and run just like haas_worker
+    does, with up to FANOUT_WORKERS running at once. So claim() decides
+    which rebuilds may run together, and which source each copies from,
+    as it would for real. Replicas are taken in order, so several replicas
+    of one master are usually rebuilt. Each rebuild is timed from when it
+    was claimed until it finished. Any left in the queue once nothing is
+    running count as failures.
+
+    :param count: Number of replicas to rebuild.
+    """
+
+    result = Result('rebuild')
+    batch = enqueue('rebuild', Instance.objects.filter(master__isnull=False
+    ).order_by('pk')[:count])
+
+    started = time.time()
+    threads = []
+
+    while True:
+        threads = [t for t in threads if t.is_alive()]
+
+        job = None
+        if len(threads) < settings.FANOUT_WORKERS:
+            job = claim(['rebuild'])
+
+        if job:
+            thread = threading.Thread(target=result.timed(run_job),
+                args=(job,)
+            )
+            thread.start()
+            threads.append(thread)
+            continue
+
+        if not threads:
+            break
+
+        time.sleep(0.05)
+
+    result.elapsed = time.time() - started
+    result.failed = [(job, job.message or 'Never claimed.')
+        for job in Job.objects.filter(batch=batch).exclude(status='done')
+    ]
+
+    return result
+
+
+def bench_failover(count):
+    """
+    Fail over several herds at once, as a DR failover does
+
+    The first replica of each herd primary is promoted.
+
+    :param count: Number of herds to fail over.
+    """
+
+    chosen = {}
+
+    for inst in Instance.objects.filter(master__isnull=False,
+        master__master__isnull=True
+    ).select_related('herd__environment', 'server', 'master__server'
+    ).order_by('pk'):
+        if len(chosen) >= count:
+            break
+        chosen.setdefault(inst.herd_id, inst)
+
+    return _fan_out(Result('failover'), FanOut(settings.FAILOVER_WORKERS),
+        _task('failover'), chosen.values()
+    )
+
+
+# Scenarios in the order they run by default. Stopping comes before
+# starting, since the fleet starts out online.
+
+SCENARIOS = ['changelist', 'connect', 'stop', 'start', 'rebuild',
+    'failover'
+]
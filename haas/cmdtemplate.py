@@ -0,0 +1,246 @@
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+
+from haas.models import Instance
+
+
+__all__ = ['CommandTemplate', 'compile_commands', 'render_command']
+
+# Variables every command template may use, and what they hold. See the
+# Commands section of the README.
+
+VARIABLES = {
+    'inst': Instance,
+    'pgdata': str,
+    'version': list,
+}
+
+# The settings COMMANDS dict the cache was compiled from, and the compiled
+# templates by name. Settings may be overridden while testing, so the
+# templates are compiled again whenever the dict itself changes.
+
+_compiled = (None, {})
+
+
+class CommandTemplate(object):
+    """
+    A command from the COMMANDS setting, ready to fill in for any instance
+
+    Commands are Python format strings, which may include other commands
+    as {COMMANDS[name]} macros. Macros are unrolled once, when the template
+    is compiled, and every variable the command refers to is checked then
+    as well. Misspelled variables, instance fields, and macros are all
+    reported right away, rather than when the command is first needed.
+
+    Once compiled, a command is a single format string with no macros
+    left, and rendering only computes the variables it actually uses.
+    """
+
+    def __init__(self, name, commands):
+        """
+        Compile a command template
+
+        :param name: Name of the command in commands.
+        :param commands: Dict of every command, for unrolling macros.
+
+        :raises: ImproperlyConfigured if the command is invalid.
+        """
+
+        self.name = name
+        self.variables = set()
+
+        parts = []
+
+        for literal, field in self.__expand(name, commands, ()):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+
+            if field:
+                self.variables.add(field[0])
+                parts.append('{%s%s%s}' % (field[1],
+                    '!' + field[2] if field[2] else '',
+                    ':' + field[3] if field[3] else ''
+                ))
+
+        self.template = ''.join(parts)
+
+
+    def __fail(self, message):
+        raise ImproperlyConfigured("COMMANDS['%s']: %s" % (self.name, message))
+
+
+    def __expand(self, name, commands, seen):
+        """
+        Parse a command, unrolling any macros it uses
+
+        :param name: Name of the command to parse.
+        :param commands: Dict of every command.
+        :param seen: Names of the commands that led to this one, to
+            detect macros that include themselves.
+
+        :return: List of (literal text, field) pairs. Fields are tuples of
+            the variable name, the full field name, any conversion, and the
+            format spec. The field is None if there's only literal text.
+        """
+
+        if name in seen:
+            self.__fail('macro loop through %s.' % ' -> '.join(
+                seen + (name,)
+            ))
+
+        if name not in commands:
+            self.__fail('no such command: %s.' % name)
+
+        pieces = []
+
+        try:
+            parsed = list(commands[name]._formatter_parser())
+        except ValueError, e:
+            self.__fail('%s in %s.' % (e, name))
+
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                pieces.append((literal, None))
+
+            if field is None:
+                continue
+
+            if field == '':
+                self.__fail('positional fields like {} are not allowed.')
+
+            root, lookups = field._formatter_field_name_split()
+            lookups = list(lookups)
+
+            if root == 'COMMANDS':
+                if len(lookups) != 1 or lookups[0][0] or spec or conversion:
+                    self.__fail('macros must look like {COMMANDS[name]}.')
+
+                pieces.extend(self.__expand(lookups[0][1], commands,
+                    seen + (name,)
+                ))
+                continue
+
+            if root not in VARIABLES:
+                self.__fail('unknown variable %s. Use %s, or COMMANDS.' % (
+                    root, ', '.join(sorted(VARIABLES))
+                ))
+
+            if conversion not in (None, 'r', 's'):
+                self.__fail('unknown conversion !%s.' % conversion)
+
+            if '{' in spec:
+                self.__fail('nested fields are not allowed in {%s}.' % field)
+
+            self.__check(field, VARIABLES[root], lookups)
+            pieces.append(('', (root, field, conversion, spec)))
+
+        return pieces
+
+
+    def __check(self, field, kind, lookups):
+        """
+        Make sure every attribute in a field exists
+
+        Model fields are followed through foreign keys to the related
+        model. Anything beyond a property or a plain column can't be
+        checked without an actual instance, so checking stops there.
+
+        :param field: Full field, for error messages.
+        :param kind: Model or type of the variable the field starts from.
+        :param lookups: List of (is attribute, key) lookups.
+        """
+
+        for is_attr, key in lookups:
+            if kind is None:
+                return
+
+            if not is_attr:
+                if kind is not list or not isinstance(key, (int, long)):
+                    self.__fail('cannot look up [%s] in {%s}.' % (key, field))
+                kind = str
+                continue
+
+            if not hasattr(kind, '_meta'):
+                if not hasattr(kind, key):
+                    self.__fail('no attribute %s in {%s}.' % (key, field))
+                kind = None
+                continue
+
+            try:
+                model_field = kind._meta.get_field(key)
+            except FieldDoesNotExist:
+                if not hasattr(kind, key):
+                    self.__fail('%s has no field %s in {%s}.' % (
+                        kind.__name__, key, field
+                    ))
+                kind = None
+                continue
+
+            if model_field.name == key and (model_field.many_to_one or
+                model_field.one_to_one):
+                kind = model_field.related_model
+            else:
+                kind = None
+
+
+    def render(self, inst):
+        """
+        Fill in this command for one instance
+
+        :param inst: Instance the command will act on.
+
+        :return: Full command string.
+        """
+
+        values = {'inst': inst}
+
+        if 'pgdata' in self.variables:
+            values['pgdata'] = inst.local_pgdata or inst.herd.pgdata
+        if 'version' in self.variables:
+            values['version'] = inst.version.split('.')
+
+        return self.template.format(**values)
+
+
+def compile_commands():
+    """
+    Compile every command in the COMMANDS setting
+
+    This is done when the application starts, so a broken setting stops
+    ElepHaaS from starting at all.
+
+    :raises: ImproperlyConfigured if any command is invalid.
+    :return: Dict of CommandTemplate objects by command name.
+    """
+
+    global _compiled
+
+    commands = getattr(settings, 'COMMANDS', {})
+    templates = dict(
+        (name, CommandTemplate(name, commands)) for name in commands
+    )
+
+    _compiled = (commands, templates)
+
+    return templates
+
+
+def render_command(name, inst):
+    """
+    Fill in a command from the COMMANDS setting for one instance
+
+    :param name: Name of the command.
+    :param inst: Instance the command will act on.
+
+    :return: Full command string, or an empty string if no such command
+        is defined.
+    """
+
+    commands, templates = _compiled
+
+    if commands is not getattr(settings, 'COMMANDS', {}):
+        templates = compile_commands()
+
+    if name not in templates:
+        return ''
+
+    return templates[name].render(inst)
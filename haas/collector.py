@@ -0,0 +1,291 @@
+import errno
+import select
+import socket
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from haas import history
+from haas.executor import FanOut
+from haas.models import Instance
+from haas.pgpool import pg_pool
+from haas.utility import lsn_to_int
+
+
+__all__ = ['probe_ports', 'resolve', 'query_position', 'collect',
+    'prune_slots',
+]
+
+def probe_ports(instances, timeout=None):
+    """
+    Check which instances accept TCP connections on their herd port
+
+    Rather than connecting to each instance in turn, every connection is
+    started at once with non-blocking sockets, and we simply wait for all
+    of them to finish. Checking a thousand instances takes no longer than
+    checking the slowest one. We use poll rather than select, since select
+    can't watch more than 1024 sockets. Host names are resolved first, in
+    parallel, since a slow name lookup would otherwise block every
+    connection behind it. Hosts that can't be resolved are offline.
+
+    :param instances: Iterable of Instance objects with herd and server.
+    :param timeout: Seconds to wait for connections. Defaults to the
+        COLLECTOR_TIMEOUT setting.
+
+    :return: Set of instance IDs that accepted a connection.
+    """
+
+    timeout = timeout or settings.COLLECTOR_TIMEOUT
+    pending = {}
+    online = set()
+
+    instances = list(instances)
+    hostnames = set(inst.server.hostname for inst in instances)
+
+    pool = FanOut(workers=settings.COLLECTOR_THREADS)
+    addresses = dict(
+        (host, addr) for host, addr, e in pool.map(resolve, hostnames)
+        if not e
+    )
+
+    for inst in instances:
+        if inst.server.hostname not in addresses:
+            continue
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+
+        try:
+            code = sock.connect_ex((addresses[inst.server.hostname],
+                inst.herd.db_port
+            ))
+        except socket.error:
+            sock.close()
+            continue
+
+        if code == 0:
+            online.add(inst.pk)
+            sock.close()
+        elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = inst.pk
+        else:
+            sock.close()
+
+    poller = select.poll()
+    sockets = {}
+
+    for sock in pending:
+        poller.register(sock, select.POLLOUT)
+        sockets[sock.fileno()] = sock
+
+    deadline = time.time() + timeout
+
+    while pending and time.time() < deadline:
+        ready = poller.poll(max(deadline - time.time(), 0) * 1000)
+
+        for fd, event in ready:
+            sock = sockets[fd]
+
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                online.add(pending[sock])
+
+            poller.unregister(fd)
+            sock.close()
+            del pending[sock]
+
+    for sock in pending:
+        sock.close()
+
+    return online
+
+
+def resolve(hostname):
+    """
+    Look up the IPv4 address of a host
+
+    :param hostname: Name of the host.
+
+    :raises: socket.error if the name can't be resolved.
+    :return: Address of the host, as a string.
+    """
+
+    return socket.getaddrinfo(hostname, None, socket.AF_INET,
+        socket.SOCK_STREAM
+    )[0][4][0]
+
+
+def query_position(inst):
+    """
+    Get the current WAL position of an instance
+
+    For a primary, this is the current write position. For a replica, it's
+    the last position replayed, since that's what matters for failover.
+
+    The query may take no longer than COLLECTOR_TIMEOUT seconds, so one
+    hung instance can't hold up a whole collection pass.
+
+    :param inst: Instance object with herd and server.
+
+    :return: Integer LSN, or None if it couldn't be determined.
+    """
+
+    try:
+        modern = int(inst.version.split('.')[0]) >= 10
+    except (AttributeError, ValueError):
+        modern = False
+
+    if modern:
+        query = """SELECT CASE WHEN pg_is_in_recovery()
+                          THEN pg_last_wal_replay_lsn()
+                          ELSE pg_current_wal_lsn() END::text"""
+    else:
+        query = """SELECT CASE WHEN pg_is_in_recovery()
+                          THEN pg_last_xlog_replay_location()
+                          ELSE pg_current_xlog_location() END::text"""
+
+    with pg_pool.connection(inst.server.hostname, inst.herd.db_port,
+        settings.COLLECTOR_TIMEOUT) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+        return lsn_to_int(cur.fetchone()[0])
+
+
+def collect(threads=None):
+    """
+    Refresh is_online and xlog_pos for every managed instance
+
+    Instances are probed all at once, and WAL positions of the online ones
+    are queried in parallel over pooled connections. Only rows where
+    something actually changed are written back, in a single statement.
+    Every position we obtained is also recorded in the lag history.
+
+    :param threads: Concurrent position queries. Defaults to the
+        COLLECTOR_THREADS setting.
+
+    :return: Tuple of instances checked and instances changed.
+    """
+
+    instances = list(Instance.objects.select_related('herd', 'server'))
+    online = probe_ports(instances)
+
+    pool = FanOut(workers=threads or settings.COLLECTOR_THREADS)
+    results = pool.map(query_position,
+        [inst for inst in instances if inst.pk in online]
+    )
+
+    positions = dict((inst.pk, pos) for inst, pos, e in results if not e)
+    changes = []
+
+    for inst in instances:
+        is_online = inst.pk in online
+        pos = positions.get(inst.pk)
+
+        if pos is None:
+            pos = inst.xlog_pos
+
+        if is_online != inst.is_online or pos != inst.xlog_pos:
+            changes.append((inst.pk, is_online, pos))
+
+    if changes:
+        values = ', '.join(['(%s, %s, %s::BIGINT)'] * len(changes))
+        params = [p for change in changes for p in change]
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE ele_instance i
+               SET is_online = v.is_online, xlog_pos = v.xlog_pos
+              FROM (VALUES %s) AS v (instance_id, is_online, xlog_pos)
+             WHERE i.instance_id = v.instance_id
+        """ % values, params)
+
+    # Lag is measured against the position of the upstream master in this
+    # same pass, so both sides of the comparison are equally fresh.
+
+    samples = []
+
+    for inst in instances:
+        if inst.pk not in positions:
+            continue
+
+        lag = None
+        if inst.master_id in positions:
+            lag = max(positions[inst.master_id] - positions[inst.pk], 0)
+
+        samples.append((inst.pk, positions[inst.pk], lag))
+
+    history.record(samples)
+
+    return (len(instances), len(changes))
+
+
+def prune_slots(threads=None, max_retained=None):
+    """
+    Drop replication slots that no longer serve a live replica
+
+    Every slot created by ElepHaaS is named after the replica it serves.
+    An inactive slot is dropped if that replica no longer follows the
+    instance holding the slot, such as after a failover, or if the slot
+    is holding back more WAL than the threshold allows. The latter means
+    the replica is dead or hopelessly behind, and will have to be rebuilt
+    anyway, so we'd rather not let the upstream fill its disk waiting.
+    Active slots are never dropped.
+
+    Retained WAL is measured from the position the collector last stored
+    for the instance holding the slot.
+
+    :param threads: Concurrent instances checked. Defaults to the
+        COLLECTOR_THREADS setting.
+    :param max_retained: Bytes of WAL an inactive slot may hold. Defaults
+        to the SLOT_MAX_RETAINED setting.
+
+    :return: List of (instance, slot name, retained bytes) tuples for
+        every slot dropped.
+    """
+
+    limit = max_retained or settings.SLOT_MAX_RETAINED
+
+    instances = list(Instance.objects.filter(is_online = True).select_related(
+        'herd', 'server'
+    ))
+
+    wanted = {}
+
+    for inst in Instance.objects.filter(master_id__isnull = False,
+        herd__use_slots = True).select_related('herd', 'server'):
+        wanted.setdefault(inst.master_id, set()).add(inst.slot_name)
+
+    def prune(inst):
+        dropped = []
+
+        host, port = inst.server.hostname, inst.herd.db_port
+        timeout = settings.COLLECTOR_TIMEOUT
+
+        with pg_pool.connection(host, port, timeout) as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT slot_name, restart_lsn::text
+                  FROM pg_replication_slots
+                 WHERE slot_type = 'physical'
+                   AND NOT active
+                   AND left(slot_name, 5) = 'haas_'
+            """)
+
+            for name, restart in cur.fetchall():
+                retained = 0
+                if restart and inst.xlog_pos is not None:
+                    retained = max(inst.xlog_pos - lsn_to_int(restart), 0)
+
+                if name in wanted.get(inst.pk, ()) and retained <= limit:
+                    continue
+
+                cur.execute('SELECT pg_drop_replication_slot(%s)', [name])
+                dropped.append((inst, name, retained))
+
+        return dropped
+
+    pool = FanOut(workers=threads or settings.COLLECTOR_THREADS)
+    results = pool.map(prune, instances)
+
+    return [slot for inst, dropped, e in results if not e for slot in dropped]
+
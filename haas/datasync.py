@@ -0,0 +1,360 @@
+import heapq
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from haas import metrics, tracing
+from haas.executor import FanOut
+from haas.progress import format_size, rsync_progress
+from haas.sshpool import ssh_pool
+from haas.utility import RSYNC_VANISHED_OK, execute_remote_cmd
+
+
+__all__ = ['ParallelSync']
+
+# These are never copied by the data directory sync. The transaction logs
+# are synchronized separately once everything else is done, and the rest
+# are specific to a single instance. Replication slots in particular would
+# pin WAL on the replica forever.
+
+EXCLUDES = ['pg_xlog/*', 'pg_replslot/*', 'postmaster.*', 'recovery.conf']
+
+
+class ParallelSync(object):
+    """
+    Copy a Postgres data directory between hosts with several rsync streams
+
+    A single rsync stream can't saturate the network or disks of a modern
+    server, which makes multi-terabyte rebuilds far slower than they need
+    to be. This splits the data directory into work units and divides them
+    into balanced buckets, each transferred by its own rsync process. There
+    are usually more buckets than streams, so a sync that fails part way
+    through can report which buckets it finished, and a retry only has to
+    copy the rest.
+
+    Work units are individual files, so large relation segments and busy
+    databases under base/ naturally spread across streams. Tablespaces are
+    included too. The pg_tblspc links themselves are copied as links, and
+    the directories they point to are copied to the same path on the
+    target host.
+
+    All rsync processes run on the target host and pull from the source,
+    just like the single-stream sync they replace. When traced, listing,
+    pruning, and every bucket are phases of their own, and each bucket
+    counts the bytes its rsync processes received. Progress of all streams
+    together can be reported as they run, including the overall transfer
+    rate and time left.
+    """
+
+    def __init__(self, source_host, target_host, streams=None,
+        compress=False, bwlimit=0, buckets=None, progress=None):
+        """
+        Initialize a parallel data directory sync
+
+        :param source_host: Host name to copy from.
+        :param target_host: Host name to copy to.
+        :param streams: Number of concurrent rsync processes. Defaults to
+            the REBUILD_STREAMS setting.
+        :param compress: Compress file data sent over the network.
+        :param bwlimit: Total bandwidth for the whole sync in KB per second,
+            shared evenly by all streams. 0 means no limit.
+        :param buckets: Number of buckets to divide the work into. Defaults
+            to the REBUILD_BUCKETS setting, and is never fewer than the
+            number of streams.
+        :param progress: Function called with a line describing the
+            progress of the whole sync, whenever a stream reports its own
+            or a bucket finishes. Streams only report their own progress
+            if RSYNC_PROGRESS is enabled.
+        """
+
+        self.source_host = source_host
+        self.target_host = target_host
+        self.streams = max(streams or settings.REBUILD_STREAMS, 1)
+        self.buckets = max(buckets or settings.REBUILD_BUCKETS, self.streams)
+        self.compress = compress
+        self.bwlimit = bwlimit
+        self.progress = progress
+        self.loads = []
+
+
+    def __source_cmd(self, command):
+        return execute_remote_cmd(self.source_host, command)
+
+
+    def __target_cmd(self, command, progress=None):
+        return execute_remote_cmd(self.target_host, command,
+            progress=progress
+        )
+
+
+    def list_units(self, root):
+        """
+        List everything within a directory on the source host
+
+        Everything in EXCLUDES is left out. The pg_replslot directory is
+        listed, since Postgres won't start without it, but the slots in it
+        are not.
+
+        :param root: Full path of the directory to list.
+
+        :return: List of (size, relative path) tuples. Directories and
+            symbolic links have a size of zero.
+        """
+
+        listing = self.__source_cmd(
+            "cd %s && find . \\( -path ./pg_xlog -o -path './pg_replslot/*' " \
+            "\\) -prune -o ! -path . ! -name 'postmaster.*' " \
+            "! -name recovery.conf -printf '%%y %%s %%P\\n'" % root
+        )
+
+        units = []
+
+        for line in listing.splitlines():
+            kind, size, path = line.split(' ', 2)
+            units.append((int(size) if kind == 'f' else 0, path))
+
+        return units
+
+
+    def list_tablespaces(self, pgdata):
+        """
+        Find the directories all tablespaces in a data directory point to
+
+        :param pgdata: Full path of the source data directory.
+
+        :return: List of full tablespace paths on the source host.
+        """
+
+        links = self.__source_cmd(
+            "find %s -maxdepth 1 -type l -printf '%%l\\n'" % (
+                os.path.join(pgdata, 'pg_tblspc'),
+            )
+        )
+
+        return [l.strip() for l in links.splitlines() if l.strip()]
+
+
+    def plan(self, roots, skip=()):
+        """
+        Divide all work units into balanced buckets
+
+        This is the classic longest-processing-time heuristic: handle the
+        biggest units first, and always give the next one to the bucket
+        with the least work so far.
+
+        :param roots: List of (source dir, target dir) pairs to copy.
+        :param skip: Full source paths of units that were already copied.
+
+        :return: List of buckets, each a dict mapping a root index to the
+            relative paths within that root assigned to the bucket. The
+            number of bytes in each bucket is kept in the loads attribute.
+        """
+
+        units = []
+
+        for index, (source, target) in enumerate(roots):
+            for size, path in self.list_units(source):
+                if os.path.join(source, path) not in skip:
+                    units.append((size, index, path))
+
+        units.sort(reverse=True)
+
+        heap = [(0, b) for b in range(self.buckets)]
+        buckets = [{} for b in range(self.buckets)]
+        loads = [0] * self.buckets
+
+        for size, index, path in units:
+            load, b = heapq.heappop(heap)
+            buckets[b].setdefault(index, []).append(path)
+            loads[b] = load + size
+            heapq.heappush(heap, (load + size, b))
+
+        self.loads = [loads[b] for b in range(self.buckets) if buckets[b]]
+
+        return [b for b in buckets if b]
+
+
+    def prune(self, roots):
+        """
+        Remove files on the target that no longer exist on the source
+
+        With --existing and --ignore-existing together, rsync transfers no
+        files at all, but --delete still removes anything extraneous. This
+        does for the whole tree what the file lists can't.
+
+        :param roots: List of (source dir, target dir) pairs to prune.
+        """
+
+        sync = 'rsync -a -K --rsh=ssh --delete --existing --ignore-existing'
+        sync += ''.join(' --exclude=%s' % e for e in EXCLUDES)
+        sync += ' postgres@%s:%s/ %s/'
+
+        for source, target in roots:
+            self.__target_cmd(sync % (self.source_host, source, target) +
+                RSYNC_VANISHED_OK
+            )
+
+
+    def transfer(self, roots, bucket, progress=None):
+        """
+        Transfer one bucket of work units with its own rsync streams
+
+        The file list for each root is uploaded to the target host, since
+        that's where rsync runs and reads --files-from. Files removed from
+        the source since they were listed are simply skipped.
+
+        :param roots: List of (source dir, target dir) pairs.
+        :param bucket: Dict of root index to relative paths, from plan().
+        :param progress: Function called with every line rsync prints, as
+            it prints them.
+        """
+
+        sync = 'rsync -a -K --rsh=ssh -W --stats --files-from=%s'
+        if progress and settings.RSYNC_PROGRESS:
+            sync += ' --info=progress2'
+        if self.compress:
+            sync += ' -z'
+        if self.bwlimit:
+            sync += ' --bwlimit=%d' % max(self.bwlimit / self.streams, 1)
+        sync += ' postgres@%s:%s/ %s/'
+
+        for index, paths in sorted(bucket.items()):
+            source, target = roots[index]
+            remote_list = '/tmp/elephaas-sync-%s.list' % uuid.uuid4().hex
+
+            list_file = tempfile.NamedTemporaryFile(bufsize=0)
+            list_file.write('\n'.join(paths) + '\n')
+
+            with ssh_pool.session(self.target_host) as client:
+                started = time.time()
+                sftp = client.open_sftp()
+                try:
+                    sftp.put(list_file.name, remote_list)
+                finally:
+                    sftp.close()
+
+            metrics.record_transfer(self.target_host,
+                os.path.getsize(list_file.name), time.time() - started
+            )
+
+            list_file.close()
+
+            try:
+                tracing.add_bytes(tracing.rsync_bytes(self.__target_cmd(
+                    sync % (remote_list, self.source_host, source, target) +
+                    RSYNC_VANISHED_OK, progress
+                )))
+            finally:
+                self.__target_cmd('rm -f %s' % remote_list)
+
+
+    def run(self, source_dir, target_dir, skip=(), copied=None):
+        """
+        Synchronize a data directory and its tablespaces
+
+        Units copied by an earlier, interrupted run may be skipped. Any
+        changes to them since are in the WAL written after the backup
+        started, so they'll be replayed like any others.
+
+        :param source_dir: Full path of the source data directory.
+        :param target_dir: Full path of the target data directory.
+        :param skip: Full source paths of units that were already copied.
+        :param copied: Function called with the full source paths of the
+            units in each bucket, as soon as that bucket is transferred.
+            It may be called from several threads at once.
+
+        :raises: Exception if any of the rsync streams failed.
+        """
+
+        roots = [(source_dir, target_dir)]
+
+        for path in self.list_tablespaces(source_dir):
+            roots.append((path, path))
+
+        with tracing.span('prune', self.target_host):
+            self.prune(roots)
+
+        with tracing.span('plan', self.source_host):
+            buckets = self.plan(roots, skip)
+
+        # Each stream reports how far into its current bucket it is. Along
+        # with the buckets already finished, that's how far along we are.
+
+        total = sum(self.loads)
+        started = time.time()
+        finished = [0]
+        current = {}
+        lock = threading.Lock()
+
+        def report(number, line=None):
+            if line:
+                parsed = rsync_progress(line)
+                if not parsed:
+                    return
+
+            with lock:
+                if line:
+                    current[number] = min(parsed[0], self.loads[number])
+                else:
+                    current.pop(number, None)
+                    finished[0] += self.loads[number]
+
+                done = finished[0] + sum(current.values())
+
+            self.progress(self.describe(done, total, time.time() - started))
+
+        def transfer(number):
+            bucket = buckets[number]
+            stream = None
+
+            if self.progress:
+                stream = lambda line: report(number, line)
+
+            with tracing.span('bucket', self.target_host):
+                self.transfer(roots, bucket, stream)
+
+            if copied:
+                copied([os.path.join(roots[index][0], path)
+                    for index, paths in bucket.items() for path in paths
+                ])
+
+            if self.progress:
+                report(number)
+
+        pool = FanOut(workers=self.streams)
+        results = pool.map(transfer, range(len(buckets)))
+
+        errors = [str(e) for number, result, e in results if e]
+
+        if errors:
+            raise Exception('\n'.join(errors))
+
+
+    def describe(self, done, total, elapsed):
+        """
+        Describe the progress of a sync, like rsync does for one stream
+
+        :param done: Bytes copied so far.
+        :param total: Bytes to copy in all.
+        :param elapsed: Seconds since the copy started.
+
+        :return: Line with the amount copied, transfer rate and time left.
+        """
+
+        rate = done / elapsed if elapsed > 0 else 0
+        line = 'Copied %s of %s (%d%%) with %d streams' % (
+            format_size(done), format_size(total),
+            100 * done / total if total else 100, self.streams
+        )
+
+        if rate:
+            left = int((total - done) / rate)
+            line += ' at %s/s, %d:%02d:%02d left' % (format_size(rate),
+                left / 3600, left / 60 % 60, left % 60
+            )
+
+        return line
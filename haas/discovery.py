@@ -0,0 +1,277 @@
+import pipes
+
+from django.conf import settings
+from django.db import transaction
+
+from haas.executor import FanOut
+from haas.models import Herd, Instance
+from haas.utility import execute_remote_cmd, lsn_to_int
+
+
+__all__ = ['PROBE_SCRIPT', 'search_paths', 'probe_server', 'match_herd',
+    'scan_servers'
+]
+
+# Every Postgres data directory has a PG_VERSION file and a global
+# directory. So does every database under base/, minus the global part,
+# which is how we tell them apart. Running clusters list their port in the
+# fourth line of postmaster.pid, and tell us their recovery state and WAL
+# position themselves. Stopped clusters only have their config file and
+# recovery.conf (or standby.signal) to go on.
+#
+# One line is printed per cluster: data directory, version, port, running
+# (1 or 0), in recovery (t or f), and WAL position, separated by tabs.
+
+PROBE_SCRIPT = r"""
+exec 2>/dev/null
+for found in $(find %(roots)s -maxdepth %(depth)d -name PG_VERSION | sort -u); do
+  dir=$(dirname "$found")
+  [ -d "$dir/global" ] || continue
+  ver=$(cat "$dir/PG_VERSION")
+  port=''; up=0; rec=f; lsn=''
+  if [ -f "$dir/postmaster.pid" ]; then
+    pid=$(sed -n 1p "$dir/postmaster.pid")
+    port=$(sed -n 4p "$dir/postmaster.pid")
+    kill -0 "$pid" && up=1
+  fi
+  if [ -z "$port" ]; then
+    port=$(sed -n 's/^[[:space:]]*port[[:space:]]*=[[:space:]]*\([0-9]*\).*/\1/p' \
+      "$dir/postgresql.conf" | tail -n 1)
+  fi
+  if [ -f "$dir/recovery.conf" ] || [ -f "$dir/standby.signal" ]; then
+    rec=t
+  fi
+  if [ $up = 1 ] && [ -n "$port" ]; then
+    case $ver in
+      8.*|9.*) f=xlog; l=location ;;
+      *) f=wal; l=lsn ;;
+    esac
+    out=$(psql -p "$port" -At -F ' ' -c "SELECT pg_is_in_recovery(),
+      CASE WHEN pg_is_in_recovery() THEN pg_last_${f}_replay_${l}()
+      ELSE pg_current_${f}_${l}() END" postgres)
+    if [ -n "$out" ]; then
+      rec=${out%%%% *}; lsn=${out#* }
+    fi
+  fi
+  printf '%%s\t%%s\t%%s\t%%s\t%%s\t%%s\n' "$dir" "$ver" "$port" "$up" "$rec" "$lsn"
+done
+exit 0
+"""
+
+
+def search_paths():
+    """
+    List the directories to search for data directories
+
+    These are the paths in the DISCOVERY_PATHS setting, and the data
+    directory of every herd and instance already known to ElepHaaS.
+
+    :return: Sorted list of directories.
+    """
+
+    roots = set(settings.DISCOVERY_PATHS)
+    roots.update(Herd.objects.values_list('pgdata', flat=True))
+    roots.update(Instance.objects.exclude(local_pgdata='').values_list(
+        'local_pgdata', flat=True
+    ))
+
+    return sorted(r for r in roots if r)
+
+
+def probe_server(server, paths=None):
+    """
+    List every Postgres cluster on a server with a single remote command
+
+    :param server: Server object to probe.
+    :param paths: Directories to search. Defaults to search_paths().
+
+    :raises: Exception if the server couldn't be reached.
+    :return: List of dicts, each with the pgdata, version, port,
+        is_online, in_recovery, and xlog_pos of one cluster.
+    """
+
+    if paths is None:
+        paths = search_paths()
+
+    script = PROBE_SCRIPT % dict(
+        roots = ' '.join(pipes.quote(p) for p in paths),
+        depth = settings.DISCOVERY_DEPTH,
+    )
+
+    clusters = []
+
+    for line in execute_remote_cmd(server.hostname, script).splitlines():
+        parts = line.split('\t')
+
+        if len(parts) != 6:
+            continue
+
+        pgdata, version, port, up, rec, lsn = parts
+
+        clusters.append(dict(
+            pgdata = pgdata.rstrip('/'),
+            version = version.strip(),
+            port = int(port) if port.isdigit() else None,
+            is_online = up == '1',
+            in_recovery = rec == 't',
+            xlog_pos = lsn_to_int(lsn),
+        ))
+
+    return clusters
+
+
+def match_herd(server, cluster, herds):
+    """
+    Find the herd a discovered cluster belongs to
+
+    The herd must use the same port, and be in the same environment as the
+    server if the server has one. If several herds qualify, the one whose
+    data directory matches wins.
+
+    :param server: Server object the cluster was found on.
+    :param cluster: Cluster dict from probe_server.
+    :param herds: List of every Herd object to choose from.
+
+    :return: The matching Herd, or None if there is no single match.
+    """
+
+    found = [h for h in herds if h.db_port == cluster['port'] and
+        (not server.environment_id or
+            h.environment_id == server.environment_id)
+    ]
+
+    if len(found) > 1:
+        found = [h for h in found
+            if h.pgdata.rstrip('/') == cluster['pgdata']
+        ]
+
+    return found[0] if len(found) == 1 else None
+
+
+def scan_servers(servers, workers=None):
+    """
+    Register or refresh every instance found on several servers
+
+    Each server is probed once, and all of them at the same time. Every
+    cluster found is matched to a herd. Instances ElepHaaS already knows
+    about get their version, online status and WAL position refreshed.
+    The rest are registered, primaries first, so new replicas can follow
+    the herd primary. A herd never gets a second primary this way. Nothing
+    is created or changed on the servers.
+
+    :param servers: Iterable of Server objects to scan.
+    :param workers: Servers probed at once. Defaults to the FANOUT_WORKERS
+        setting.
+
+    :return: Dict with lists of created and refreshed instances, unknown
+        (server, cluster) pairs that matched no herd, conflicts of (server,
+        cluster, herd) for clusters that aren't replicas in herds that
+        already have a primary, and failed (server, error) pairs for
+        servers that couldn't be probed.
+    """
+
+    paths = search_paths()
+    results = FanOut(workers).map(
+        lambda server: probe_server(server, paths), servers
+    )
+    herds = list(Herd.objects.all())
+
+    report = dict(created=[], refreshed=[], unknown=[], conflicts=[],
+        failed=[]
+    )
+    found = {}
+
+    # A server may have more than one copy of a herd, such as an old data
+    # directory left behind. The running copy is the one that counts.
+
+    for server, clusters, e in results:
+        if e:
+            report['failed'].append((server, e))
+            continue
+
+        for cluster in sorted(clusters, key=lambda c: not c['is_online']):
+            herd = match_herd(server, cluster, herds)
+
+            if not herd:
+                report['unknown'].append((server, cluster))
+            elif (herd.pk, server.pk) not in found:
+                found[(herd.pk, server.pk)] = (server, herd, cluster)
+
+    known = dict(
+        ((inst.herd_id, inst.server_id), inst)
+        for inst in Instance.objects.filter(
+            server__in = [server for server, c, e in results]
+        ).select_related('herd', 'server')
+    )
+
+    new = []
+
+    with transaction.atomic():
+        for server, herd, cluster in found.values():
+            inst = known.get((herd.pk, server.pk))
+
+            if inst:
+                Instance.objects.filter(pk = inst.pk).update(
+                    version = cluster['version'] or inst.version,
+                    is_online = cluster['is_online'],
+                    xlog_pos = cluster['xlog_pos'] or inst.xlog_pos,
+                )
+                report['refreshed'].append(inst)
+                continue
+
+            inst = Instance(herd = herd, server = server,
+                version = cluster['version'],
+                is_online = cluster['is_online'],
+                xlog_pos = cluster['xlog_pos'],
+            )
+
+            if cluster['pgdata'] != herd.pgdata.rstrip('/'):
+                inst.local_pgdata = cluster['pgdata']
+
+            new.append((inst, cluster['in_recovery'], cluster))
+
+        # A herd only ever has one primary. Any other cluster that isn't a
+        # replica is most likely a stale data directory, or a replica that
+        # lost its recovery configuration, and is left for an admin to sort
+        # out. Where a new herd has several, an online one is preferred.
+
+        herded = set(Instance.objects.filter(
+            herd_id__in = [i.herd_id for i, rec, c in new],
+            master_id__isnull = True
+        ).values_list('herd_id', flat=True))
+
+        created = []
+
+        standalone = [(inst, c) for inst, rec, c in new if not rec]
+        standalone.sort(key=lambda n: not n[0].is_online)
+
+        for inst, cluster in standalone:
+            if inst.herd_id in herded:
+                report['conflicts'].append((inst.server, cluster, inst.herd))
+                continue
+
+            herded.add(inst.herd_id)
+            created.append(inst)
+
+        # Primaries have to exist before replicas can follow them.
+
+        Instance.objects.bulk_create(created)
+
+        primaries = {}
+
+        for inst in Instance.objects.filter(
+            herd_id__in = [i.herd_id for i, rec, c in new if rec],
+            master_id__isnull = True
+        ).order_by('-is_online', 'pk'):
+            primaries.setdefault(inst.herd_id, inst)
+
+        replicas = [i for i, rec, c in new if rec]
+
+        for inst in replicas:
+            inst.master = primaries.get(inst.herd_id)
+
+        Instance.objects.bulk_create(replicas)
+
+    report['created'] = created + replicas
+
+    return report
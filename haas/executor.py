@@ -0,0 +1,138 @@
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from haas import metrics, tracing
+
+
+__all__ = ['FanOut']
+
+class FanOut(object):
+    """
+    Run a function on many items at once, within concurrency limits
+
+    Bulk actions like restarting a few hundred instances spend nearly all
+    of their time waiting on remote hosts. This runs those actions in a
+    pool of threads so the total time depends on the slowest host rather
+    than the sum of all of them.
+
+    Besides the global thread limit, any number of keyed limits can be
+    imposed. Each is a function that maps an item to a key, such as the
+    server hosting an instance, and the maximum number of items with that
+    key that may run at once. Items are only started once every one of
+    their limits has room, so a busy server never holds up work destined
+    for the others.
+    """
+
+    def __init__(self, workers=None, limits=None):
+        """
+        Initialize a fan-out executor
+
+        :param workers: Maximum items running at once. Defaults to the
+            FANOUT_WORKERS setting.
+        :param limits: List of (key function, maximum) tuples.
+        """
+
+        self.workers = workers or settings.FANOUT_WORKERS
+        self.limits = limits or []
+
+
+    @classmethod
+    def per_server(cls, workers=None):
+        """
+        Create an executor limiting concurrent work on each server
+
+        This is the usual case for instance actions. The per-server limit
+        comes from the FANOUT_PER_SERVER setting.
+        """
+
+        return cls(workers, [
+            (lambda inst: inst.server_id, settings.FANOUT_PER_SERVER)
+        ])
+
+
+    def _keys(self, item):
+        return [(i, key(item)) for i, (key, cap) in enumerate(self.limits)]
+
+
+    def _admissible(self, keys, counts):
+        for i, key in keys:
+            if counts.get((i, key), 0) >= self.limits[i][1]:
+                return False
+        return True
+
+
+    def map(self, func, items):
+        """
+        Apply a function to every item, returning results in item order
+
+        Exceptions don't stop the other items. Each result is a tuple of
+        the item, the function's return value, and the exception raised,
+        if any.
+
+        :param func: Function accepting a single item.
+        :param items: Iterable of items to process.
+
+        :return: List of (item, result, exception) tuples.
+        """
+
+        items = list(items)
+        results = [None] * len(items)
+        pending = range(len(items))
+        counts = {}
+        running = [0]
+        cond = threading.Condition()
+
+        # Work done by the threads counts towards whatever request or job
+        # started it, and is traced in the same span.
+
+        tally = metrics.current()
+        parent = tracing.current()
+
+        def execute(index, keys):
+            item = items[index]
+
+            try:
+                with metrics.tracking(tally), tracing.within(parent):
+                    results[index] = (item, func(item), None)
+            except Exception, e:
+                results[index] = (item, None, e)
+            finally:
+                connection.close()
+
+                with cond:
+                    running[0] -= 1
+                    for k in keys:
+                        counts[k] -= 1
+                    cond.notify()
+
+        with cond:
+            while pending or running[0]:
+                started = False
+
+                for index in list(pending):
+                    if running[0] >= self.workers:
+                        break
+
+                    keys = self._keys(items[index])
+
+                    if not self._admissible(keys, counts):
+                        continue
+
+                    pending.remove(index)
+                    running[0] += 1
+                    for k in keys:
+                        counts[k] = counts.get(k, 0) + 1
+
+                    thread = threading.Thread(target=execute,
+                        args=(index, keys)
+                    )
+                    thread.daemon = True
+                    thread.start()
+                    started = True
+
+                if not started:
+                    cond.wait()
+
+        return results
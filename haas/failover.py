@@ -0,0 +1,180 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from django.conf import settings
+
+from haas.executor import FanOut
+from haas.models import Instance
+from haas.nameserver import dns_updater
+from haas.utility import PGUtility
+
+
+__all__ = ['PhaseTimer', 'failover_pair']
+
+class PhaseTimer(object):
+    """
+    Time each phase of a long operation, and report them to its job
+
+    Timings are kept in the order the phases ran, and the full list is
+    stored in the job detail as each phase finishes, along with whether
+    it took longer than its budget in the FAILOVER_BUDGET setting. A
+    phase that fails is still timed. Every phase is traced as well.
+    """
+
+    def __init__(self, util):
+        """
+        Initialize a phase timer
+
+        :param util: PGUtility for the instance being acted upon. Progress
+            is reported through it.
+        """
+
+        self.util = util
+        self.phases = []
+
+
+    @contextmanager
+    def phase(self, name, progress, message, host=None):
+        """
+        Time one phase of the operation
+
+        :param name: Short phase name, as used in FAILOVER_BUDGET.
+        :param progress: Approximate percentage complete at the start.
+        :param message: Description of the phase to report.
+        :param host: Host the phase runs on, if not that of our instance.
+        """
+
+        self.util.report(progress, message)
+        started = time.time()
+
+        try:
+            with self.util.trace(name, host):
+                yield
+        finally:
+            elapsed = round(time.time() - started, 2)
+            budget = settings.FAILOVER_BUDGET.get(name)
+
+            self.phases.append({
+                'phase': name, 'seconds': elapsed,
+                'over': bool(budget and elapsed > budget),
+            })
+
+            if self.util.job:
+                self.util.job.report(detail={'phases': self.phases})
+
+
+def failover_pair(newb, job=None):
+    """
+    Promote a Herd Follower to Leader Status
+
+    This process is fairly complicated, and comes in several parts:
+
+    1. Stop the current primary node. This ensures only the secondary
+       can accept new data.
+    2. Wait for the top follower to replay the old primary's final
+       checkpoint, then promote it to read/write status. This essentially
+       makes it the new leader of the herd.
+    3. Assign the follower as the new stream source to the old primary.
+       This officially swaps the roles of the two nodes. Note that the
+       new follower is still out of sync with the new leader. This will
+       require a separate node rebuild step to rectify.
+    4. Move the declared virtual host to the new leader, and wait until
+       every nameserver reports the change.
+    5. Reassign the other replicas of the old primary to follow the new
+       leader. We do this last because it relies on DNS propagation, and
+       pushing a reload after that step implies a reconnection. Replicas
+       are reconfigured all at once, so this takes as long as the slowest
+       one. Replicas cascading from the new leader are reconfigured too,
+       since they now reach it through the vhost. Anything further down
+       the tree keeps following the same upstream replica.
+
+    :param newb: Replica instance that should become the herd primary.
+    :param job: Job to report progress to, if any.
+
+    :raises: Exception if any step of the failover failed, or if any
+        replica could not be repointed.
+    :return: String describing the completed failover.
+    """
+
+    sage = newb.master
+
+    # Start with the transfer: stop -> catch up -> promote -> alter.
+    # The replica must replay everything up to the old primary's shutdown
+    # checkpoint before we promote it, or we lose those transactions. If
+    # the old primary's host is unreachable, the best we can do is replay
+    # everything the replica received.
+
+    sage_util = PGUtility(sage)
+    newb_util = PGUtility(newb, job)
+    timer = PhaseTimer(newb_util)
+
+    with timer.phase('stop', 10, 'Stopping %s' % sage.server.hostname,
+        sage.server.hostname):
+        sage_util.stop()
+
+    with timer.phase('catchup', 20, 'Waiting for replay to catch up'):
+        try:
+            target = sage_util.get_checkpoint_lsn()
+        except Exception:
+            target = None
+
+        newb_util.wait_for_lsn(target)
+
+    with timer.phase('promote', 40, 'Promoting'):
+        newb_util.promote()
+
+        sage.master = newb
+        sage.save()
+
+    # Now update the DNS. If other herds are failing over at the same
+    # time, their changes go out in the same update as ours.
+
+    with timer.phase('dns', 50, 'Moving %s' % newb.herd.vhost):
+        dns_updater.move(newb.herd.vhost, newb.server.hostname)
+
+    # Now point every replica of the old primary at the new leader. The
+    # catalog changes go out as a single update, and then every replica of
+    # the new leader, including the old primary, gets its new recovery.conf
+    # and reload at the same time, within the usual fan-out limits. Writing
+    # recovery.conf also creates each replica's slot on the new leader, if
+    # the herd uses them. Old slots are left for the collector to drop. This
+    # may exceed the herd fan-out limit, but the tree is only a preference,
+    # and demoting or rebuilding replicas will sort it out again.
+
+    Instance.objects.filter(master_id = sage.pk).update(master = newb)
+
+    herd = list(Instance.objects.filter(master_id = newb.pk).select_related(
+        'herd', 'server'
+    ))
+
+    done = [0]
+    lock = threading.Lock()
+
+    def repoint(member):
+        util = PGUtility(member)
+
+        with util.trace('replica'):
+            util.update_stream_config()
+            util.reload()
+
+        with lock:
+            done[0] += 1
+            newb_util.report(60 + 40 * done[0] / len(herd),
+                'Repointed %d of %d replicas' % (done[0], len(herd))
+            )
+
+    with timer.phase('repoint', 60, 'Repointing %d replicas' % len(herd)):
+        results = FanOut.per_server().map(repoint, herd)
+
+    failed = ['%s : %s' % (e, member) for member, r, e in results if e]
+
+    if failed:
+        raise Exception('%s now active on %s, but %d of %d replicas ' \
+            'were not repointed:\n%s' % (
+                newb.herd, newb.server.hostname, len(failed), len(herd),
+                '\n'.join(failed)
+            )
+        )
+
+    return "%s now active on %s!" % (newb.herd, newb.server.hostname)
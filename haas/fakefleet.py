@@ -0,0 +1,558 @@
+import random
+import re
+import select
+import socket
+import stat
+import threading
+import time
+
+import paramiko
+
+from collections import Counter
+from StringIO import StringIO
+
+
+__all__ = ['COMMANDS', 'CHECKPOINT_LSN', 'CURRENT_LSN', 'FakeFleet']
+
+# The fake fleet understands the Debian cluster wrappers, so benchmarks use
+# these commands regardless of how the COMMANDS setting is configured.
+
+COMMANDS = {
+    'base': 'pg_ctlcluster {version[0]}.{version[1]} {inst.herd.base_name}',
+    'start': '{COMMANDS[base]} start',
+    'stop': '{COMMANDS[base]} stop -m fast',
+    'reload': '{COMMANDS[base]} reload',
+    'promote': '{COMMANDS[base]} promote',
+    'init': 'pg_createcluster {version[0]}.{version[1]} {inst.herd.base_name} -D {pgdata} -p {inst.herd.db_port}',
+    'controldata': 'pg_controldata {pgdata}',
+}
+
+# Every cluster reports the same WAL positions. Replicas have always
+# replayed past the last checkpoint of their primary, so failovers never
+# wait for them to catch up.
+
+CHECKPOINT_LSN = '0/3000028'
+CURRENT_LSN = '0/3000060'
+
+
+class _Cluster(object):
+    """
+    State of one emulated Postgres cluster
+    """
+
+    def __init__(self, name, port, online, recovery):
+        self.name = name
+        self.port = port
+        self.online = online
+        self.recovery = recovery
+
+        # Start time of the running exclusive backup, if any.
+
+        self.backup = False
+
+
+class FakeFleet(object):
+    """
+    Emulate a fleet of Postgres servers behind a local SSH server
+
+    Every host gets its own port on the loopback interface, served by an
+    in-process paramiko SSH server that accepts any key. Commands sent to
+    a host are not executed, but interpreted: pg_ctlcluster, pg_isready,
+    psql, pg_controldata, pg_rewind, pg_basebackup, rsync, find, test, cat
+    and echo all answer the way a real server would, and track whether
+    each cluster is running, in recovery, or in backup mode. Anything else
+    quietly succeeds. Files sent over SFTP are kept in memory.
+
+    Each command waits latency seconds before answering, and each copy
+    waits copy_time seconds more. A failure_rate fraction of commands
+    fail outright, so error handling can be exercised too.
+
+    Point the SSH pool at the fleet by passing connect_options as its
+    connect_options function.
+    """
+
+    def __init__(self, latency=0.0, copy_time=0.0, failure_rate=0.0,
+        files=100, rewind=False, version='9.6', seed=None):
+        """
+        Initialize a fake fleet
+
+        :param latency: Seconds every command takes.
+        :param copy_time: Extra seconds taken by every rsync and
+            pg_basebackup.
+        :param failure_rate: Fraction of commands which fail, from 0 to 1.
+        :param files: Number of files in every data directory.
+        :param rewind: Let pg_rewind succeed rather than fail.
+        :param version: Postgres version found in every data directory.
+        :param seed: Seed for failure injection and file sizes.
+        """
+
+        self.latency = latency
+        self.copy_time = copy_time
+        self.failure_rate = failure_rate
+        self.rewind = rewind
+        self.version = version
+
+        self.random = random.Random(seed)
+        self.clusters = {}
+        self.uploads = {}
+        self.vhosts = {}
+        self.commands = Counter()
+        self.failures = 0
+
+        self.listing = 'd 0 base\n' + ''.join(
+            'f %d base/%d\n' % (self.random.randint(8192, 1 << 30), i)
+            for i in range(files)
+        )
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+
+        self._hosts = {}
+        self._listeners = {}
+        self._transports = []
+        self._poll = select.poll()
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def add_cluster(self, hostname, name, port, online=True, recovery=False):
+        """
+        Place an emulated Postgres cluster on a host
+
+        Clusters are found by name by pg_ctlcluster, and by port by psql
+        and pg_isready, on another host if they're given one with -h.
+        Commands for clusters nobody added fail the same way they would on
+        a real server.
+
+        :param hostname: Host the cluster runs on.
+        :param name: Cluster name, as given to pg_ctlcluster.
+        :param port: Port the cluster listens on.
+        :param online: Whether the cluster is running.
+        :param recovery: Whether the cluster is a replica.
+        """
+
+        cluster = _Cluster(name, port, online, recovery)
+        self.clusters[(hostname, name)] = cluster
+        self.clusters[(hostname, port)] = cluster
+
+
+    def start(self):
+        """
+        Start accepting SSH connections in a background thread
+        """
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop accepting connections, and close every open one
+        """
+
+        thread, self._thread = self._thread, None
+
+        if thread:
+            thread.join()
+
+        with self._lock:
+            for sock, hostname in self._listeners.values():
+                sock.close()
+            for transport in self._transports:
+                transport.close()
+
+            self._hosts = {}
+            self._listeners = {}
+            self._transports = []
+
+
+    def connect_options(self, hostname):
+        """
+        Tell paramiko how to reach a host in the fleet
+
+        A port is opened for each host the first time it's asked for.
+
+        :param hostname: Name of the emulated host.
+
+        :return: Dict of keyword arguments for paramiko's connect.
+        """
+
+        with self._lock:
+            if hostname not in self._hosts:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind(('127.0.0.1', 0))
+                sock.listen(32)
+
+                self._hosts[hostname] = sock.getsockname()[1]
+                self._listeners[sock.fileno()] = (sock, hostname)
+                self._poll.register(sock, select.POLLIN)
+
+            port = self._hosts[hostname]
+
+        return dict(hostname='127.0.0.1', port=port, pkey=self.client_key,
+            look_for_keys=False, allow_agent=False
+        )
+
+
+    def apply_dns(self, changes):
+        """
+        Stand in for DNSUpdater.apply
+
+        Nameservers aren't emulated. Every change is simply recorded, and
+        takes as long as any other command.
+
+        :param changes: List of (vhost, target host) pairs.
+
+        :return: Empty dict, since every change succeeds.
+        """
+
+        time.sleep(self.latency)
+
+        with self._lock:
+            self.commands['dns'] += 1
+            self.vhosts.update(changes)
+
+        return {}
+
+
+    def _serve(self):
+        while self._thread:
+            for fd, event in self._poll.poll(100):
+                with self._lock:
+                    sock, hostname = self._listeners.get(fd, (None, None))
+
+                if not sock:
+                    continue
+
+                conn, address = sock.accept()
+
+                transport = paramiko.Transport(conn)
+                transport.add_server_key(self.host_key)
+                transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                    _FakeSFTP
+                )
+                transport.start_server(threading.Event(),
+                    _FakeServer(self, hostname)
+                )
+
+                with self._lock:
+                    self._transports.append(transport)
+
+
+    def _exec(self, hostname, channel, command):
+
+        # The command may finish before paramiko has even accepted the exec
+        # request, and a channel closed that early looks like a failure to
+        # the client. So we only send EOF, and let the client close it.
+
+        try:
+            out, err, status = self.run(hostname, command)
+
+            # Output may also be a series of chunks, sent as they come.
+
+            for chunk in ([out] if isinstance(out, basestring) else out):
+                if chunk:
+                    channel.sendall(chunk)
+            if err:
+                channel.sendall_stderr(err)
+
+            channel.send_exit_status(status)
+        finally:
+            channel.shutdown_write()
+
+
+    def run(self, hostname, command):
+        """
+        Answer a command the way a real host would
+
+        :param hostname: Host the command was sent to.
+        :param command: Full command line.
+
+        :return: Tuple of standard output, standard error and exit status.
+            Standard output may be an iterable of chunks instead.
+        """
+
+        name = command.split(None, 1)[0] if command.strip() else ''
+
+        if '-printf' in command and '%y' in command:
+            name = 'find'
+
+        time.sleep(self.latency)
+
+        with self._lock:
+            self.commands[name] += 1
+
+            if self.random.random() < self.failure_rate:
+                self.failures += 1
+                return ('', 'fakefleet: injected %s failure\n' % name, 1)
+
+        handler = getattr(self, '_run_' + name.replace('-', '_'), None)
+
+        if not handler:
+            return ('', '', 0)
+
+        return handler(hostname, command)
+
+
+    def _cluster(self, hostname, key):
+        cluster = self.clusters.get((hostname, key))
+
+        if not cluster:
+            return None, ('', 'Error: specified cluster does not exist\n', 1)
+
+        return cluster, None
+
+
+    def _run_pg_ctlcluster(self, hostname, command):
+        args = command.split()
+        cluster, error = self._cluster(hostname, args[2])
+
+        if error:
+            return error
+
+        action = args[3]
+
+        if action == 'start':
+            if cluster.online:
+                return ('', 'Cluster is already running.\n', 2)
+            cluster.online = True
+
+        elif not cluster.online:
+            return ('', 'Cluster is not running.\n', 2)
+
+        elif action == 'stop':
+            cluster.online = False
+            cluster.backup = False
+
+        elif action == 'promote':
+            if not cluster.recovery:
+                return ('', 'server is not in standby mode\n', 1)
+            cluster.recovery = False
+
+        return ('', '', 0)
+
+
+    def _run_pg_createcluster(self, hostname, command):
+        return ('Creating new cluster\n', '', 0)
+
+
+    def _port(self, hostname, command):
+        found = re.search(r'-p\s*(\d+)', command)
+        remote = re.search(r'-h\s*(\S+)', command)
+
+        return self._cluster(remote.group(1) if remote else hostname,
+            int(found.group(1)) if found else 5432
+        )
+
+
+    def _run_pg_isready(self, hostname, command):
+        cluster, error = self._port(hostname, command)
+
+        if error or not cluster.online:
+            return ('', '', 2)
+
+        return ('', '', 0)
+
+
+    def _run_psql(self, hostname, command):
+        cluster, error = self._port(hostname, command)
+
+        if error or not cluster.online:
+            return ('', 'psql: could not connect to server: ' \
+                'No such file or directory\n', 2
+            )
+
+        if 'pg_start_backup' in command:
+            if cluster.backup:
+                return ('', 'ERROR:  a backup is already in progress\n', 1)
+            cluster.backup = time.strftime('%Y-%m-%d %H:%M:%S') + \
+                '.%06d+00' % self.random.randint(0, 999999)
+            return (CHECKPOINT_LSN + '\n', '', 0)
+
+        if 'pg_stop_backup' in command:
+            if not cluster.backup:
+                return ('', 'ERROR:  a backup is not in progress\n', 1)
+            cluster.backup = False
+            return (CURRENT_LSN + '\n', 'NOTICE:  pg_stop_backup complete, ' \
+                'all required WAL segments have been archived\n', 0
+            )
+
+        if 'pg_backup_start_time' in command:
+            return ((cluster.backup or '') + '\n', '', 0)
+
+        if 'pg_is_in_backup' in command:
+            return ('t\n' if cluster.backup else 'f\n', '', 0)
+
+        if 'pg_is_in_recovery' in command:
+            return ('t\n' if cluster.recovery else 'f\n', '', 0)
+
+        if re.search(r'_(lsn|location)\(', command):
+            return (CURRENT_LSN + '\n', '', 0)
+
+        return ('', '', 0)
+
+
+    def _run_pg_controldata(self, hostname, command):
+        return ('pg_control version number:            960\n'
+            'Latest checkpoint location:           %s\n' % CHECKPOINT_LSN,
+            '', 0
+        )
+
+
+    def _run_pg_rewind(self, hostname, command):
+        if not self.rewind:
+            return ('', 'pg_rewind: target server needs to use either data ' \
+                'checksums or "wal_log_hints = on"\n', 1
+            )
+
+        time.sleep(self.copy_time / 10)
+        return ('Done!\n', '', 0)
+
+
+    def _run_rsync(self, hostname, command):
+        if '--info=progress2' in command:
+            return (self._rsync_progress(command), '', 0)
+
+        time.sleep(self.copy_time)
+        return (self._rsync_stats(command), '', 0)
+
+
+    def _rsync_progress(self, command):
+
+        # Every copy moves a megabyte in four steps, redrawing one line of
+        # progress after each, like rsync does.
+
+        rate = 0.25 / max(self.copy_time, 0.001)
+
+        for step in range(1, 5):
+            time.sleep(self.copy_time / 4)
+            yield '%15s %3d%% %7.2fMB/s 0:00:%02d (xfr#%d, to-chk=%d/4)\r' % (
+                '{:,}'.format(262144 * step), 25 * step, rate,
+                (4 - step) * self.copy_time / 4, step, 4 - step
+            )
+
+        yield '\n' + self._rsync_stats(command)
+
+
+    def _rsync_stats(self, command):
+        if '--stats' not in command:
+            return ''
+
+        return 'Total bytes sent: 4,096\nTotal bytes received: 1,048,576\n'
+
+
+    def _run_pg_basebackup(self, hostname, command):
+        time.sleep(self.copy_time)
+        return ('', '', 0)
+
+
+    def _run_find(self, hostname, command):
+
+        # Only data directory listings find anything. There are no
+        # tablespaces, or any other files.
+
+        if '%y' not in command:
+            return ('', '', 0)
+
+        return (self.listing, '', 0)
+
+
+    def _run_cat(self, hostname, command):
+        if command.rstrip().endswith('PG_VERSION'):
+            return (self.version + '\n', '', 0)
+
+        return ('', '', 0)
+
+
+    def _run_echo(self, hostname, command):
+        return (command.split(None, 1)[1] + '\n', '', 0)
+
+
+class _FakeServer(paramiko.ServerInterface):
+    """
+    Accept any key, and pass every command to the fleet
+    """
+
+    def __init__(self, fleet, hostname):
+        self.fleet = fleet
+        self.hostname = hostname
+
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.fleet._exec,
+            args=(self.hostname, channel, command)
+        )
+        thread.daemon = True
+        thread.start()
+
+        return True
+
+
+class _FakeSFTP(paramiko.SFTPServerInterface):
+    """
+    Keep every file written over SFTP in the memory of the fleet
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super(_FakeSFTP, self).__init__(server, *args, **kwargs)
+        self.fleet = server.fleet
+        self.hostname = server.hostname
+
+
+    def open(self, path, flags, attr):
+        return _Upload(self, path, flags)
+
+
+    def stat(self, path):
+        data = self.fleet.uploads.get((self.hostname, path))
+
+        if data is None:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(data)
+        attr.st_mode = stat.S_IFREG | 0600
+
+        return attr
+
+
+    lstat = stat
+
+
+    def remove(self, path):
+        self.fleet.uploads.pop((self.hostname, path), None)
+        return paramiko.SFTP_OK
+
+
+class _Upload(paramiko.SFTPHandle):
+    """
+    A file being written over SFTP, saved to the fleet once closed
+    """
+
+    def __init__(self, sftp, path, flags):
+        super(_Upload, self).__init__(flags)
+        self.sftp = sftp
+        self.path = path
+        self.writefile = StringIO()
+
+
+    def close(self):
+        self.sftp.fleet.uploads[(self.sftp.hostname, self.path)] = \
+            self.writefile.getvalue()
+        super(_Upload, self).close()
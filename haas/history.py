@@ -0,0 +1,97 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+
+
+__all__ = ['record', 'rotate', 'rollup', 'prune_rollups']
+
+def partition_name(ts):
+    """
+    Get the name of the raw lag sample partition holding a timestamp
+
+    :param ts: Timezone-aware datetime.
+
+    :return: Name of the daily ele_lag_sample partition table.
+    """
+    return 'ele_lag_sample_' + ts.astimezone(timezone.utc).strftime('%Y%m%d')
+
+
+def record(samples, ts=None):
+    """
+    Store a batch of raw lag samples, all taken at the same time
+
+    Samples go straight into the partition for the current day in a single
+    multi-row INSERT. If that partition doesn't exist yet, we create it
+    and try again.
+
+    :param samples: List of (instance ID, xlog position, lag in bytes).
+    :param ts: Time the samples were taken. Defaults to now.
+    """
+
+    if not samples:
+        return
+
+    ts = ts or timezone.now()
+
+    query = 'INSERT INTO %s (sample_ts, instance_id, xlog_pos, lag_bytes) ' \
+        'VALUES %s' % (
+            partition_name(ts), ', '.join(['(%s, %s, %s, %s)'] * len(samples))
+        )
+    params = [p for sample in samples for p in (ts,) + tuple(sample)]
+
+    cursor = connection.cursor()
+
+    try:
+        with transaction.atomic():
+            cursor.execute(query, params)
+    except DatabaseError:
+        rotate()
+        cursor.execute(query, params)
+
+
+def rotate():
+    """
+    Create upcoming sample partitions, and drop expired ones
+
+    Partitions older than LAG_RAW_RETENTION_DAYS are removed entirely.
+    """
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT sp_lag_rotate(1, %s)', [
+        settings.LAG_RAW_RETENTION_DAYS
+    ])
+
+
+def rollup(since):
+    """
+    Recalculate minute, hour, and day rollups from a point in time
+
+    Every rollup period overlapping `since` is rebuilt in full, so it's
+    safe to overlap previous calls.
+
+    :param since: Timezone-aware datetime to start from.
+    """
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT sp_lag_rollup(%s)', [since])
+
+
+def prune_rollups():
+    """
+    Delete minute and hour rollups older than their retention period
+
+    Daily rollups are tiny, so they're kept forever.
+    """
+
+    now = timezone.now()
+    cursor = connection.cursor()
+
+    for resolution, days in (('1m', settings.LAG_MINUTE_RETENTION_DAYS),
+                             ('1h', settings.LAG_HOUR_RETENTION_DAYS)):
+        cursor.execute(
+            'DELETE FROM ele_lag_rollup WHERE resolution = %s' \
+            '   AND bucket_ts < %s',
+            [resolution, now - timedelta(days=days)]
+        )
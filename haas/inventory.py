@@ -0,0 +1,508 @@
+import csv
+import json
+
+from cStringIO import StringIO
+
+from django.db import transaction
+
+from haas.executor import FanOut
+from haas.models import Environment, Herd, Instance, Server
+from haas.utility import execute_remote_cmd
+
+
+__all__ = ['COLUMNS', 'FIELDS', 'export_records', 'export_json',
+    'export_csv', 'read_records', 'check_hosts', 'import_records',
+]
+
+# Each kind of record, and the fields it carries in export order. The
+# first fields of each kind identify it. Relations are written as names
+# rather than IDs, so an inventory can be loaded into any ElepHaaS
+# database: an environment by name, a herd by name and environment, a
+# server by host name, and an instance by herd and server. The master of
+# an instance is the host name of the server its master runs on. Herds
+# and servers need not belong to an environment; theirs is left empty.
+
+FIELDS = [
+    ('environment', ['env_name', 'env_descr']),
+    ('herd', ['herd_name', 'environment', 'base_name', 'herd_descr',
+        'db_port', 'pgdata', 'vhost', 'sync_method', 'sync_compress',
+        'max_fanout', 'use_slots']),
+    ('server', ['hostname', 'environment']),
+    ('instance', ['herd', 'environment', 'server', 'local_pgdata', 'version',
+        'master']),
+]
+
+COLUMNS = ['kind']
+
+for kind, fields in FIELDS:
+    COLUMNS += [f for f in fields if f not in COLUMNS]
+
+KEYS = {
+    'environment': ['env_name'],
+    'herd': ['herd_name'],
+    'server': ['hostname'],
+    'instance': ['herd', 'server'],
+}
+
+MODELS = {
+    'environment': Environment,
+    'herd': Herd,
+    'server': Server,
+    'instance': Instance,
+}
+
+RELATIONS = ('environment', 'herd', 'server', 'master')
+
+
+def export_records(environments=None):
+    """
+    Describe the whole inventory as a series of records
+
+    Records come in dependency order, so they can be imported in the same
+    order they were exported. Rows are read with iterators, so even a very
+    large inventory is never held in memory all at once.
+
+    :param environments: Only export these environment names, if given.
+
+    :return: Generator of dicts, each with a kind and that kind's fields.
+    """
+
+    envs = Environment.objects.all()
+    herds = Herd.objects.all()
+    servers = Server.objects.select_related('environment')
+    instances = Instance.objects.select_related('herd__environment',
+        'server', 'master__server'
+    ).order_by('pk')
+
+    if environments:
+        envs = envs.filter(env_name__in=environments)
+        herds = herds.filter(environment__env_name__in=environments)
+        servers = servers.filter(environment__env_name__in=environments)
+        instances = instances.filter(
+            herd__environment__env_name__in=environments
+        )
+
+    for env in envs.iterator():
+        yield dict(kind='environment', env_name=env.env_name,
+            env_descr=env.env_descr
+        )
+
+    for herd in herds.iterator():
+        record = dict(kind='herd',
+            environment=herd.environment.env_name if herd.environment else ''
+        )
+        for field in dict(FIELDS)['herd']:
+            record.setdefault(field, getattr(herd, field))
+        yield record
+
+    for server in servers.iterator():
+        yield dict(kind='server', hostname=server.hostname,
+            environment=server.environment.env_name if server.environment \
+                else ''
+        )
+
+    for inst in instances.iterator():
+        yield dict(kind='instance', herd=inst.herd.herd_name,
+            environment=inst.herd.environment.env_name \
+                if inst.herd.environment else '',
+            server=inst.server.hostname, local_pgdata=inst.local_pgdata,
+            version=inst.version or '',
+            master=inst.master.server.hostname if inst.master else '',
+        )
+
+
+def export_json(records):
+    """
+    Write records as a JSON list, one record per line
+
+    :param records: Iterable of record dicts.
+
+    :return: Generator of JSON text chunks.
+    """
+
+    yield '['
+    separator = '\n'
+
+    for record in records:
+        yield separator + json.dumps(record, sort_keys=True)
+        separator = ',\n'
+
+    yield '\n]\n'
+
+
+def export_csv(records):
+    """
+    Write records as CSV, one record per row
+
+    Every row has a column for every field of every kind. Fields that
+    don't apply to a kind are left empty.
+
+    :param records: Iterable of record dicts.
+
+    :return: Generator of CSV lines.
+    """
+
+    out = StringIO()
+    writer = csv.DictWriter(out, COLUMNS)
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(dict(
+            (k, v.encode('utf-8') if isinstance(v, unicode) else v)
+            for k, v in record.items()
+        ))
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+    yield out.getvalue()
+
+
+def read_records(stream, format):
+    """
+    Read records from an exported inventory
+
+    Empty CSV values are left out, so they leave existing values alone
+    when imported.
+
+    :param stream: File object to read from.
+    :param format: Either 'json' or 'csv'.
+
+    :return: List of record dicts.
+    """
+
+    if format == 'json':
+        return json.load(stream)
+
+    records = []
+
+    for row in csv.DictReader(stream):
+        records.append(dict(
+            (k, v.decode('utf-8')) for k, v in row.items() if k and v != ''
+        ))
+
+    return records
+
+
+def check_hosts(hostnames, workers=None):
+    """
+    Make sure we can reach several hosts over SSH, all at the same time
+
+    This is the same check the server form does for a single host.
+
+    :param hostnames: Host names to check.
+    :param workers: Hosts checked at once. Defaults to the FANOUT_WORKERS
+        setting.
+
+    :return: List of error messages for hosts that couldn't be reached.
+    """
+
+    results = FanOut(workers).map(
+        lambda host: execute_remote_cmd(host, 'echo Hello World'), hostnames
+    )
+
+    return ["Can't connect to %s!" % host for host, r, e in results if e]
+
+
+def import_records(records, check=True, workers=None, dry_run=False):
+    """
+    Create or update everything described by a list of records
+
+    Records are matched to existing rows by the fields identifying them.
+    Existing rows only have changed fields updated, and everything new is
+    created with one bulk insert per kind. Instances are created in order
+    of their depth in the replication tree, so masters always exist first.
+    All of it happens in a single transaction, so an import either fully
+    succeeds or changes nothing.
+
+    Before anything is written, every server in the records is checked for
+    SSH access at the same time.
+
+    :param records: List of record dicts, as produced by export_records.
+    :param check: Check SSH access to every server first.
+    :param workers: Hosts checked at once. Defaults to the FANOUT_WORKERS
+        setting.
+    :param dry_run: Roll everything back once done.
+
+    :raises: Exception listing every problem found, if any.
+    :return: Dict of kind to a tuple of rows created and rows updated.
+    """
+
+    kinds = dict(FIELDS)
+    errors = []
+    batches = dict((kind, []) for kind in kinds)
+
+    for line, record in enumerate(records, 1):
+        kind = record.get('kind')
+
+        if kind not in kinds:
+            errors.append('Record %d: unknown kind %r.' % (line, kind))
+            continue
+
+        missing = [k for k in KEYS[kind] if not record.get(k)]
+
+        if missing:
+            errors.append('Record %d: %s needs %s.' % (
+                line, kind, ', '.join(missing)
+            ))
+            continue
+
+        values = {}
+
+        for field in kinds[kind]:
+            if field not in record:
+                continue
+
+            value = record[field]
+
+            if field not in RELATIONS:
+                try:
+                    value = MODELS[kind]._meta.get_field(field).to_python(
+                        value
+                    )
+                except Exception, e:
+                    errors.append('Record %d: %s %s' % (line, field, e))
+                    continue
+
+            values[field] = value
+
+        batches[kind].append((line, values))
+
+    if check and not errors:
+        errors += check_hosts(
+            [values['hostname'] for line, values in batches['server']],
+            workers
+        )
+
+    if errors:
+        raise Exception('\n'.join(errors))
+
+    with transaction.atomic():
+        summary = _Importer(batches).run()
+
+        if dry_run:
+            transaction.set_rollback(True)
+
+    return summary
+
+
+class _Importer(object):
+    """
+    Apply parsed records to the database, one kind at a time
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.summary = {}
+
+
+    def run(self):
+        self.environments()
+        self.herds()
+        self.servers()
+        self.instances()
+
+        return self.summary
+
+
+    def upsert(self, kind, existing, rows):
+        """
+        Update changed rows, and bulk create the rest
+
+        :param kind: Kind of record.
+        :param existing: Dict of key to existing model object.
+        :param rows: List of (key, field values) pairs.
+        """
+
+        model = MODELS[kind]
+        new = []
+        updated = 0
+
+        for key, values in rows:
+            obj = existing.get(key)
+
+            if not obj:
+                new.append(model(**values))
+                continue
+
+            changes = dict(
+                (f, v) for f, v in values.items() if getattr(obj, f) != v
+            )
+
+            if changes:
+                model.objects.filter(pk=obj.pk).update(**changes)
+                updated += 1
+
+        model.objects.bulk_create(new)
+        self.summary[kind] = (len(new), updated)
+
+
+    def lookup(self, mapping, key, what, line):
+        try:
+            return mapping[key]
+        except KeyError:
+            if isinstance(key, tuple):
+                key = ' / '.join(filter(None, key))
+            raise Exception('Record %d: no such %s %s.' % (line, what, key))
+
+
+    def environments(self):
+        existing = dict((e.env_name, e) for e in Environment.objects.all())
+
+        self.upsert('environment', existing, [
+            (values['env_name'], values)
+            for line, values in self.batches['environment']
+        ])
+
+        self.env_ids = dict(
+            Environment.objects.values_list('env_name', 'pk')
+        )
+
+
+    def env_id(self, env, line):
+        """
+        Find the ID of an environment by name, or None for no environment
+        """
+
+        if not env:
+            return None
+
+        return self.lookup(self.env_ids, env, 'environment', line)
+
+
+    def herds(self):
+        existing = dict(
+            ((h.herd_name, h.environment.env_name if h.environment else None),
+                h)
+            for h in Herd.objects.select_related('environment')
+        )
+
+        rows = []
+
+        for line, values in self.batches['herd']:
+            env = values.pop('environment', None) or None
+            values['environment_id'] = self.env_id(env, line)
+            rows.append(((values['herd_name'], env), values))
+
+        self.upsert('herd', existing, rows)
+
+        self.herd_ids = dict(
+            ((name, env), pk) for pk, name, env in Herd.objects.values_list(
+                'pk', 'herd_name', 'environment__env_name'
+            )
+        )
+
+
+    def servers(self):
+        existing = dict((s.hostname, s) for s in Server.objects.all())
+
+        rows = []
+
+        for line, values in self.batches['server']:
+            env = values.pop('environment', None)
+            if env:
+                values['environment_id'] = self.env_id(env, line)
+            rows.append((values['hostname'], values))
+
+        self.upsert('server', existing, rows)
+
+        self.server_ids = dict(Server.objects.values_list('hostname', 'pk'))
+
+
+    def instances(self):
+        """
+        Create and update instances, masters before their replicas
+
+        A new replica can only be created once its master has an ID. So we
+        create instances in rounds: those whose masters already exist go
+        first, and then those following them, until none are left.
+        """
+
+        existing = self.instance_map()
+        hosts = dict((pk, host) for host, pk in self.server_ids.items())
+        pending = []
+        updated = 0
+
+        for line, values in self.batches['instance']:
+            herd_id = self.lookup(self.herd_ids,
+                (values.pop('herd'), values.pop('environment', None) or None),
+                'herd', line
+            )
+            server_id = self.lookup(self.server_ids, values.pop('server'),
+                'server', line
+            )
+            values.update(herd_id=herd_id, server_id=server_id)
+            pending.append((line, values))
+
+        created = 0
+
+        while pending:
+            ready = []
+            waiting = []
+
+            for line, values in pending:
+                master = values.get('master')
+
+                if master and (values['herd_id'], master) not in existing:
+                    waiting.append((line, values))
+                else:
+                    ready.append((line, values))
+
+            if not ready:
+                raise Exception('\n'.join(
+                    'Record %d: no master on %s in the same herd.' % (
+                        line, values['master']
+                    ) for line, values in waiting
+                ))
+
+            new = []
+
+            for line, values in ready:
+                values = dict(values)
+
+                # A record without a master leaves it alone, but an empty
+                # master makes the instance a primary.
+
+                if 'master' in values:
+                    master = values.pop('master')
+                    values['master_id'] = None
+
+                    if master:
+                        values['master_id'] = existing[
+                            (values['herd_id'], master)
+                        ].pk
+
+                obj = existing.get(
+                    (values['herd_id'], hosts[values['server_id']])
+                )
+
+                if not obj:
+                    new.append(Instance(**values))
+                    continue
+
+                changes = dict((f, v) for f, v in values.items()
+                    if getattr(obj, f) != v
+                )
+
+                if changes:
+                    Instance.objects.filter(pk=obj.pk).update(**changes)
+                    updated += 1
+
+            Instance.objects.bulk_create(new)
+            created += len(new)
+
+            existing = self.instance_map()
+            pending = waiting
+
+        self.summary['instance'] = (created, updated)
+
+
+    def instance_map(self):
+        """
+        Map every instance by herd ID and host name
+        """
+
+        return dict(
+            ((i.herd_id, i.server.hostname), i)
+            for i in Instance.objects.select_related('server')
+        )
@@ -0,0 +1,542 @@
+import json
+import os
+import socket
+import uuid
+
+from collections import Counter
+from django.conf import settings
+from django.contrib import messages
+from django.db import connection, transaction
+from django.utils import timezone
+
+from haas import metrics
+from haas.models import Instance, Job, RebuildCheckpoint
+from haas.failover import failover_pair
+from haas.utility import PGUtility
+
+
+__all__ = ['HERD_ACTIONS', 'SkipAction', 'TASKS', 'TRANSFER_ACTIONS',
+    'enqueue', 'claim', 'exclusive_backup', 'pick_sources', 'run_job',
+    'run_task', 'reap_orphans', 'transfer_limits', 'worker_name',
+]
+
+TASKS = {}
+
+# These actions copy a whole data directory from the upstream master or a
+# peer, and are throttled by the REBUILD_PER_SOURCE and REBUILD_PER_TARGET
+# settings.
+
+TRANSFER_ACTIONS = ('rebuild', 'demote')
+
+# These actions change which instances of a herd are primaries, and check
+# the rest of the herd before they do. Only one of them may run in a herd
+# at a time, or two demotions could each leave the other as the last
+# master, and then demote it anyway.
+
+HERD_ACTIONS = ('promote', 'demote')
+
+# Any arbitrary number will do, so long as nothing else using the ElepHaaS
+# database takes the same advisory lock.
+
+CLAIM_LOCK = 0x454c4501
+
+class SkipAction(Exception):
+    """
+    Raised by a task that decided there was nothing to do
+
+    This isn't an error, so callers report it as a warning instead.
+    """
+    pass
+
+
+def task(name):
+    """
+    Register a function as a named task
+
+    Tasks accept an instance and a PGUtility bound to it, and return a
+    message describing what they did. They may raise SkipAction if the
+    instance is already in the requested state, or any other Exception
+    if the action failed.
+
+    :param name: Action name used to submit and look up this task.
+    """
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+@task('start')
+def start_task(inst, util):
+    if inst.is_online:
+        raise SkipAction("%s is already running." % inst)
+
+    util.start()
+    return "%s started!" % inst
+
+
+@task('stop')
+def stop_task(inst, util):
+    if not inst.is_online:
+        raise SkipAction("%s is already stopped." % inst)
+
+    util.stop()
+    return "%s stopped!" % inst
+
+
+@task('restart')
+def restart_task(inst, util):
+    util.stop()
+    util.start()
+    return "%s restarted!" % inst
+
+
+@task('reload')
+def reload_task(inst, util):
+    util.reload()
+    return "%s config files reloaded!" % inst
+
+
+@task('promote')
+def promote_task(inst, util):
+    util.promote()
+    return "%s promoted to read/write!" % inst
+
+
+@task('demote')
+def demote_task(inst, util):
+    util.demote()
+    return "%s demoted to %s replica!" % (inst.server.hostname, inst.herd)
+
+
+@task('rebuild')
+def rebuild_task(inst, util):
+
+    # Only queued rebuilds may copy from a peer, since claim() is what
+    # keeps track of which instances are busy copying.
+
+    source = None
+
+    if util.job and util.job.source_id:
+        source = Instance.objects.select_related('server').get(
+            pk=util.job.source_id
+        )
+
+    util.master_sync(source)
+
+    if source and source.pk != inst.master_id:
+        return "%s rebuilt from %s!" % (inst, source.server.hostname)
+
+    return "%s rebuilt!" % inst
+
+
+@task('failover')
+def failover_task(inst, util):
+    return failover_pair(inst, util.job)
+
+
+def worker_name():
+    """
+    Identify the current worker process as host:pid
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def transfer_limits():
+    """
+    Get fan-out limits for actions that copy data from a master
+
+    Each transfer reads from the server hosting the upstream master, and
+    writes to the server hosting the instance. Both ends have their own
+    limit on concurrent transfers. Primaries being demoted don't know their
+    master until the task chooses one from their herd, so those count
+    against a limit for their herd instead. Transfers that need the
+    exclusive backup of their master also run one at a time per master;
+    see exclusive_backup.
+
+    :return: List of (key function, maximum) tuples for FanOut.
+    """
+
+    def source(inst):
+        if inst.master_id:
+            return inst.master.server_id
+        return ('herd', inst.herd_id)
+
+    def backup(inst):
+        return exclusive_backup(inst) or ('copy', inst.pk)
+
+    return [
+        (source, settings.REBUILD_PER_SOURCE),
+        (lambda inst: inst.server_id, settings.REBUILD_PER_TARGET),
+        (backup, 1),
+    ]
+
+
+def exclusive_backup(inst, source=None):
+    """
+    Identify the exclusive backup a transfer would put a master in
+
+    Copies with rsync put the upstream master in backup mode, and so do
+    rewinds, since they fall back to rsync. Postgres allows only one such
+    backup at a time, and the copy stopping it would end it for any other
+    copy still using it. Base backups need no exclusive backup, and neither
+    do copies from a peer or a cascading master, which always use
+    pg_basebackup. Primaries being demoted don't know their master until
+    the task chooses one, so they claim the backup of their whole herd.
+
+    :param inst: Instance the data will be copied to.
+    :param source: Instance the data will be copied from, if not the
+        upstream master.
+
+    :return: ('backup', master ID) or ('herd', herd ID), or None if the
+        transfer needs no exclusive backup.
+    """
+
+    if inst.herd.sync_method == 'basebackup':
+        return None
+
+    if not inst.master_id:
+        return ('herd', inst.herd_id)
+
+    if source and source.pk != inst.master_id or inst.master.master_id:
+        return None
+
+    return ('backup', inst.master_id)
+
+
+def enqueue(action, instances, user=None, priority=0):
+    """
+    Queue an action for background execution on several instances
+
+    :param action: Name of a registered task.
+    :param instances: Iterable of Instance objects to act upon.
+    :param user: Django user submitting the jobs, if any.
+    :param priority: Jobs with higher priority are claimed first.
+
+    :return: Batch identifier shared by all of the new jobs.
+    """
+
+    if action not in TASKS:
+        raise KeyError('No such task: %s' % action)
+
+    batch = uuid.uuid4().hex
+    owner = user.get_username() if user else ''
+
+    Job.objects.bulk_create([
+        Job(batch=batch, action=action, instance=inst, owner=owner,
+            priority=priority)
+        for inst in instances
+    ])
+
+    return batch
+
+
+def claim(actions=None):
+    """
+    Claim the most urgent queued job that may run right now
+
+    Jobs are considered in priority order, oldest first. Jobs that copy
+    data are skipped while the servers at either end of the transfer are
+    already busy with as many transfers as they're allowed, so a mass
+    rebuild proceeds as fast as the masters can stand and no faster.
+    Rebuilds may also copy from a peer replica instead of the master; see
+    pick_sources. The chosen source is recorded on the job. Copies needing
+    the exclusive backup of a master wait while another copy holds it.
+
+    Promotions and demotions wait while another one is running in the
+    same herd.
+
+    Several workers may poll at once, so a job only belongs to us if our
+    conditional update is the one that moved it out of the queued state.
+    The queue is scanned while holding an advisory lock, so two workers
+    can't both take the last free slot on a server, or start in the same
+    herd.
+
+    :param actions: Only claim jobs for these actions, if given.
+
+    :return: The claimed Job, or None if nothing is waiting.
+    """
+
+    waiting = Job.objects.filter(status='queued').select_related(
+        'instance__master__server', 'instance__server', 'instance__herd'
+    ).order_by('-priority', 'job_id')
+
+    if actions:
+        waiting = waiting.filter(action__in=actions)
+
+    # The whole scan happens under one lock, so the running transfers we
+    # count can't change until we've claimed something or given up.
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute(
+                'SELECT pg_advisory_xact_lock(%s)', [CLAIM_LOCK]
+            )
+
+        busy = None
+
+        for job in waiting[:100]:
+            if not job.instance:
+                if _claim(job):
+                    return job
+                continue
+
+            if job.action in HERD_ACTIONS and Job.objects.filter(
+                status='running', action__in=HERD_ACTIONS,
+                instance__herd_id=job.instance.herd_id
+            ).exists():
+                continue
+
+            if job.action not in TRANSFER_ACTIONS:
+                if _claim(job):
+                    return job
+                continue
+
+            if busy is None:
+                busy = _busy_transfers()
+
+            counts, rebuilding, sourcing, backups = busy
+            inst = job.instance
+
+            # An instance can't be replaced while another rebuild is still
+            # copying from it.
+
+            target = ('target', inst.server_id)
+            if counts[target] >= settings.REBUILD_PER_TARGET or \
+                inst.pk in sourcing:
+                continue
+
+            # Instances being demoted have no master until the task finds
+            # one, so there's no way to know their source yet.
+
+            source = None
+
+            if inst.master_id:
+                if job.action == 'rebuild':
+                    sources = pick_sources(inst, busy)
+                else:
+                    sources = [inst.master]
+
+                for candidate in sources:
+                    key = ('source', candidate.server_id)
+                    if counts[key] < settings.REBUILD_PER_SOURCE and \
+                        not _backup_taken(inst, candidate, backups):
+                        source = candidate
+                        break
+
+                if not source:
+                    continue
+
+            elif _backup_taken(inst, None, backups):
+                continue
+
+            if _claim(job, source):
+                return job
+
+            busy = None
+
+    return None
+
+
+def pick_sources(inst, busy=None):
+    """
+    Rank the instances a replica could be rebuilt from
+
+    The upstream master is always a candidate. If REBUILD_FROM_PEERS is
+    enabled, so is any other online replica of the same master, which is
+    no more than REBUILD_PEER_MAX_LAG bytes behind it, and isn't being
+    rebuilt itself. Servers with fewer running transfers come first, and
+    peers come before the master when equally busy, which keeps bulk reads
+    off the primary whenever possible. If an earlier rebuild of the replica
+    was interrupted, its source comes first of all, since only a rebuild
+    from the same source can resume.
+
+    :param inst: Replica Instance to be rebuilt.
+    :param busy: Result of _busy_transfers, if already known.
+
+    :return: List of Instance objects, best first.
+    """
+
+    master = inst.master
+    counts, rebuilding, sourcing, backups = busy or _busy_transfers()
+
+    candidates = [master]
+
+    if settings.REBUILD_FROM_PEERS and master.xlog_pos is not None:
+        candidates += list(Instance.objects.filter(
+            master_id = master.pk,
+            is_online = True,
+            xlog_pos__gte = master.xlog_pos - settings.REBUILD_PEER_MAX_LAG
+        ).exclude(pk__in = [inst.pk] + list(rebuilding)).select_related(
+            'server'
+        ))
+
+    resume = RebuildCheckpoint.objects.filter(instance_id = inst.pk
+        ).values_list('source_id', flat=True).first()
+
+    return sorted(candidates, key=lambda c: (
+        c.pk != resume, counts[('source', c.server_id)], c.pk == master.pk,
+        (master.xlog_pos or 0) - (c.xlog_pos or 0)
+    ))
+
+
+def _claim(job, source=None):
+    claimed = Job.objects.filter(pk=job.pk, status='queued').update(
+        status='running', worker=worker_name(), started_dt=timezone.now(),
+        source=source
+    )
+
+    if claimed:
+        job.status = 'running'
+        job.worker = worker_name()
+        job.source = source
+
+    return claimed
+
+
+def _busy_transfers():
+    """
+    Count the running transfers reading from and writing to each server
+
+    :return: Tuple of a Counter keyed by ('source', server ID) and
+        ('target', server ID), the set of instance IDs being copied to,
+        the set of instance IDs being copied from, and the set of
+        exclusive backups in use. Besides the keys from exclusive_backup,
+        the backups hold ('in herd', herd ID) for every herd with any of
+        them.
+    """
+
+    counts = Counter()
+    rebuilding = set()
+    sourcing = set()
+    backups = set()
+
+    for job in Job.objects.filter(status='running',
+        action__in=TRANSFER_ACTIONS, instance__isnull=False
+    ).select_related('instance__master', 'instance__herd', 'source'):
+        rebuilding.add(job.instance_id)
+        counts[('target', job.instance.server_id)] += 1
+
+        source = job.source or job.instance.master
+        if source:
+            counts[('source', source.server_id)] += 1
+            sourcing.add(source.pk)
+
+        backup = exclusive_backup(job.instance, job.source)
+        if backup:
+            backups.update([backup, ('in herd', job.instance.herd_id)])
+
+    return (counts, rebuilding, sourcing, backups)
+
+
+def _backup_taken(inst, source, backups):
+    """
+    Check whether a transfer needs an exclusive backup already in use
+
+    A demotion claims the backup of its whole herd, so it must wait for any
+    backup in the herd, and every copy in the herd must wait for it.
+    """
+
+    backup = exclusive_backup(inst, source)
+
+    if not backup:
+        return False
+
+    if backup[0] == 'herd':
+        return ('in herd', inst.herd_id) in backups
+
+    return backup in backups or ('herd', inst.herd_id) in backups
+
+
+def run_task(action, inst, job=None):
+    """
+    Execute a registered task against a single instance
+
+    :param action: Name of a registered task.
+    :param inst: Instance object to act upon.
+    :param job: Job tracking this execution, if any.
+
+    :return: Tuple of messages level and the resulting message.
+    """
+
+    try:
+        util = PGUtility(inst, job)
+        return (messages.SUCCESS, TASKS[action](inst, util))
+    except SkipAction, e:
+        return (messages.WARNING, str(e))
+    except Exception, e:
+        return (messages.ERROR, "%s : %s" % (e, inst))
+
+
+def run_job(job):
+    """
+    Execute a claimed job and record the outcome
+
+    The instance is always reloaded first, since its state may have
+    changed while the job was waiting in the queue. The SQL queries, SSH
+    commands and file transfers the job needed are added to its detail
+    as its cost.
+
+    :param job: A Job previously returned by claim().
+    """
+
+    tally = metrics.Tally()
+
+    try:
+        with metrics.tracking(tally):
+            inst = Instance.objects.get(pk=job.instance_id)
+            level, message = run_task(job.action, inst, job)
+
+        try:
+            detail = json.loads(job.detail)
+        except ValueError:
+            detail = {}
+
+        detail['cost'] = tally.summary()
+
+        job.status = 'failed' if level == messages.ERROR else 'done'
+        job.progress = 100
+        job.message = message
+        job.detail = json.dumps(detail)
+        job.finished_dt = timezone.now()
+        job.save(update_fields=['status', 'progress', 'message', 'detail',
+            'finished_dt'
+        ])
+
+    finally:
+        connection.close()
+
+
+def reap_orphans():
+    """
+    Fail any running jobs whose worker on this host no longer exists
+
+    A worker that dies mid-job leaves its jobs marked as running forever.
+    Since workers are named by host and pid, we can tell which of them
+    belonged to processes on this host that have since exited.
+
+    :return: Number of jobs marked as failed.
+    """
+
+    host = socket.gethostname()
+    reaped = 0
+
+    running = Job.objects.filter(status='running',
+        worker__startswith=host + ':'
+    )
+
+    for job in running:
+        pid = int(job.worker.rsplit(':', 1)[1])
+
+        try:
+            os.kill(pid, 0)
+            continue
+        except OSError:
+            pass
+
+        reaped += Job.objects.filter(pk=job.pk, status='running').update(
+            status='failed', finished_dt=timezone.now(),
+            message='Worker %s exited before the job completed.' % job.worker
+        )
+
+    return reaped
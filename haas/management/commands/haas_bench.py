@@ -0,0 +1,151 @@
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, \
+    teardown_test_environment
+
+from haas import benchmark
+from haas.fakefleet import COMMANDS, FakeFleet
+from haas.nameserver import dns_updater
+from haas.sshpool import ssh_pool
+
+
+class Command(BaseCommand):
+    help = 'Measure bulk actions and admin pages against a fake fleet ' \
+        'of servers, in a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--herds', type=int, default=500,
+            help='Herds in the fake inventory. Default: 500'
+        )
+        parser.add_argument('--replicas', type=int, default=2,
+            help='Replicas of every herd primary. Default: 2'
+        )
+        parser.add_argument('--servers', type=int, default=250,
+            help='Servers the instances are spread over. Default: 250'
+        )
+        parser.add_argument('--latency', type=float, default=0.005,
+            help='Seconds every remote command takes. Default: 0.005'
+        )
+        parser.add_argument('--copy-time', type=float, default=0.2,
+            help='Extra seconds every rsync takes. Default: 0.2'
+        )
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+            help='Fraction of remote commands that fail. Default: 0'
+        )
+        parser.add_argument('--rebuilds', type=int, default=50,
+            help='Replicas to rebuild. Default: 50'
+        )
+        parser.add_argument('--failovers', type=int, default=50,
+            help='Herds to fail over. Default: 50'
+        )
+        parser.add_argument('--pages', type=int, default=10,
+            help='Instance list pages to render. Default: 10'
+        )
+        parser.add_argument('--scenario', action='append',
+            choices=benchmark.SCENARIOS,
+            help='Only run this scenario. May be given more than once.'
+        )
+        parser.add_argument('--seed', type=int,
+            help='Random seed, for repeatable failures.'
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Seed a test database and a fake fleet, then time every scenario
+
+        Nothing touches the real inventory or any real server. The test
+        database is created the same way the test runner does, and
+        destroyed afterwards. Every SSH connection goes to the fake fleet,
+        and DNS changes are only recorded by it.
+        """
+
+        fleet = FakeFleet(latency=options['latency'],
+            copy_time=options['copy_time'],
+            failure_rate=options['failure_rate'], seed=options['seed']
+        )
+
+        old_name = connection.creation.create_test_db(verbosity=0,
+            autoclobber=True, serialize=False
+        )
+        setup_test_environment()
+
+        fleet.start()
+        ssh_pool.close_all()
+        ssh_pool.connect_options = fleet.connect_options
+        dns_updater.apply = fleet.apply_dns
+
+        try:
+            with override_settings(COMMANDS=COMMANDS):
+                self.run_scenarios(fleet, options)
+        finally:
+            del dns_updater.apply
+            ssh_pool.close_all()
+            ssh_pool.connect_options = None
+            fleet.stop()
+
+            teardown_test_environment()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+    def run_scenarios(self, fleet, options):
+        count = benchmark.seed_fleet(fleet, options['herds'],
+            options['replicas'], options['servers']
+        )
+        self.stdout.write('Seeded %d instances in %d herds.\n' % (
+            count, options['herds']
+        ))
+
+        runners = {
+            'changelist': lambda: benchmark.bench_changelist(
+                options['pages']
+            ),
+            'connect': benchmark.bench_connect,
+            'stop': lambda: benchmark.bench_action('stop'),
+            'start': lambda: benchmark.bench_action('start'),
+            'rebuild': lambda: benchmark.bench_rebuild(options['rebuilds']),
+            'failover': lambda: benchmark.bench_failover(
+                options['failovers']
+            ),
+        }
+
+        row = '%-12s %7s %7s %9s %9s %9s %9s %9s %8s'
+
+        self.stdout.write(row % ('Scenario', 'Items', 'Errors', 'Seconds',
+            'Per sec', 'p50 ms', 'p95 ms', 'Max ms', 'Queries'
+        ))
+
+        failed = []
+
+        for name in benchmark.SCENARIOS:
+            if options['scenario'] and name not in options['scenario']:
+                continue
+
+            result = runners[name]()
+            failed += [(name, e) for item, e in result.failed]
+
+            self.stdout.write(row % (name, len(result.latencies),
+                result.errors, '%.2f' % result.elapsed,
+                '%.1f' % result.rate,
+                '%.1f' % (result.percentile(50) * 1000),
+                '%.1f' % (result.percentile(95) * 1000),
+                '%.1f' % (result.percentile(100) * 1000),
+                result.queries if result.queries is not None else '-'
+            ))
+
+        self.stdout.write('\nRemote commands: %s' % ', '.join(
+            '%s %d' % (name, n) for name, n in sorted(fleet.commands.items())
+        ))
+        self.stdout.write('Injected failures: %d' % fleet.failures)
+
+        # Errors are summarized by their first line, which leaves out the
+        # instance they happened to.
+
+        seen = Counter()
+
+        for name, e in failed:
+            seen[(name, str(e).strip().split('\n')[0])] += 1
+
+        for (name, message), n in sorted(seen.items()):
+            self.stderr.write('%s: %s (%d times)' % (name, message, n))
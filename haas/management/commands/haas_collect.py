@@ -0,0 +1,109 @@
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from haas import history
+from haas.collector import collect, prune_slots
+
+
+class Command(BaseCommand):
+    help = 'Refresh online status and WAL position of all managed instances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+            default=settings.COLLECTOR_INTERVAL,
+            help='Seconds between collection passes. Default: %s' % (
+                settings.COLLECTOR_INTERVAL
+            )
+        )
+        parser.add_argument('--threads', type=int,
+            default=settings.COLLECTOR_THREADS,
+            help='Concurrent WAL position queries. Default: %s' % (
+                settings.COLLECTOR_THREADS
+            )
+        )
+        parser.add_argument('--once', action='store_true',
+            help='Perform a single collection pass and exit.'
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Collect instance status on a fixed schedule
+
+        Each pass starts interval seconds after the previous one started,
+        unless it ran long, in which case the next starts right away. A
+        failed pass is reported, but never stops the collector.
+
+        The lag history is maintained here as well. Rollups are refreshed
+        about once a minute, and partitions are rotated once an hour. Stale
+        replication slots are dropped once an hour too. Each of these can
+        fail on its own, without keeping the others or the collection
+        itself from running. Hourly tasks that fail wait for the next hour.
+        """
+
+        last_rollup = timezone.now()
+        last_rotate = None
+        threads = options['threads']
+
+        while True:
+            started = time.time()
+
+            if not last_rotate or started - last_rotate > 3600:
+                last_rotate = started
+                self.attempt('Partition rotation', history.rotate)
+                self.attempt('Rollup pruning', history.prune_rollups)
+                self.attempt('Slot pruning', self.prune_slots, threads)
+
+            self.attempt('Collection', self.collect, threads)
+
+            if timezone.now() - last_rollup > timedelta(minutes=1):
+                rolled_up = timezone.now()
+                if self.attempt('Rollup', history.rollup, last_rollup):
+                    last_rollup = rolled_up
+
+            if options['once']:
+                break
+
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
+
+
+    def attempt(self, what, func, *args):
+        """
+        Run one task of a collection pass, reporting any failure
+
+        :param what: Name of the task, for the error message.
+        :param func: Function to call.
+        :param args: Arguments to pass to the function.
+
+        :return: True if the task succeeded.
+        """
+
+        try:
+            func(*args)
+            return True
+        except Exception, e:
+            self.stderr.write('%s failed: %s' % (what, e))
+            connection.close()
+            return False
+
+
+    def collect(self, threads):
+        started = time.time()
+        checked, changed = collect(threads)
+
+        self.stdout.write('Checked %d instances, %d changed in %.2fs.' % (
+            checked, changed, time.time() - started
+        ))
+
+
+    def prune_slots(self, threads):
+        for inst, slot, retained in prune_slots(threads):
+            self.stdout.write('Dropped slot %s on %s, retaining %d MB.' % (
+                slot, inst.server.hostname, retained / 1024 / 1024
+            ))
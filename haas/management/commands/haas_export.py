@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from haas.inventory import export_csv, export_json, export_records
+
+
+class Command(BaseCommand):
+    help = 'Write every environment, herd, server and instance as JSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['json', 'csv'],
+            default='json',
+            help='Output format. Default: json'
+        )
+        parser.add_argument('--environment', action='append', default=[],
+            help='Only export this environment. May be repeated.'
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Stream the inventory to standard output
+
+        Records are written as they're read from the database, so exporting
+        thousands of hosts takes about as long as reading them.
+        """
+
+        records = export_records(options['environment'])
+
+        if options['format'] == 'csv':
+            chunks = export_csv(records)
+        else:
+            chunks = export_json(records)
+
+        for chunk in chunks:
+            self.stdout.write(chunk, ending='')
+
+        self.stdout.flush()
@@ -0,0 +1,67 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from haas.inventory import import_records, read_records
+
+
+class Command(BaseCommand):
+    help = 'Create or update environments, herds, servers and instances ' \
+        'from a JSON or CSV inventory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file',
+            help='Inventory written by haas_export, or - for standard input.'
+        )
+        parser.add_argument('--format', choices=['json', 'csv'],
+            help='Input format. Default: guessed from the file name, or json.'
+        )
+        parser.add_argument('--no-check', action='store_false', dest='check',
+            help='Skip checking SSH access to every server.'
+        )
+        parser.add_argument('--threads', type=int,
+            default=settings.FANOUT_WORKERS,
+            help='Servers checked at once. Default: %s' % (
+                settings.FANOUT_WORKERS
+            )
+        )
+        parser.add_argument('--dry-run', action='store_true',
+            help='Check everything, but don\'t save any changes.'
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Import the inventory in a single transaction
+
+        Nothing is saved unless every record is valid, and every server
+        can be reached over SSH.
+        """
+
+        format = options['format']
+
+        if not format:
+            format = 'csv' if options['file'].endswith('.csv') else 'json'
+
+        if options['file'] == '-':
+            records = read_records(sys.stdin, format)
+        else:
+            with open(options['file'], 'rb') as stream:
+                records = read_records(stream, format)
+
+        try:
+            summary = import_records(records, options['check'],
+                options['threads'], options['dry_run']
+            )
+        except Exception, e:
+            raise CommandError(str(e))
+
+        for kind in ('environment', 'herd', 'server', 'instance'):
+            created, updated = summary.get(kind, (0, 0))
+            self.stdout.write('%s: %d created, %d updated.' % (
+                kind.capitalize(), created, updated
+            ))
+
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing was saved.')
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from haas.models import Instance
+from haas.sqlrunner import SQLRunner
+
+
+class Command(BaseCommand):
+    help = 'Run one SQL statement on many instances at once, as CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement',
+            help='SQL statement to execute on every matching instance.'
+        )
+        parser.add_argument('--herd', action='append', default=[],
+            help='Only instances in this herd. May be repeated.'
+        )
+        parser.add_argument('--environment', action='append', default=[],
+            help='Only instances in this environment. May be repeated.'
+        )
+        parser.add_argument('--role', choices=['primary', 'replica'],
+            help='Only primary or replica instances.'
+        )
+        parser.add_argument('--timeout', type=int,
+            default=settings.SQL_TIMEOUT,
+            help='Statement timeout in seconds. Default: %s' % (
+                settings.SQL_TIMEOUT
+            )
+        )
+        parser.add_argument('--threads', type=int,
+            default=settings.SQL_WORKERS,
+            help='Instances to query at once. Default: %s' % (
+                settings.SQL_WORKERS
+            )
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Execute the statement and write every result row to standard output
+
+        Rows are written as soon as any instance produces them, so even very
+        large results never need to fit in memory. Failures are reported on
+        standard error, and make the command exit with an error once every
+        instance has finished.
+        """
+
+        instances = Instance.objects.filter(is_online=True).select_related(
+            'herd__environment', 'server'
+        )
+
+        if options['herd']:
+            instances = instances.filter(herd__herd_name__in=options['herd'])
+        if options['environment']:
+            instances = instances.filter(
+                herd__environment__env_name__in=options['environment']
+            )
+        if options['role'] == 'primary':
+            instances = instances.filter(master__isnull=True)
+        elif options['role'] == 'replica':
+            instances = instances.filter(master__isnull=False)
+
+        failed = []
+
+        def on_error(inst, e):
+            failed.append(inst)
+            self.stderr.write('%s : %s' % (e, inst))
+
+        runner = SQLRunner(options['statement'], options['timeout'],
+            options['threads']
+        )
+
+        for line in runner.run_csv(instances, on_error):
+            self.stdout.write(line, ending='')
+            self.stdout.flush()
+
+        if failed:
+            raise CommandError('Statement failed on %d instances.' % len(failed))
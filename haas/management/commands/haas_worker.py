@@ -0,0 +1,93 @@
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from haas.jobs import claim, run_job, reap_orphans, worker_name
+
+
+class Command(BaseCommand):
+    help = 'Execute queued ElepHaaS background jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int,
+            help='Maximum jobs this worker runs at once. Default: 4, or ' +
+                'FAILOVER_WORKERS for a worker that only runs failovers.'
+        )
+        parser.add_argument('--actions',
+            help='Comma-separated actions to run, such as failover. ' +
+                'Default: all of them.'
+        )
+        parser.add_argument('--poll', type=float, default=2.0,
+            help='Seconds to wait between queue checks when idle. Default: 2'
+        )
+        parser.add_argument('--once', action='store_true',
+            help='Exit once the queue is empty and all jobs are finished.'
+        )
+
+
+    def handle(self, *args, **options):
+        """
+        Claim and execute jobs until told to stop
+
+        Each claimed job runs in its own thread, up to the requested
+        limit. Run several of these processes for more capacity; jobs are
+        claimed atomically, so workers never step on each other.
+
+        On SIGTERM or SIGINT, we stop claiming jobs and wait for the ones
+        already running to finish.
+
+        A worker may be limited to certain actions. A worker that only runs
+        failovers is never busy with a rebuild when a failover is needed.
+        """
+
+        actions = None
+        if options['actions']:
+            actions = [a.strip() for a in options['actions'].split(',')]
+
+        limit = options['threads'] or (
+            settings.FAILOVER_WORKERS if actions == ['failover'] else 4
+        )
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+
+        reaped = reap_orphans()
+        if reaped:
+            self.stderr.write('Failed %d orphaned jobs.' % reaped)
+
+        self.stdout.write('Worker %s started.' % worker_name())
+
+        threads = []
+
+        while self.running:
+            threads = [t for t in threads if t.is_alive()]
+
+            job = None
+            if len(threads) < limit:
+                job = claim(actions)
+
+            if job:
+                self.stdout.write('Running %s on %s.' % (job, job.instance))
+                thread = threading.Thread(target=run_job, args=(job,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+                continue
+
+            if options['once'] and not threads:
+                break
+
+            time.sleep(options['poll'])
+
+        for thread in threads:
+            thread.join()
+
+        self.stdout.write('Worker %s stopped.' % worker_name())
+
+
+    def shutdown(self, signum, frame):
+        self.running = False
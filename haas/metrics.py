@@ -0,0 +1,363 @@
+import os
+import threading
+import time
+
+from collections import Counter
+from django.db import connection
+
+
+__all__ = ['BUCKETS', 'Registry', 'Tally', 'command_name', 'current',
+    'record_command', 'record_connect', 'record_queries', 'record_transfer',
+    'registry', 'tracking',
+]
+
+# Upper bounds of latency histogram buckets, in seconds. Remote commands
+# range from a few milliseconds for a psql query to hours for a rebuild.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    300, 1800, 7200
+)
+
+HELP = {
+    'haas_ssh_commands_total': ('counter',
+        'Remote commands run over SSH.'),
+    'haas_ssh_command_seconds': ('histogram',
+        'Time taken by remote commands, excluding SSH handshakes.'),
+    'haas_ssh_connects_total': ('counter',
+        'SSH handshakes with managed servers.'),
+    'haas_ssh_connect_seconds': ('histogram',
+        'Time taken by SSH handshakes.'),
+    'haas_sftp_bytes_total': ('counter',
+        'Bytes sent to managed servers over SFTP.'),
+    'haas_sftp_seconds': ('histogram',
+        'Time taken by SFTP file transfers.'),
+    'haas_sql_queries_total': ('counter',
+        'Queries on the ElepHaaS database.'),
+    'haas_sql_query_seconds': ('histogram',
+        'Time taken by queries on the ElepHaaS database.'),
+    'haas_request_seconds': ('histogram',
+        'Time taken by web requests.'),
+}
+
+_local = threading.local()
+
+
+class Registry(object):
+    """
+    Counters and latency histograms for this process
+
+    Every value is kept by metric name and a set of labels, such as the
+    host or command involved. The whole registry can be rendered in the
+    Prometheus text format. Each process has its own registry, so every
+    web and worker process must be scraped separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._histograms = {}
+
+
+    def inc(self, name, labels, value=1):
+        """
+        Add to a counter
+
+        :param name: Metric name.
+        :param labels: Dict of label names and values.
+        :param value: Amount to add.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] += value
+
+
+    def observe(self, name, labels, seconds):
+        """
+        Add one observation to a latency histogram
+
+        :param name: Metric name.
+        :param labels: Dict of label names and values.
+        :param seconds: Observed latency.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+
+            buckets, total, count = self._histograms[key]
+
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+
+            self._histograms[key][1:] = [total + seconds, count + 1]
+
+
+    def render(self):
+        """
+        Describe every metric in the Prometheus text exposition format
+
+        :return: String of metric lines.
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(
+                (k, (list(b), s, c)) for k, (b, s, c) in
+                    self._histograms.items()
+            )
+
+        lines = []
+
+        for name in sorted(HELP):
+            kind, text = HELP[name]
+
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for key in sorted(counters):
+                if key[0] == name:
+                    lines.append('%s%s %s' % (name, _labels(key[1]),
+                        counters[key]
+                    ))
+
+            for key in sorted(histograms):
+                if key[0] != name:
+                    continue
+
+                buckets, total, count = histograms[key]
+
+                for bound, n in zip(BUCKETS, buckets):
+                    lines.append('%s_bucket%s %d' % (name,
+                        _labels(key[1] + (('le', repr(float(bound))),)), n
+                    ))
+
+                lines.append('%s_bucket%s %d' % (name,
+                    _labels(key[1] + (('le', '+Inf'),)), count
+                ))
+                lines.append('%s_sum%s %r' % (name, _labels(key[1]), total))
+                lines.append('%s_count%s %d' % (name, _labels(key[1]), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\'
+        ).replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs
+    )
+
+
+registry = Registry()
+
+
+class Tally(object):
+    """
+    Running totals of the work done on behalf of one request or job
+
+    Everything is counted by kind: 'sql' for database queries, 'ssh' for
+    remote commands, 'connect' for SSH handshakes, and 'sftp' for file
+    transfers. Remote commands are also counted by command name. Threads
+    started by FanOut add to the tally of the thread that started them.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.commands = Counter()
+        self.command_seconds = Counter()
+        self.bytes = 0
+        self.hosts = set()
+        self._lock = threading.Lock()
+
+
+    def add(self, kind, seconds, host=None, command=None, nbytes=0):
+        with self._lock:
+            self.counts[kind] += 1
+            self.seconds[kind] += seconds
+            self.bytes += nbytes
+
+            if host:
+                self.hosts.add(host)
+            if command:
+                self.commands[command] += 1
+                self.command_seconds[command] += seconds
+
+
+    def summary(self):
+        """
+        Summarize the tally so far
+
+        :return: Dict of totals, suitable for JSON. Times are in seconds.
+        """
+
+        with self._lock:
+            return dict(
+                seconds = round(time.time() - self.started, 3),
+                counts = dict(self.counts),
+                kind_seconds = dict(
+                    (k, round(v, 3)) for k, v in self.seconds.items()
+                ),
+                commands = dict(
+                    (c, [n, round(self.command_seconds[c], 3)])
+                    for c, n in self.commands.items()
+                ),
+                bytes = self.bytes,
+                hosts = len(self.hosts),
+            )
+
+
+def current():
+    """
+    Get the tally of the request or job this thread is working for
+
+    :return: A Tally, or None if nothing is being tracked.
+    """
+
+    return getattr(_local, 'tally', None)
+
+
+class tracking(object):
+    """
+    Attribute everything the current thread does to a tally
+
+    Used as a context manager. Database queries are only logged while
+    tracking, and are added to the tally when tracking ends. Nested
+    tracking in the same thread leaves the queries to the outermost.
+    Tracking a tally of None does nothing at all.
+    """
+
+    def __init__(self, tally):
+        self.tally = tally
+
+
+    def __enter__(self):
+        if not self.tally:
+            return None
+
+        self.previous = current()
+        _local.tally = self.tally
+
+        # Django only keeps so many queries. If the log is already full,
+        # there's no telling which queries are ours, so it's emptied.
+
+        if not self.previous:
+            self.debug = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+
+            if len(connection.queries_log) >= connection.queries_limit:
+                connection.queries_log.clear()
+
+            self.logged = len(connection.queries_log)
+
+        return self.tally
+
+
+    def __exit__(self, *exc):
+        if not self.tally:
+            return
+
+        if not self.previous:
+            record_queries(list(connection.queries_log)[self.logged:])
+            connection.force_debug_cursor = self.debug
+
+        _local.tally = self.previous
+
+
+def command_name(command):
+    """
+    Guess a short name for a remote command
+
+    This is the program being run, without its path. Commands which change
+    directory first are named after what they run there, and anything more
+    complicated is simply a shell script.
+
+    :param command: Full command line.
+
+    :return: Name of the command.
+    """
+
+    if command.startswith('cd ') and '&&' in command:
+        command = command.split('&&', 1)[1]
+
+    words = command.split(None, 1)
+
+    if not words or words[0] in ('if', 'for', 'exec'):
+        return 'sh'
+
+    return os.path.basename(words[0])
+
+
+def record_command(host, command, seconds, failed=False):
+    """
+    Record a remote command
+
+    :param host: Host the command ran on.
+    :param command: Command name, from COMMANDS or command_name.
+    :param seconds: Time taken, excluding any SSH handshake.
+    :param failed: Whether the command failed.
+    """
+
+    labels = dict(host=host, command=command)
+
+    registry.observe('haas_ssh_command_seconds', labels, seconds)
+    labels['status'] = 'error' if failed else 'ok'
+    registry.inc('haas_ssh_commands_total', labels)
+
+    if current():
+        current().add('ssh', seconds, host, command)
+
+
+def record_connect(host, seconds):
+    """
+    Record an SSH handshake
+
+    :param host: Host connected to.
+    :param seconds: Time taken to connect and authenticate.
+    """
+
+    registry.inc('haas_ssh_connects_total', dict(host=host))
+    registry.observe('haas_ssh_connect_seconds', dict(host=host), seconds)
+
+    if current():
+        current().add('connect', seconds, host)
+
+
+def record_transfer(host, nbytes, seconds):
+    """
+    Record a file sent over SFTP
+
+    :param host: Host the file was sent to.
+    :param nbytes: Size of the file.
+    :param seconds: Time taken by the transfer.
+    """
+
+    registry.inc('haas_sftp_bytes_total', dict(host=host), nbytes)
+    registry.observe('haas_sftp_seconds', dict(host=host), seconds)
+
+    if current():
+        current().add('sftp', seconds, host, nbytes=nbytes)
+
+
+def record_queries(queries):
+    """
+    Record database queries logged by Django
+
+    :param queries: Iterable of query dicts, as in connection.queries.
+    """
+
+    for query in queries:
+        seconds = float(query.get('time') or 0)
+
+        registry.inc('haas_sql_queries_total', {})
+        registry.observe('haas_sql_query_seconds', {}, seconds)
+
+        if current():
+            current().add('sql', seconds)
@@ -0,0 +1,119 @@
+import time
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.encoding import force_text
+
+from haas import metrics
+
+
+__all__ = ['CostMiddleware']
+
+class CostMiddleware(object):
+    """
+    Account for the SQL queries and SSH work done by every request
+
+    Everything a request does, including work fanned out to other threads,
+    is added to its own metrics.Tally, and to the process-wide metrics
+    registry. When the METRICS_FOOTER setting is enabled, admin pages also
+    get a footer summarizing what they cost. If it's None, the footer is
+    only shown when DEBUG is on.
+
+    Admin actions redirect back to the list they were started from, so
+    the cost of a form submission is kept in the session, and shown on
+    the page that follows it.
+    """
+
+    def process_request(self, request):
+        request.haas_tally = metrics.Tally()
+        request.haas_tracking = metrics.tracking(request.haas_tally)
+        request.haas_tracking.__enter__()
+
+
+    def process_response(self, request, response):
+        tracker = getattr(request, 'haas_tracking', None)
+
+        if not tracker:
+            return response
+
+        tracker.__exit__(None, None, None)
+        del request.haas_tracking
+
+        tally = request.haas_tally
+        metrics.registry.observe('haas_request_seconds',
+            dict(method=request.method), time.time() - tally.started
+        )
+
+        footer = settings.METRICS_FOOTER
+        if footer is None:
+            footer = settings.DEBUG
+
+        if not footer or not request.path.startswith('/admin/') or \
+            not hasattr(request, 'session'):
+            return response
+
+        if request.method == 'POST' and response.status_code in (301, 302,
+            303):
+            request.session['haas_cost'] = tally.summary()
+        elif self.wants_footer(response):
+            self.add_footer(response, [
+                ('Previous request', request.session.pop('haas_cost', None)),
+                ('This request', tally.summary()),
+            ])
+
+        return response
+
+
+    def wants_footer(self, response):
+        """
+        Decide whether a response is a page we can add a footer to
+        """
+
+        return not response.streaming and \
+            response.status_code == 200 and \
+            response.get('Content-Type', '').startswith('text/html') and \
+            '</body>' in force_text(response.content[-1024:], errors='ignore')
+
+
+    def add_footer(self, response, summaries):
+        """
+        Insert the cost of requests just before the end of the page
+
+        :param response: HttpResponse of an HTML page.
+        :param summaries: List of (title, Tally summary) pairs. Summaries
+            which are None are left out.
+        """
+
+        costs = []
+
+        for title, summary in summaries:
+            if not summary:
+                continue
+
+            counts = summary['counts']
+            spent = summary['kind_seconds']
+
+            costs.append(dict(title=title, summary=summary,
+                kinds = [
+                    (label, counts.get(kind, 0), spent.get(kind, 0))
+                    for kind, label in (('sql', 'SQL queries'),
+                        ('ssh', 'SSH commands'),
+                        ('connect', 'SSH handshakes'),
+                        ('sftp', 'file transfers'))
+                ],
+                commands = sorted(summary['commands'].items(),
+                    key=lambda c: -c[1][1]
+                ),
+            ))
+
+        footer = render_to_string('admin/haas/shared/cost_footer.html',
+            {'costs': costs}
+        )
+
+        content = force_text(response.content, response.charset)
+        head, tail = content.rsplit('</body>', 1)
+
+        response.content = head + footer + '</body>' + tail
+
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0005_fix_views'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('job_id', models.AutoField(primary_key=True, serialize=False)),
+                ('batch', models.CharField(db_index=True, max_length=32, verbose_name=b'Batch')),
+                ('action', models.CharField(max_length=40, verbose_name=b'Action')),
+                ('status', models.CharField(choices=[(b'queued', b'Queued'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')], db_index=True, default=b'queued', max_length=10, verbose_name=b'Status')),
+                ('progress', models.IntegerField(default=0, verbose_name=b'Progress (%)')),
+                ('message', models.TextField(blank=True, verbose_name=b'Last Message')),
+                ('owner', models.CharField(blank=True, max_length=150, verbose_name=b'Submitted By')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name=b'Worker')),
+                ('created_dt', models.DateTimeField(auto_now_add=True, verbose_name=b'Submitted')),
+                ('started_dt', models.DateTimeField(null=True, verbose_name=b'Started')),
+                ('finished_dt', models.DateTimeField(null=True, verbose_name=b'Finished')),
+                ('instance', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='haas.Instance')),
+            ],
+            options={
+                'ordering': ['-job_id'],
+                'db_table': 'ele_job',
+                'verbose_name': 'Background Job',
+            },
+        ),
+    ]
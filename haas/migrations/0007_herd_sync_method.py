@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0006_add_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='herd',
+            name='sync_method',
+            field=models.CharField(choices=[(b'rewind', b'pg_rewind, falling back to rsync'), (b'rsync', b'rsync'), (b'basebackup', b'pg_basebackup')], default=b'rewind', help_text=b'How replicas in this herd are rebuilt from the primary.', max_length=20, verbose_name=b'Rebuild Method'),
+        ),
+        migrations.AddField(
+            model_name='herd',
+            name='sync_compress',
+            field=models.BooleanField(default=False, help_text=b'Compress data sent while rebuilding replicas. Useful on slow links, but costs CPU on both hosts.', verbose_name=b'Compress Rebuilds'),
+        ),
+    ]
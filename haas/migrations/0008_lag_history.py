@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0007_herd_sync_method'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LagRollup',
+            fields=[
+                ('rollup_id', models.AutoField(primary_key=True, serialize=False)),
+                ('resolution', models.CharField(choices=[(b'1m', b'Minute'), (b'1h', b'Hour'), (b'1d', b'Day')], max_length=2, verbose_name=b'Resolution')),
+                ('bucket_ts', models.DateTimeField(verbose_name=b'Period Start')),
+                ('avg_lag', models.BigIntegerField(null=True, verbose_name=b'Average Lag (Bytes)')),
+                ('max_lag', models.BigIntegerField(null=True, verbose_name=b'Maximum Lag (Bytes)')),
+                ('xlog_pos', models.BigIntegerField(null=True, verbose_name=b'Last XLOG Position')),
+                ('samples', models.IntegerField(verbose_name=b'Samples')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='haas.Instance')),
+            ],
+            options={
+                'ordering': ['bucket_ts'],
+                'db_table': 'ele_lag_rollup',
+                'verbose_name': 'Lag Rollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='lagrollup',
+            unique_together=set([('instance', 'resolution', 'bucket_ts')]),
+        ),
+        migrations.RunSQL(
+            """
+            CREATE TABLE ele_lag_sample (
+              sample_ts    TIMESTAMP WITH TIME ZONE NOT NULL,
+              instance_id  INT NOT NULL,
+              xlog_pos     BIGINT,
+              lag_bytes    BIGINT
+            );
+            """
+            """
+            CREATE OR REPLACE FUNCTION sp_lag_rotate(
+              p_days_ahead INT,
+              p_keep_days  INT
+            )
+            RETURNS VOID AS
+            $$
+            DECLARE
+              v_today DATE := (now() AT TIME ZONE 'UTC')::DATE;
+              v_day   DATE;
+              v_part  TEXT;
+            BEGIN
+              -- Raw samples are partitioned by UTC day. Each partition is a
+              -- child of ele_lag_sample, so dropping old data is a simple
+              -- DROP TABLE rather than a huge DELETE.
+
+              FOR v_day IN
+                  SELECT generate_series(v_today, v_today + p_days_ahead,
+                         '1 day')::DATE
+              LOOP
+                v_part := 'ele_lag_sample_' || to_char(v_day, 'YYYYMMDD');
+
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_tables
+                     WHERE schemaname = current_schema()
+                       AND tablename = v_part
+                ) THEN
+                  EXECUTE format(
+                    'CREATE TABLE %I (
+                       CHECK (sample_ts >= %L AND sample_ts < %L)
+                     ) INHERITS (ele_lag_sample)',
+                    v_part, v_day::TEXT || ' 00:00:00+00',
+                    (v_day + 1)::TEXT || ' 00:00:00+00'
+                  );
+                  EXECUTE format(
+                    'CREATE INDEX ON %I (instance_id, sample_ts)', v_part
+                  );
+                END IF;
+              END LOOP;
+
+              FOR v_part IN
+                  SELECT c.relname::TEXT
+                    FROM pg_inherits i
+                    JOIN pg_class c ON (c.oid = i.inhrelid)
+                   WHERE i.inhparent = 'ele_lag_sample'::REGCLASS
+                     AND c.relname::TEXT < 'ele_lag_sample_' ||
+                         to_char(v_today - p_keep_days, 'YYYYMMDD')
+              LOOP
+                EXECUTE format('DROP TABLE %I', v_part);
+              END LOOP;
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+            """
+            CREATE OR REPLACE FUNCTION sp_lag_rollup(p_since TIMESTAMPTZ)
+            RETURNS VOID AS
+            $$
+            BEGIN
+              -- Each resolution is built from the one below it, so only
+              -- minute rollups ever read raw samples. Buckets overlapping
+              -- p_since are recalculated in full, so calling this again
+              -- for the same period is harmless.
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1m', date_trunc('minute', sample_ts),
+                     avg(lag_bytes)::BIGINT, max(lag_bytes), max(xlog_pos),
+                     count(*)
+                FROM ele_lag_sample
+               WHERE sample_ts >= date_trunc('minute', p_since)
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1h', date_trunc('hour', bucket_ts),
+                     (sum(avg_lag * samples) / nullif(sum(samples)
+                       FILTER (WHERE avg_lag IS NOT NULL), 0))::BIGINT,
+                     max(max_lag), max(xlog_pos), sum(samples)
+                FROM ele_lag_rollup
+               WHERE resolution = '1m'
+                 AND bucket_ts >= date_trunc('hour', p_since)
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1d', date_trunc('day', bucket_ts),
+                     (sum(avg_lag * samples) / nullif(sum(samples)
+                       FILTER (WHERE avg_lag IS NOT NULL), 0))::BIGINT,
+                     max(max_lag), max(xlog_pos), sum(samples)
+                FROM ele_lag_rollup
+               WHERE resolution = '1h'
+                 AND bucket_ts >= date_trunc('day', p_since)
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+            """
+            SELECT sp_lag_rotate(1, 2);
+            """,
+            """
+            DROP FUNCTION sp_lag_rollup(TIMESTAMPTZ);
+            DROP FUNCTION sp_lag_rotate(INT, INT);
+            DROP TABLE ele_lag_sample CASCADE;
+            """
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0008_lag_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='detail',
+            field=models.TextField(blank=True, help_text=b'JSON details recorded by the task, such as phase timings.', verbose_name=b'Detail'),
+        ),
+    ]
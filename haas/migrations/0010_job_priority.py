@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0009_job_detail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='priority',
+            field=models.IntegerField(choices=[(10, b'High'), (0, b'Normal'), (-10, b'Low')], default=0, verbose_name=b'Priority'),
+        ),
+    ]
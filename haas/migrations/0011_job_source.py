@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0010_job_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='haas.Instance', verbose_name=b'Copied From'),
+        ),
+    ]
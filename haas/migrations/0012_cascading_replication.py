@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0011_job_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='herd',
+            name='max_fanout',
+            field=models.PositiveIntegerField(default=0, help_text=b'Most replicas allowed to stream directly from any one instance. New replicas cascade from existing replicas once the primary is full. Zero means no limit.', verbose_name=b'Replicas per Upstream'),
+        ),
+        migrations.AlterField(
+            model_name='instance',
+            name='master',
+            field=models.ForeignKey(blank=True, help_text=b'If this is a replica, the upstream data source. This may be another replica, for cascading replication. Leave empty to choose automatically.', null=True, on_delete=django.db.models.deletion.SET_NULL, to='haas.Instance'),
+        ),
+        migrations.RunSQL(
+            """
+            CREATE OR REPLACE VIEW v_dr_pairs AS
+            SELECT DISTINCT ON (herd_id)
+                   r.herd_id, r.instance_id, r.master_id, r.server_id,
+                   round(abs(coalesce(p.xlog_pos, 0) - 
+                     coalesce(r.xlog_pos, 0)) / 1024.0 / 1024.0, 1) AS mb_lag,
+                   h.vhost
+              FROM ele_instance r
+              JOIN ele_instance p ON (p.instance_id = r.master_id)
+              JOIN ele_herd h ON (h.herd_id = r.herd_id)
+             WHERE r.is_online
+               AND r.master_id IS NOT NULL
+               AND p.master_id IS NULL
+             ORDER BY herd_id, mb_lag, r.instance_id;
+            """,
+            """
+            CREATE OR REPLACE VIEW v_dr_pairs AS
+            SELECT DISTINCT ON (herd_id)
+                   r.herd_id, r.instance_id, r.master_id, r.server_id,
+                   round(abs(coalesce(p.xlog_pos, 0) - 
+                     coalesce(r.xlog_pos, 0)) / 1024.0 / 1024.0, 1) AS mb_lag,
+                   h.vhost
+              FROM ele_instance r
+              JOIN ele_instance p ON (p.instance_id = r.master_id)
+              JOIN ele_herd h ON (h.herd_id = r.herd_id)
+             WHERE r.is_online
+               AND r.master_id IS NOT NULL
+             ORDER BY herd_id, mb_lag, r.instance_id;
+            """
+        ),
+    ]
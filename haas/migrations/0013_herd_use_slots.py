@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0012_cascading_replication'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='herd',
+            name='use_slots',
+            field=models.BooleanField(default=False, help_text=b'Keep a replication slot for every replica on its upstream, so lagging replicas can always catch up by streaming. Requires PostgreSQL 9.4 or higher.', verbose_name=b'Replication Slots'),
+        ),
+    ]
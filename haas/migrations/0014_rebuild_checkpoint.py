@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0013_herd_use_slots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RebuildCheckpoint',
+            fields=[
+                ('checkpoint_id', models.AutoField(primary_key=True, serialize=False)),
+                ('method', models.CharField(max_length=20, verbose_name=b'Rebuild Method')),
+                ('phases', models.TextField(blank=True, verbose_name=b'Completed Phases')),
+                ('units', models.TextField(blank=True, verbose_name=b'Copied Files')),
+                ('created_dt', models.DateTimeField(auto_now_add=True, verbose_name=b'Started')),
+                ('modified_dt', models.DateTimeField(auto_now=True, verbose_name=b'Last Progress')),
+                ('instance', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='haas.Instance')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='haas.Instance')),
+            ],
+            options={
+                'db_table': 'ele_rebuild_checkpoint',
+                'verbose_name': 'Rebuild Checkpoint',
+            },
+        ),
+    ]
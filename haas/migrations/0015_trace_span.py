@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0014_rebuild_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TraceSpan',
+            fields=[
+                ('span_id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=40, verbose_name=b'Phase')),
+                ('host', models.CharField(blank=True, max_length=255, verbose_name=b'Host')),
+                ('started_dt', models.DateTimeField(verbose_name=b'Started')),
+                ('seconds', models.FloatField(null=True, verbose_name=b'Duration (s)')),
+                ('bytes', models.BigIntegerField(null=True, verbose_name=b'Bytes Copied')),
+                ('commands', models.IntegerField(default=0, verbose_name=b'Remote Commands')),
+                ('exit_status', models.IntegerField(null=True, verbose_name=b'Exit Status')),
+                ('error', models.TextField(blank=True, verbose_name=b'Error')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='haas.Job')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='haas.TraceSpan')),
+            ],
+            options={
+                'ordering': ['span_id'],
+                'db_table': 'ele_trace_span',
+                'verbose_name': 'Trace Span',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0015_trace_span'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='output',
+            field=models.TextField(blank=True, help_text=b'Last lines printed by long remote commands, like rsync.', verbose_name=b'Recent Output'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0016_job_output'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rebuildcheckpoint',
+            name='backup_start',
+            field=models.CharField(blank=True, help_text=b'When the backup on the source the copy belongs to began.', max_length=40, verbose_name=b'Backup Started'),
+        ),
+    ]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('haas', '0017_checkpoint_backup_start'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            CREATE OR REPLACE FUNCTION sp_lag_rollup(p_since TIMESTAMPTZ)
+            RETURNS VOID AS
+            $$
+            BEGIN
+              -- Each resolution is built from the one below it, so only
+              -- minute rollups ever read raw samples. Buckets overlapping
+              -- p_since are recalculated in full, so calling this again
+              -- for the same period is harmless. Samples have no foreign
+              -- key, so those of instances deleted since they were taken
+              -- are left out rather than failing the rollup's.
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1m', date_trunc('minute', sample_ts),
+                     avg(lag_bytes)::BIGINT, max(lag_bytes), max(xlog_pos),
+                     count(*)
+                FROM ele_lag_sample s
+               WHERE sample_ts >= date_trunc('minute', p_since)
+                 AND EXISTS (
+                     SELECT 1 FROM ele_instance i
+                      WHERE i.instance_id = s.instance_id
+                 )
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1h', date_trunc('hour', bucket_ts),
+                     (sum(avg_lag * samples) / nullif(sum(samples)
+                       FILTER (WHERE avg_lag IS NOT NULL), 0))::BIGINT,
+                     max(max_lag), max(xlog_pos), sum(samples)
+                FROM ele_lag_rollup
+               WHERE resolution = '1m'
+                 AND bucket_ts >= date_trunc('hour', p_since)
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+
+              INSERT INTO ele_lag_rollup
+                     (instance_id, resolution, bucket_ts, avg_lag, max_lag,
+                      xlog_pos, samples)
+              SELECT instance_id, '1d', date_trunc('day', bucket_ts),
+                     (sum(avg_lag * samples) / nullif(sum(samples)
+                       FILTER (WHERE avg_lag IS NOT NULL), 0))::BIGINT,
+                     max(max_lag), max(xlog_pos), sum(samples)
+                FROM ele_lag_rollup
+               WHERE resolution = '1h'
+                 AND bucket_ts >= date_trunc('day', p_since)
+               GROUP BY 1, 3
+                  ON CONFLICT (instance_id, resolution, bucket_ts)
+                  DO UPDATE SET avg_lag = EXCLUDED.avg_lag,
+                                max_lag = EXCLUDED.max_lag,
+                                xlog_pos = EXCLUDED.xlog_pos,
+                                samples = EXCLUDED.samples;
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+            """
+            CREATE OR REPLACE FUNCTION sp_lag_sample_purge()
+            RETURNS TRIGGER AS
+            $$
+            BEGIN
+              -- Raw samples of a deleted instance are of no further use,
+              -- and its rollups are already removed by their foreign key.
+
+              DELETE FROM ele_lag_sample
+               WHERE instance_id = OLD.instance_id;
+
+              RETURN OLD;
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+            """
+            CREATE TRIGGER t_instance_lag_purge_a_d
+            AFTER DELETE
+                ON ele_instance
+               FOR EACH ROW EXECUTE PROCEDURE sp_lag_sample_purge();
+            """
+            """
+            DELETE FROM ele_lag_sample s
+             WHERE NOT EXISTS (
+                   SELECT 1 FROM ele_instance i
+                    WHERE i.instance_id = s.instance_id
+             );
+            """,
+            """
+            DROP TRIGGER t_instance_lag_purge_a_d ON ele_instance;
+            DROP FUNCTION sp_lag_sample_purge();
+            """
+        ),
+    ]
@@ -1,5 +1,11 @@
+import json
+import re
+
 from django.db import models
+from django.db.models.functions import Concat
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 class Environment(models.Model):
     """
@@ -29,6 +35,21 @@ class Environment(models.Model):
         return self.env_name
 
 
+class HerdManager(models.Manager):
+    """
+    Always fetch the environment along with a herd
+
+    A herd's name includes its environment, so listing herds anywhere in
+    the admin (filters, select boxes) would otherwise cost one extra query
+    for every herd.
+    """
+
+    def get_queryset(self):
+        return super(HerdManager, self).get_queryset().select_related(
+            'environment'
+        )
+
+
 class Herd(models.Model):
     """
     Define a Postgres Database Herd
@@ -70,9 +91,38 @@ class Herd(models.Model):
         max_length=40,
         help_text='Virtual host name to identify primary herd member.'
     )
+    sync_method = models.CharField('Rebuild Method',
+        max_length=20,
+        choices=(
+            ('rewind', 'pg_rewind, falling back to rsync'),
+            ('rsync', 'rsync'),
+            ('basebackup', 'pg_basebackup'),
+        ),
+        default='rewind',
+        help_text='How replicas in this herd are rebuilt from the primary.'
+    )
+    sync_compress = models.BooleanField('Compress Rebuilds',
+        default=False,
+        help_text='Compress data sent while rebuilding replicas. Useful on' +
+            ' slow links, but costs CPU on both hosts.'
+    )
+    use_slots = models.BooleanField('Replication Slots',
+        default=False,
+        help_text='Keep a replication slot for every replica on its upstream,' +
+            ' so lagging replicas can always catch up by streaming.' +
+            ' Requires PostgreSQL 9.4 or higher.'
+    )
+    max_fanout = models.PositiveIntegerField('Replicas per Upstream',
+        default=0,
+        help_text='Most replicas allowed to stream directly from any one' +
+            ' instance. New replicas cascade from existing replicas once' +
+            ' the primary is full. Zero means no limit.'
+    )
     created_dt = models.DateField(editable=False)
     modified_dt = models.DateField(editable=False)
 
+    objects = HerdManager()
+
     class Meta:
         verbose_name = 'Herd'
         db_table = 'ele_herd'
@@ -144,8 +194,9 @@ class Instance(models.Model):
         on_delete = models.SET_NULL,
         null=True,
         blank=True,
-        editable=False,
-        help_text='If this is a replica, the upstream data source.'
+        help_text='If this is a replica, the upstream data source. This may' +
+            ' be another replica, for cascading replication. Leave empty' +
+            ' to choose automatically.'
     )
 
     created_dt = models.DateField(editable=False)
@@ -159,6 +210,59 @@ class Instance(models.Model):
     def __unicode__(self):
         return self.herd.herd_name + ' - ' + self.herd.environment.env_name
 
+    @property
+    def slot_name(self):
+        """
+        Name of the replication slot kept for this replica on its upstream
+
+        Every slot created by ElepHaaS starts with haas_, so slots created
+        by anything else are never touched.
+        """
+        name = 'haas_%s_%s' % (self.herd.base_name, self.server.hostname)
+        return re.sub('[^a-z0-9_]', '_', name.lower())[:63]
+
+    def clean(self):
+        """
+        Make sure the upstream master makes sense for this instance
+
+        The master must belong to the same herd, and following masters
+        upward must reach a primary rather than loop back here. The master
+        may also not already feed as many replicas as the herd allows.
+        """
+
+        if not self.master_id:
+            return
+
+        master = self.master
+
+        if master.herd_id != self.herd_id:
+            raise ValidationError({'master':
+                'The upstream master must be in the same herd.'
+            })
+
+        seen = set([self.pk])
+        node = master
+
+        while node:
+            if node.pk in seen:
+                raise ValidationError({'master':
+                    'Replication may not loop back to this instance.'
+                })
+            seen.add(node.pk)
+            node = node.master
+
+        limit = self.herd.max_fanout
+        feeds = Instance.objects.filter(master_id = master.pk).exclude(
+            pk = self.pk
+        ).count()
+
+        if limit and feeds >= limit:
+            raise ValidationError({'master':
+                '%s already feeds %d replicas.' % (
+                    master.server.hostname, feeds
+                )
+            })
+
 
 class DisasterRecovery(models.Model):
     """
@@ -197,3 +301,260 @@ class DisasterRecovery(models.Model):
         db_table = 'v_dr_pairs'
         managed = False
 
+
+
+class Job(models.Model):
+    """
+    Define a Background Job
+
+    Some admin actions, like rebuilding a replica, can take hours. Rather
+    than tying up a web request, these can be queued here and executed by
+    one or more haas_worker processes. Every job applies a single action
+    to a single instance, and jobs submitted together share a batch so
+    their progress can be tracked as a group.
+    """
+
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    PRIORITY_CHOICES = (
+        (10, 'High'),
+        (0, 'Normal'),
+        (-10, 'Low'),
+    )
+
+    job_id = models.AutoField(primary_key=True)
+    batch = models.CharField('Batch', max_length=32, db_index=True)
+    action = models.CharField('Action', max_length=40)
+    instance = models.ForeignKey('Instance',
+        on_delete = models.CASCADE,
+        null=True
+    )
+    source = models.ForeignKey('Instance',
+        verbose_name='Copied From',
+        on_delete = models.SET_NULL,
+        related_name='+',
+        null=True,
+        blank=True
+    )
+    status = models.CharField('Status',
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default='queued',
+        db_index=True
+    )
+    priority = models.IntegerField('Priority',
+        choices=PRIORITY_CHOICES,
+        default=0
+    )
+    progress = models.IntegerField('Progress (%)', default=0)
+    message = models.TextField('Last Message', blank=True)
+    detail = models.TextField('Detail', blank=True,
+        help_text='JSON details recorded by the task, such as phase timings.'
+    )
+    output = models.TextField('Recent Output', blank=True,
+        help_text='Last lines printed by long remote commands, like rsync.'
+    )
+    owner = models.CharField('Submitted By', max_length=150, blank=True)
+    worker = models.CharField('Worker', max_length=100, blank=True)
+    created_dt = models.DateTimeField('Submitted', auto_now_add=True)
+    started_dt = models.DateTimeField('Started', null=True)
+    finished_dt = models.DateTimeField('Finished', null=True)
+
+    class Meta:
+        verbose_name = 'Background Job'
+        db_table = 'ele_job'
+        ordering = ['-job_id',]
+
+    def __unicode__(self):
+        return '%s #%d' % (self.action, self.job_id)
+
+    def report(self, progress=None, message=None, detail=None, output=None):
+        """
+        Record job progress without disturbing any other columns
+
+        Workers and the web tier both touch job rows, so we only ever
+        update the specific columns being reported. Details are any
+        structure that can be stored as JSON. Output is the latest few
+        lines printed by a remote command.
+        """
+        changes = {}
+
+        if progress is not None:
+            self.progress = changes['progress'] = progress
+        if message is not None:
+            self.message = changes['message'] = message
+        if detail is not None:
+            self.detail = changes['detail'] = json.dumps(detail)
+        if output is not None:
+            self.output = changes['output'] = output
+
+        if changes:
+            Job.objects.filter(pk=self.pk).update(**changes)
+
+
+class RebuildCheckpoint(models.Model):
+    """
+    Define a Rebuild Checkpoint
+
+    Rebuilding a large replica can take hours, and a dropped connection
+    along the way would otherwise mean starting over from the beginning,
+    including another checkpoint on the master. As a rebuild progresses,
+    each completed phase is recorded here, along with every file already
+    copied. A retried rebuild of the same instance, from the same source
+    and with the same method, continues from there. Copied files are only
+    trusted while the source is still in the very backup they were copied
+    under. The checkpoint is removed once the rebuild succeeds.
+    """
+
+    checkpoint_id = models.AutoField(primary_key=True)
+    instance = models.OneToOneField('Instance', on_delete = models.CASCADE)
+    source = models.ForeignKey('Instance',
+        on_delete = models.CASCADE,
+        related_name='+'
+    )
+    method = models.CharField('Rebuild Method', max_length=20)
+    backup_start = models.CharField('Backup Started', max_length=40,
+        blank=True,
+        help_text='When the backup on the source the copy belongs to began.'
+    )
+    phases = models.TextField('Completed Phases', blank=True)
+    units = models.TextField('Copied Files', blank=True)
+    created_dt = models.DateTimeField('Started', auto_now_add=True)
+    modified_dt = models.DateTimeField('Last Progress', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Rebuild Checkpoint'
+        db_table = 'ele_rebuild_checkpoint'
+
+    def __unicode__(self):
+        return '%s from %s' % (self.instance, self.source)
+
+    def done(self, phase):
+        """
+        Check whether a phase of the rebuild was already completed
+        """
+        return phase in self.phases.split(',')
+
+    def complete(self, phase):
+        """
+        Record that a phase of the rebuild is complete
+        """
+        if not self.done(phase):
+            self.phases = ','.join(filter(None, [self.phases, phase]))
+            self.save(update_fields=['phases', 'modified_dt'])
+
+    def reset(self, *phases):
+        """
+        Forget completed phases, and every copied file along with them
+        """
+        self.phases = ','.join(
+            p for p in self.phases.split(',') if p and p not in phases
+        )
+        self.units = ''
+
+        if 'backup' in phases:
+            self.backup_start = ''
+
+        self.save(update_fields=['phases', 'units', 'backup_start',
+            'modified_dt'
+        ])
+
+    def copied(self):
+        """
+        Get the set of files already copied, as full source paths
+        """
+        return set(filter(None, self.units.split('\n')))
+
+    def add_copied(self, paths):
+        """
+        Record more copied files, as full source paths
+
+        Paths are appended to the list in the database, one per line, so
+        each bucket costs the same to record no matter how many came before
+        it. The list already loaded in this object is left alone.
+        """
+        added = ''.join(path + '\n' for path in paths)
+
+        RebuildCheckpoint.objects.filter(pk=self.pk).update(
+            units=Concat('units', models.Value(added),
+                output_field=models.TextField()
+            ),
+            modified_dt=timezone.now()
+        )
+
+
+class TraceSpan(models.Model):
+    """
+    Define a Trace Span
+
+    Rebuilds, demotions and failovers are long chains of remote steps, and
+    knowing only the final outcome says nothing about where the time went.
+    Every step a job takes is recorded here as it starts, and completed
+    with its duration, the bytes it copied, and the exit status of its
+    last remote command once it ends. Steps may contain smaller steps,
+    such as the individual rsync streams of a data directory copy.
+    """
+
+    span_id = models.AutoField(primary_key=True)
+    job = models.ForeignKey('Job', on_delete = models.CASCADE)
+    parent = models.ForeignKey('self',
+        on_delete = models.CASCADE,
+        null=True,
+        blank=True
+    )
+    name = models.CharField('Phase', max_length=40)
+    host = models.CharField('Host', max_length=255, blank=True)
+    started_dt = models.DateTimeField('Started')
+    seconds = models.FloatField('Duration (s)', null=True)
+    bytes = models.BigIntegerField('Bytes Copied', null=True)
+    commands = models.IntegerField('Remote Commands', default=0)
+    exit_status = models.IntegerField('Exit Status', null=True)
+    error = models.TextField('Error', blank=True)
+
+    class Meta:
+        verbose_name = 'Trace Span'
+        db_table = 'ele_trace_span'
+        ordering = ['span_id',]
+
+    def __unicode__(self):
+        return '%s #%d' % (self.name, self.span_id)
+
+
+class LagRollup(models.Model):
+    """
+    Define a Downsampled Replication Lag Measurement
+
+    The status collector records a raw lag sample for every instance on
+    every pass. Those are kept in the day-partitioned ele_lag_sample table
+    for a short time only. For charts and capacity planning, samples are
+    rolled up into one row per instance for every minute, hour and day.
+    """
+
+    RESOLUTION_CHOICES = (
+        ('1m', 'Minute'),
+        ('1h', 'Hour'),
+        ('1d', 'Day'),
+    )
+
+    rollup_id = models.AutoField(primary_key=True)
+    instance = models.ForeignKey('Instance', on_delete = models.CASCADE)
+    resolution = models.CharField('Resolution',
+        max_length=2,
+        choices=RESOLUTION_CHOICES
+    )
+    bucket_ts = models.DateTimeField('Period Start')
+    avg_lag = models.BigIntegerField('Average Lag (Bytes)', null=True)
+    max_lag = models.BigIntegerField('Maximum Lag (Bytes)', null=True)
+    xlog_pos = models.BigIntegerField('Last XLOG Position', null=True)
+    samples = models.IntegerField('Samples')
+
+    class Meta:
+        verbose_name = 'Lag Rollup'
+        db_table = 'ele_lag_rollup'
+        unique_together = ('instance', 'resolution', 'bucket_ts')
+        ordering = ['bucket_ts',]
@@ -0,0 +1,255 @@
+import threading
+import time
+
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+import dns.update
+
+from django.conf import settings
+
+from haas.executor import FanOut
+from haas.models import Herd, Instance
+from haas.utility import wait_for
+
+
+__all__ = ['DNSUpdater', 'dns_updater', 'refresh_herds']
+
+class _Change(object):
+    """
+    One requested vhost move, waiting to be sent with its batch
+    """
+
+    def __init__(self, vhost, target):
+        self.vhost = str(vhost)
+        self.target = str(target)
+        self.error = None
+        self.done = threading.Event()
+
+
+class DNSUpdater(object):
+    """
+    Move herd virtual hosts between servers with dynamic DNS updates
+
+    Every vhost is a CNAME in a single zone, which defaults to the search
+    domain of the local resolver configuration. That configuration is read
+    once and reused for every update.
+
+    When many herds fail over at once, each of them asks for its vhost to
+    be moved within moments of the others. Rather than send each change on
+    its own, requests arriving within DNS_BATCH_WINDOW seconds of the first
+    are merged into one update message. Updates are sent to every
+    nameserver at the same time, and then every nameserver is queried,
+    also at the same time, until they all answer with the new targets.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._resolver = None
+
+
+    def resolver(self):
+        """
+        Get the resolver configuration shared by all updates
+
+        Nameservers and the zone come from the DNS_NAMESERVERS and DNS_ZONE
+        settings when set, and from the local resolver otherwise.
+
+        :return: A dns.resolver.Resolver object.
+        """
+
+        with self._lock:
+            if not self._resolver:
+                res = dns.resolver.Resolver()
+                if settings.DNS_NAMESERVERS:
+                    res.nameservers = list(settings.DNS_NAMESERVERS)
+                if settings.DNS_ZONE:
+                    res.domain = dns.name.from_text(settings.DNS_ZONE)
+                self._resolver = res
+
+        return self._resolver
+
+
+    def move(self, vhost, target):
+        """
+        Point a vhost at a new server, merged with any concurrent moves
+
+        The first caller waits out the batch window, then sends everything
+        requested in the meantime. Everyone else simply waits for the batch
+        they joined to be confirmed.
+
+        :param vhost: Virtual host name, relative to the zone.
+        :param target: Host name the vhost should point to.
+
+        :raises: Exception if the update failed or never propagated.
+        """
+
+        change = _Change(vhost, target)
+
+        with self._lock:
+            self._pending.append(change)
+            leader = len(self._pending) == 1
+
+        if leader:
+            time.sleep(settings.DNS_BATCH_WINDOW)
+
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+
+            try:
+                errors = self.apply([(c.vhost, c.target) for c in batch])
+            except Exception, e:
+                errors = dict((c.vhost, str(e)) for c in batch)
+
+            for c in batch:
+                c.error = errors.get(c.vhost)
+                c.done.set()
+
+        change.done.wait()
+
+        if change.error:
+            raise Exception(change.error)
+
+
+    def apply(self, changes):
+        """
+        Point several vhosts at new servers with a single update message
+
+        :param changes: List of (vhost, target host) pairs.
+
+        :return: Dict of vhost to error message for any changes that were
+            sent but did not propagate to every nameserver.
+        :raises: Exception if any nameserver rejected the update.
+        """
+
+        if not changes:
+            return {}
+
+        res = self.resolver()
+        zone = res.domain
+
+        update = dns.update.Update(zone)
+
+        for vhost, target in changes:
+            update.delete(vhost, 'cname')
+            update.add(vhost, settings.DNS_TTL, 'cname', target)
+
+        pool = FanOut(workers=len(res.nameservers))
+
+        results = pool.map(
+            lambda ns: dns.query.tcp(update, ns, timeout=settings.DNS_TIMEOUT),
+            res.nameservers
+        )
+
+        failed = []
+
+        for ns, response, e in results:
+            if e:
+                failed.append('%s: %s' % (ns, e))
+            elif response.rcode() != dns.rcode.NOERROR:
+                failed.append('%s: %s' % (
+                    ns, dns.rcode.to_text(response.rcode())
+                ))
+
+        if failed:
+            raise Exception('DNS update failed on %s' % ', '.join(failed))
+
+        # Names in the update are relative to the zone, so the expected
+        # answers must be resolved the same way.
+
+        names = dict(
+            (dns.name.from_text(vhost, zone), vhost) for vhost, target in changes
+        )
+        expected = dict(
+            (dns.name.from_text(vhost, zone), dns.name.from_text(target, zone))
+            for vhost, target in changes
+        )
+
+        results = pool.map(
+            lambda ns: self.__verify(ns, expected), res.nameservers
+        )
+
+        errors = {}
+
+        for ns, missing, e in results:
+            for name in (expected.keys() if e else missing):
+                errors[names[name]] = 'DNS change for %s not visible on %s.' % (
+                    names[name], ns
+                )
+
+        return errors
+
+
+    def __verify(self, ns, expected):
+        """
+        Wait until one nameserver answers every name with its new target
+
+        :return: List of names still not answered correctly, if we ran out
+            of time waiting for them.
+        """
+
+        remaining = dict(expected)
+
+        def check():
+            for name, target in remaining.items():
+                query = dns.message.make_query(name, dns.rdatatype.CNAME)
+                answer = dns.query.udp(query, ns, timeout=settings.DNS_TIMEOUT)
+
+                for rrset in answer.answer:
+                    if any(rr.target == target for rr in rrset):
+                        del remaining[name]
+                        break
+
+            return not remaining
+
+        try:
+            wait_for(check, settings.DNS_VERIFY_TIMEOUT,
+                '%s to answer with new targets' % ns
+            )
+        except Exception:
+            pass
+
+        return remaining.keys()
+
+
+dns_updater = DNSUpdater()
+
+
+def refresh_herds(herd_ids):
+    """
+    Point the vhost of each herd back at its current primary
+
+    After a manual promotion, or a failover where the DNS step failed, a
+    vhost may no longer lead to the herd primary. This corrects any number
+    of herds with a single update. Where a herd has several primaries, an
+    online one is preferred.
+
+    :param herd_ids: IDs of the herds to refresh.
+
+    :raises: Exception if any nameserver rejected the update.
+    :return: Tuple of the herds refreshed, the herds which had no primary,
+        and a dict of vhost to error for changes that didn't propagate.
+    """
+
+    primaries = {}
+
+    for inst in Instance.objects.filter(
+        herd_id__in=herd_ids, master_id__isnull=True
+    ).select_related('herd', 'server').order_by('-is_online', 'pk'):
+        primaries.setdefault(inst.herd_id, inst)
+
+    missing = Herd.objects.filter(pk__in=herd_ids).exclude(
+        pk__in=primaries.keys()
+    )
+
+    errors = dns_updater.apply([
+        (inst.herd.vhost, inst.server.hostname)
+        for inst in primaries.values()
+    ])
+
+    return ([inst.herd for inst in primaries.values()], missing, errors)
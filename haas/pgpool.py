@@ -0,0 +1,120 @@
+import psycopg2
+import threading
+
+from contextlib import contextmanager
+from django.conf import settings
+
+
+__all__ = ['PGPool', 'pg_pool']
+
+class PGPool(object):
+    """
+    Pool of libpq connections to managed Postgres instances
+
+    Status collection and fleet-wide queries connect to every managed
+    instance over and over. Rather than paying for a new backend process
+    every time, idle connections are kept here and reused. Connections
+    are keyed by host and port, and use the options in the PG_CONNECT
+    setting, such as user and dbname.
+
+    Connections are always returned in autocommit mode, so no borrower can
+    leave a transaction open for the next one. Borrowers that must not
+    wait on a hung instance can ask for a timeout, which limits both how
+    long a statement may run and how long a dead connection goes unnoticed.
+    Connections with different timeouts are pooled separately.
+    """
+
+    def __init__(self, max_idle=2):
+        """
+        Initialize a connection pool
+
+        :param max_idle: Idle connections to keep for each host and port.
+        """
+
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def _connect(self, host, port, timeout=None):
+        dsn = '%s host=%s port=%s' % (settings.PG_CONNECT, host, port)
+
+        # TCP keepalives are the only way to notice a server that stopped
+        # answering in the middle of a query.
+
+        if timeout:
+            dsn += " options='-c statement_timeout=%d' keepalives=1" \
+                " keepalives_idle=%d keepalives_interval=1" \
+                " keepalives_count=3" % (timeout * 1000, max(timeout, 1))
+
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+
+        return conn
+
+
+    @contextmanager
+    def connection(self, host, port, timeout=None):
+        """
+        Borrow a connection to a Postgres instance
+
+        If the borrower raises a database error, the connection is closed
+        rather than returned to the pool, since it may be broken.
+
+        :param host: Host name of the instance.
+        :param port: Port of the instance.
+        :param timeout: Whole seconds any statement may run, if limited.
+
+        :return: A psycopg2 connection in autocommit mode.
+        """
+
+        key = (host, port, timeout)
+        conn = None
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle and not conn:
+                conn = idle.pop()
+                if conn.closed:
+                    conn = None
+
+        if not conn:
+            conn = self._connect(host, port, timeout)
+
+        try:
+            yield conn
+        except psycopg2.Error:
+            conn.close()
+            raise
+        except:
+            self._release(key, conn)
+            raise
+
+        self._release(key, conn)
+
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+
+            if conn.closed or len(idle) >= self.max_idle:
+                conn.close()
+            else:
+                idle.append(conn)
+
+
+    def close_all(self):
+        """
+        Close every idle connection in the pool
+        """
+
+        with self._lock:
+            pools = self._idle.values()
+            self._idle = {}
+
+        for idle in pools:
+            for conn in idle:
+                conn.close()
+
+
+pg_pool = PGPool()
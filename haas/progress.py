@@ -0,0 +1,202 @@
+import re
+import threading
+import time
+
+from collections import deque
+from django.conf import settings
+
+
+__all__ = ['LineTail', 'ProgressFeed', 'format_size', 'rsync_progress',
+    'stream_channel',
+]
+
+# Commands that stream their output only keep this many of their last
+# lines, and lines are never longer than MAX_LINE bytes. That's plenty for
+# error messages and the rsync --stats summary.
+
+TAIL_LINES = 200
+MAX_LINE = 4096
+
+# Read buffer size, and how long to wait for more output before checking
+# whether the command exited, in seconds.
+
+READ_SIZE = 32768
+POLL_DELAY = 0.1
+
+
+class LineTail(object):
+    """
+    Split output into lines as it arrives, keeping only the last few
+
+    Progress meters like rsync --info=progress2 redraw one line by ending
+    it with a carriage return instead of a newline, so both end a line.
+    Each line is passed to a callback as soon as it's complete, so memory
+    use stays the same however much a command prints.
+    """
+
+    def __init__(self, callback=None, lines=TAIL_LINES):
+        """
+        Initialize an output tail
+
+        :param callback: Function called with every non-empty line.
+        :param lines: Number of lines to keep.
+        """
+
+        self.callback = callback
+        self.lines = deque(maxlen=lines)
+        self.partial = ''
+
+
+    def feed(self, data):
+        """
+        Add output, calling the callback for every line it completes
+        """
+
+        pieces = re.split(r'\r\n|\r|\n', self.partial + data)
+        self.partial = pieces.pop()
+
+        if len(self.partial) > MAX_LINE:
+            pieces.append(self.partial[:MAX_LINE])
+            self.partial = ''
+
+        for line in pieces:
+            line = line[:MAX_LINE]
+            self.lines.append(line)
+
+            if self.callback and line.strip():
+                self.callback(line)
+
+
+    def getvalue(self):
+        """
+        Get the last lines of output, as one string
+        """
+
+        lines = list(self.lines)
+        if self.partial:
+            lines.append(self.partial)
+
+        return '\n'.join(lines) + ('\n' if lines else '')
+
+
+def stream_channel(channel, callback):
+    """
+    Read the output of a remote command as it runs
+
+    Standard output is split into lines and passed to the callback as
+    they arrive. Both standard output and error are read throughout, so
+    neither can fill up and stall the command, but only their last lines
+    are kept.
+
+    :param channel: Paramiko Channel the command was started on.
+    :param callback: Function called with every line of standard output.
+
+    :return: Tuple of the last lines of standard output, the last lines of
+        standard error, and the exit status.
+    """
+
+    out = LineTail(callback)
+    err = LineTail()
+
+    while True:
+        idle = True
+
+        if channel.recv_ready():
+            out.feed(channel.recv(READ_SIZE))
+            idle = False
+        if channel.recv_stderr_ready():
+            err.feed(channel.recv_stderr(READ_SIZE))
+            idle = False
+
+        if idle:
+            if channel.exit_status_ready():
+                break
+            time.sleep(POLL_DELAY)
+
+    # Output that arrived just before the exit status is still waiting.
+
+    while channel.recv_ready():
+        out.feed(channel.recv(READ_SIZE))
+    while channel.recv_stderr_ready():
+        err.feed(channel.recv_stderr(READ_SIZE))
+
+    return (out.getvalue(), err.getvalue(), channel.recv_exit_status())
+
+
+def rsync_progress(line):
+    """
+    Read a line of rsync --info=progress2 output
+
+    These look like: 1,238,099  67%  2.39MB/s  0:00:03 (xfr#5, to-chk=0/9)
+
+    :param line: Line of rsync output.
+
+    :return: Tuple of bytes transferred so far, percent complete, rate,
+        and time left, or None if the line isn't progress.
+    """
+
+    match = re.match(r'\s*([\d,.]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d\d:\d\d)',
+        line
+    )
+
+    if not match:
+        return None
+
+    return (int(re.sub(r'[,.]', '', match.group(1))), int(match.group(2)),
+        match.group(3), match.group(4)
+    )
+
+
+def format_size(nbytes):
+    """
+    Describe a number of bytes in the largest sensible unit, like 1.5GB
+    """
+
+    size = float(nbytes)
+
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+
+    return '%.1f%s' % (size, unit) if unit != 'B' else '%dB' % size
+
+
+class ProgressFeed(object):
+    """
+    Pass the latest output of remote commands on to a job
+
+    Called with each line of progress. The last JOB_OUTPUT_LINES lines are
+    kept in a ring buffer, and written to the output column of the job at
+    most every JOB_OUTPUT_INTERVAL seconds, where the batch progress page
+    picks them up. Several threads may feed the same job at once. Without
+    a job, lines are simply discarded.
+    """
+
+    def __init__(self, job=None):
+        """
+        Initialize a progress feed
+
+        :param job: Job to report output to, if any.
+        """
+
+        self.job = job
+        self.lines = deque(maxlen=settings.JOB_OUTPUT_LINES)
+        self.reported = 0
+        self._lock = threading.Lock()
+
+
+    def __call__(self, line):
+        if not self.job:
+            return
+
+        with self._lock:
+            self.lines.append(line.strip())
+
+            if time.time() - self.reported < settings.JOB_OUTPUT_INTERVAL:
+                return
+
+            self.reported = time.time()
+            output = '\n'.join(self.lines)
+
+        self.job.report(output=output)
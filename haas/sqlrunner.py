@@ -0,0 +1,310 @@
+import Queue
+import csv
+import psycopg2
+import threading
+
+from django.conf import settings
+
+from haas.executor import FanOut
+from haas.pgpool import pg_pool
+
+
+__all__ = ['SQLRunner']
+
+# Statements starting with these keywords are read through a server-side
+# cursor, since DECLARE accepts nothing else. A WITH query may still modify
+# data, which DECLARE refuses, so those fall back to a plain cursor.
+# Anything else, like SHOW or EXPLAIN, runs on a plain cursor, and its rows
+# or command status are reported once it finishes.
+
+CURSOR_KEYWORDS = ('select', 'values', 'table', 'with')
+
+
+class SQLRunner(object):
+    """
+    Run one SQL statement on many instances at once, streaming the results
+
+    Every instance gets its own pooled connection and thread, within the
+    usual fan-out limits. Queries are read through server-side cursors in
+    batches, and rows are handed to the caller as soon as any instance
+    produces them. Since the hand-off queue is bounded, a slow reader
+    simply slows the queries down, and results are never all held in
+    memory at once. Statements Postgres can't declare a cursor for, like
+    SHOW, are read in full on each instance before being handed over.
+
+    Results from every instance are merged into one stream. Instances may
+    not all return the same columns, such as when they run different
+    Postgres versions, so the column names are kept for each instance.
+
+    Results can also be read a page at a time. Each page holds the same
+    window of rows from every instance, skipped and limited within each
+    server-side cursor.
+    """
+
+    def __init__(self, statement, timeout=None, workers=None, offset=0,
+        limit=None):
+        """
+        Initialize a fleet-wide SQL statement
+
+        :param statement: SQL to execute on every instance.
+        :param timeout: Statement timeout in seconds. Defaults to the
+            SQL_TIMEOUT setting.
+        :param workers: Instances to query at once. Defaults to the
+            SQL_WORKERS setting.
+        :param offset: Rows to skip on each instance.
+        :param limit: Most rows to read from each instance. Unlimited by
+            default.
+        """
+
+        self.statement = statement.strip().rstrip(';')
+        self.timeout = timeout or settings.SQL_TIMEOUT
+        self.workers = workers or settings.SQL_WORKERS
+        self.offset = offset
+        self.limit = limit
+        self.columns = {}
+        self.more = set()
+        self.truncated = set()
+
+        self._queue = Queue.Queue(maxsize=self.workers * 4)
+        self._cancelled = threading.Event()
+
+
+    def is_query(self):
+        """
+        Determine whether the statement can be read through a cursor
+
+        :return: True if rows should be fetched from a server-side cursor.
+        """
+
+        words = self.statement.split(None, 1)
+        return bool(words) and words[0].lower() in CURSOR_KEYWORDS
+
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+        raise Exception('Statement cancelled.')
+
+
+    def _execute(self, inst):
+        """
+        Execute the statement on one instance, queueing everything it returns
+        """
+
+        with pg_pool.connection(inst.server.hostname, inst.herd.db_port) as conn:
+            cur = conn.cursor()
+            cur.execute('SET statement_timeout = %s', [self.timeout * 1000])
+
+            try:
+                if self.is_query():
+
+                    # Server-side cursors only exist within a transaction,
+                    # which must never outlive this borrow of the connection.
+
+                    conn.autocommit = False
+                    cur = conn.cursor(name='haas_sql')
+
+                    try:
+                        cur.execute(self.statement)
+                    except psycopg2.NotSupportedError:
+                        conn.rollback()
+                        conn.autocommit = True
+                        cur = conn.cursor()
+                        cur.execute(self.statement)
+                else:
+                    cur.execute(self.statement)
+
+                if not cur.name and not cur.description:
+                    self.columns[inst.pk] = ['status']
+                    self._put((inst, (cur.statusmessage,), None))
+                    return
+
+                self._read(inst, cur)
+
+                cur.close()
+
+                if not conn.autocommit:
+                    conn.commit()
+
+            finally:
+                if not conn.closed:
+                    if not conn.autocommit:
+                        conn.rollback()
+                        conn.autocommit = True
+                    conn.cursor().execute('RESET statement_timeout')
+
+
+    def _read(self, inst, cur):
+        """
+        Queue the rows of one instance that fall within the page
+
+        One row past the page is read, to tell whether there are more. A
+        plain cursor already holds every row, but its statement may have
+        modified data, so it must not be run again for the next page.
+        Those rows are only cut off.
+        """
+
+        if self.offset:
+            if cur.name:
+                cur.scroll(self.offset)
+            else:
+                cur.fetchmany(self.offset)
+
+        remaining = self.limit
+
+        while True:
+            size = settings.SQL_FETCH_SIZE
+            if remaining is not None:
+                size = min(size, remaining + 1)
+
+            rows = cur.fetchmany(size)
+
+            if inst.pk not in self.columns and cur.description:
+                self.columns[inst.pk] = [c[0] for c in cur.description]
+
+            if not rows:
+                break
+
+            full = remaining is not None and len(rows) > remaining
+
+            for row in rows[:remaining]:
+                self._put((inst, row, None))
+
+            if full:
+                (self.more if cur.name else self.truncated).add(inst.pk)
+                break
+
+            if remaining is not None:
+                remaining -= len(rows)
+
+
+    def _dispatch(self, instances):
+
+        # Errors are passed along as soon as they happen, rather than when
+        # every instance has finished.
+
+        def execute(inst):
+            try:
+                self._execute(inst)
+            except Exception, e:
+                if not self._cancelled.is_set():
+                    self._put((inst, None, e))
+
+        try:
+            FanOut(workers=self.workers).map(execute, instances)
+        finally:
+            try:
+                self._put(None)
+            except Exception:
+                pass
+
+
+    def run(self, instances):
+        """
+        Execute the statement everywhere, yielding results as they arrive
+
+        Results are tuples of the instance, and either a row or the error
+        that instance raised. Rows from statements that don't return any
+        contain only the command status, such as "ANALYZE". The names of
+        the columns in an instance's rows are in the columns attribute,
+        by instance ID, by the time its first row arrives. If the caller
+        stops reading early, all outstanding queries are abandoned.
+
+        Once every result is read, the more attribute holds the IDs of the
+        instances with rows past the page, and truncated those with rows
+        past the page that can't be paged to.
+
+        :param instances: Iterable of Instance objects with herd and server.
+
+        :return: Generator of (instance, row, exception) tuples.
+        """
+
+        thread = threading.Thread(target=self._dispatch,
+            args=(list(instances),)
+        )
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                yield item
+
+        finally:
+            self._cancelled.set()
+
+
+    def run_csv(self, instances, on_error=None):
+        """
+        Execute the statement everywhere, producing CSV lines as results arrive
+
+        Each row is prefixed with the container and port of the instance it
+        came from. The header is produced along with the first row, since
+        that's when the column names become known. Whenever a row has
+        different columns than the last header, another header is produced
+        before it.
+
+        :param instances: Iterable of Instance objects with herd and server.
+        :param on_error: Function called with the instance and exception for
+            each failure. By default, failures become a row with the error
+            in place of the results.
+
+        :return: Generator of UTF-8 encoded CSV lines.
+        """
+
+        out = _LineBuffer()
+        writer = csv.writer(out)
+        header = None
+
+        for inst, row, e in self.run(instances):
+            if e and on_error:
+                on_error(inst, e)
+                continue
+
+            columns = self.columns.get(inst.pk, header or [])
+
+            if columns != header:
+                writer.writerow(['container', 'port'] + columns)
+                header = columns
+
+            writer.writerow([inst.server.hostname, inst.herd.db_port] + [
+                _encode(v) for v in (row or ['ERROR: %s' % e])
+            ])
+
+            yield out.flush()
+
+        if header is None:
+            writer.writerow(['container', 'port'] +
+                next(iter(self.columns.values()), [])
+            )
+            yield out.flush()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class _LineBuffer(object):
+    """
+    File-like object that holds whatever the CSV writer last wrote
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def flush(self):
+        data = ''.join(self.lines)
+        self.lines = []
+        return data
@@ -0,0 +1,291 @@
+import atexit
+import os
+import paramiko
+import threading
+import time
+
+from contextlib import contextmanager
+from django.conf import settings
+
+from haas import metrics
+
+
+__all__ = ['SSHPool', 'ssh_pool']
+
+class SSHPool(object):
+    """
+    Pool of authenticated SSH transports, one per remote host
+
+    Building a paramiko client means a TCP connection, a key exchange, and
+    an authentication handshake. For short commands like `test -d`, that
+    handshake costs far more than the command itself. This pool keeps one
+    authenticated transport for every host we talk to, and hands out new
+    channels on that transport instead. Each exec or SFTP session is its
+    own channel, so several can run over the same connection at once.
+
+    Pooled transports are subject to a few rules:
+
+    * Only max_sessions channels may be open on any one host at a time.
+      Further requests wait for a free slot. This should stay below the
+      MaxSessions setting of the remote sshd.
+    * Transports idle longer than idle_timeout seconds are closed.
+    * Keepalive packets are sent every keepalive seconds so firewalls
+      don't silently drop our idle connections.
+    * Transports are checked before reuse, and replaced if they died.
+    """
+
+    def __init__(self, username='postgres', max_sessions=None,
+        idle_timeout=None, keepalive=None, connect_options=None):
+        """
+        Initialize an SSH connection pool
+
+        Any limits not specified here are taken from the SSH_MAX_SESSIONS,
+        SSH_IDLE_TIMEOUT and SSH_KEEPALIVE settings.
+
+        :param username: OS user for all remote connections.
+        :param max_sessions: Maximum concurrent channels per host.
+        :param idle_timeout: Seconds before an unused transport is closed.
+        :param keepalive: Seconds between transport keepalive packets.
+        :param connect_options: Function of a host name returning extra
+            keyword arguments for paramiko's connect, such as a different
+            address, port or key to use for that host.
+        """
+
+        self.username = username
+        self.max_sessions = max_sessions or settings.SSH_MAX_SESSIONS
+        self.idle_timeout = idle_timeout or settings.SSH_IDLE_TIMEOUT
+        self.keepalive = keepalive or settings.SSH_KEEPALIVE
+        self.connect_options = connect_options
+
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+
+    def _host(self, hostname):
+        """
+        Get the pool entry for a host, creating it if necessary
+
+        Transports don't survive a fork, so if we find ourselves in a new
+        process, everything inherited from the parent is simply forgotten.
+        The parent still owns those sockets.
+
+        :param hostname: Name of the remote host.
+
+        :return: A _PoolHost tracking this host's transport.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._hosts = {}
+                self._pid = os.getpid()
+
+            if hostname not in self._hosts:
+                self._hosts[hostname] = _PoolHost(hostname, self.max_sessions)
+
+            return self._hosts[hostname]
+
+
+    def _connect(self, hostname):
+        """
+        Build a new authenticated SSH client for the given host
+
+        :param hostname: Name of the remote host.
+
+        :return: A connected paramiko.SSHClient.
+        """
+
+        started = time.time()
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        options = dict(hostname=hostname, username=self.username)
+
+        if self.connect_options:
+            options.update(self.connect_options(hostname))
+
+        client.connect(**options)
+        client.get_transport().set_keepalive(self.keepalive)
+
+        metrics.record_connect(hostname, time.time() - started)
+
+        return client
+
+
+    def reap(self):
+        """
+        Close any transports which have been idle for too long
+
+        This is called opportunistically whenever a session is requested,
+        so there's no need for a separate reaper thread.
+        """
+
+        cutoff = time.time() - self.idle_timeout
+
+        with self._lock:
+            hosts = self._hosts.values()
+
+        for host in hosts:
+            host.close_if_idle(cutoff)
+
+
+    def close_all(self):
+        """
+        Close every pooled transport
+        """
+
+        with self._lock:
+            hosts = self._hosts.values()
+            self._hosts = {}
+
+        for host in hosts:
+            host.close()
+
+
+    @contextmanager
+    def session(self, hostname):
+        """
+        Borrow a connected SSH client for one exec or SFTP session
+
+        The client is shared with other callers, so it must never be closed
+        by the borrower. Simply open a channel (exec_command, open_sftp,
+        etc.) and close that channel before the context exits.
+
+        If the borrower gets an SSH or socket error because the transport
+        died underneath us, the dead transport is discarded so the next
+        request reconnects. Errors that only affect the borrower's own
+        channel, like a refused session or a failed SFTP upload, leave the
+        transport alone, since other callers may be using it.
+
+        :param hostname: Name of the remote host.
+
+        :return: A paramiko.SSHClient with an active transport.
+        """
+
+        self.reap()
+        host = self._host(hostname)
+
+        host.slots.acquire()
+
+        try:
+            client = host.checkout(self._connect)
+        except:
+            host.slots.release()
+            raise
+
+        try:
+            yield client
+        except (paramiko.SSHException, EOFError, IOError):
+            host.discard_if_dead(client)
+            raise
+        finally:
+            host.checkin()
+            host.slots.release()
+
+
+class _PoolHost(object):
+    """
+    Connection state for a single pooled host
+
+    This is strictly a helper for SSHPool, and tracks the shared client,
+    the session slots available on it, and how long it has been idle.
+    """
+
+    def __init__(self, hostname, max_sessions):
+        self.hostname = hostname
+        self.slots = threading.BoundedSemaphore(max_sessions)
+        self.client = None
+        self.active = 0
+        self.last_used = time.time()
+        self._lock = threading.Lock()
+
+
+    def _healthy(self):
+        """
+        Determine whether the current transport can still be used
+
+        A transport that reports itself as active may still have been cut
+        off by a firewall. So we also send an ignore packet as a cheap
+        probe, which fails fast if the socket is dead and needs no reply.
+        """
+
+        if not self.client:
+            return False
+
+        transport = self.client.get_transport()
+
+        if not transport or not transport.is_active():
+            return False
+
+        if not transport.is_authenticated():
+            return False
+
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+
+        return transport.is_active()
+
+
+    def checkout(self, connect):
+        """
+        Get the shared client, reconnecting first if it's unhealthy
+
+        :param connect: Function to create a new client for this host.
+        """
+
+        with self._lock:
+            if not self._healthy():
+                self._close()
+                self.client = connect(self.hostname)
+
+            self.active += 1
+            self.last_used = time.time()
+            return self.client
+
+
+    def checkin(self):
+        with self._lock:
+            self.active -= 1
+            self.last_used = time.time()
+
+
+    def discard_if_dead(self, client):
+        """
+        Drop a client whose transport died, provided nobody replaced it
+        """
+
+        transport = client.get_transport()
+
+        if transport and transport.is_active():
+            return
+
+        with self._lock:
+            if self.client is client:
+                self._close()
+
+
+    def close_if_idle(self, cutoff):
+        with self._lock:
+            if self.active == 0 and self.last_used < cutoff:
+                self._close()
+
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+    def _close(self):
+        if self.client:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+
+        self.client = None
+
+
+ssh_pool = SSHPool()
+atexit.register(ssh_pool.close_all)
@@ -0,0 +1,665 @@
+import threading
+import time
+
+from cStringIO import StringIO
+from datetime import date
+
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from haas import discovery, inventory
+from haas.cmdtemplate import CommandTemplate
+from haas.datasync import ParallelSync
+from haas.executor import FanOut
+from haas.jobs import claim, enqueue
+from haas.models import (DisasterRecovery, Environment, Herd, Instance, Job,
+    RebuildCheckpoint, Server
+)
+
+
+class ChangelistQueryTest(TestCase):
+    """
+    Make sure changelists cost the same number of queries at any page size
+
+    Every related object shown in a row must be fetched along with the
+    rows themselves. Otherwise each row adds another query or two, and a
+    page of a few hundred instances takes a few hundred queries.
+    """
+
+    herds = 12
+
+    def setUp(self):
+        today = date.today()
+        stamps = dict(created_dt=today, modified_dt=today)
+
+        for n in range(self.herds):
+            env = Environment.objects.create(env_name='env%d' % n,
+                env_descr='', **stamps
+            )
+            herd = Herd.objects.create(environment=env, base_name='db%d' % n,
+                herd_name='herd%d' % n, herd_descr='', db_port=5432 + n,
+                pgdata='/db/herd%d' % n, vhost='herd%d-vhost' % n, **stamps
+            )
+            server = Server.objects.create(environment=env,
+                hostname='host%d' % n, **stamps
+            )
+            primary = Instance.objects.create(herd=herd, server=server,
+                version='9.6', is_online=True, xlog_pos=2048, **stamps
+            )
+            Instance.objects.create(herd=herd, server=server, version='9.6',
+                is_online=True, xlog_pos=1024, master=primary, **stamps
+            )
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+
+    def assertConstantQueries(self, model, url):
+        """
+        Render a changelist with a short and a long page, and compare
+        """
+
+        model_admin = site._registry[model]
+        per_page = model_admin.list_per_page
+
+        try:
+            model_admin.list_per_page = 2
+
+            with CaptureQueriesContext(connection) as short:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            model_admin.list_per_page = self.herds * 2
+
+            with self.assertNumQueries(len(short)):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+        finally:
+            model_admin.list_per_page = per_page
+
+
+    def test_instance_changelist(self):
+        self.assertConstantQueries(Instance, '/admin/haas/instance/')
+
+
+    def test_dr_changelist(self):
+        self.assertConstantQueries(DisasterRecovery,
+            '/admin/haas/disasterrecovery/'
+        )
+
+
+class FanOutTest(SimpleTestCase):
+    """
+    Make sure fan-out keeps results in order and honors every limit
+    """
+
+    def track(self, key=lambda item: item, delay=0.02):
+        """
+        Build a function recording the most items running at once
+
+        :return: The function, the overall peak, and the peak per key.
+        """
+
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+        total = [0, 0]
+
+        def func(item):
+            with lock:
+                running[key(item)] = running.get(key(item), 0) + 1
+                peaks[key(item)] = max(peaks.get(key(item), 0),
+                    running[key(item)]
+                )
+                total[0] += 1
+                total[1] = max(total)
+
+            time.sleep(delay)
+
+            with lock:
+                running[key(item)] -= 1
+                total[0] -= 1
+
+            return item
+
+        return func, total, peaks
+
+
+    def test_results_in_order(self):
+        def func(item):
+            time.sleep(0.01 * (5 - item))
+            if item == 3:
+                raise ValueError('three')
+            return item * 10
+
+        results = FanOut(5).map(func, range(5))
+
+        self.assertEqual([r[0] for r in results], range(5))
+        self.assertEqual([r[1] for r in results], [0, 10, 20, None, 40])
+        self.assertIsInstance(results[3][2], ValueError)
+        self.assertEqual([r[2] for r in results if r[0] != 3], [None] * 4)
+
+
+    def test_worker_limit(self):
+        func, total, peaks = self.track()
+        FanOut(3).map(func, range(12))
+
+        self.assertEqual(total[1], 3)
+
+
+    def test_keyed_limit(self):
+        func, total, peaks = self.track(key=lambda item: item[0])
+        items = [(host, n) for host in 'abc' for n in range(4)]
+
+        results = FanOut(10, [(lambda item: item[0], 2)]).map(func, items)
+
+        self.assertEqual([r[1] for r in results], items)
+        self.assertEqual(peaks, dict(a=2, b=2, c=2))
+        self.assertEqual(total[1], 6)
+
+
+    def test_every_limit_applies(self):
+        func, total, peaks = self.track(key=lambda item: item)
+        items = [(host, herd) for host in 'ab' for herd in 'xy'] * 2
+
+        FanOut(10, [
+            (lambda item: item[0], 2), (lambda item: item[1], 1)
+        ]).map(func, items)
+
+        self.assertEqual(total[1], 2)
+        self.assertEqual(max(peaks.values()), 1)
+
+
+    def test_busy_key_does_not_block(self):
+        later = threading.Event()
+
+        def func(item):
+            if item == 'b':
+                later.set()
+            else:
+                return later.wait(1)
+
+        results = FanOut(10, [(lambda item: item, 1)]).map(func,
+            ['a', 'a', 'b']
+        )
+
+        self.assertTrue(results[0][1])
+
+
+class PlanTest(SimpleTestCase):
+    """
+    Make sure a parallel sync divides its work evenly, and only once
+    """
+
+    def engine(self, listings, buckets):
+        engine = ParallelSync('source', 'target', streams=1, buckets=buckets)
+        engine.list_units = lambda root: listings[root]
+        return engine
+
+
+    def assertPlanned(self, buckets, roots, expected):
+        planned = sorted((roots[index][0], path) for bucket in buckets
+            for index, paths in bucket.items() for path in paths
+        )
+        self.assertEqual(planned, sorted(expected))
+
+
+    def test_balanced(self):
+        listing = [(size, 'base/%d' % size) for size in (1, 7, 3, 5, 2, 4)]
+        engine = self.engine({'/db': listing}, 2)
+
+        buckets = engine.plan([('/db', '/db')])
+
+        self.assertEqual(engine.loads, [11, 11])
+        self.assertEqual(sorted(buckets[0][0]), ['base/1', 'base/3', 'base/7'])
+        self.assertPlanned(buckets, [('/db', '/db')],
+            [('/db', path) for size, path in listing]
+        )
+
+
+    def test_biggest_first(self):
+        listing = [(1, 'a'), (1, 'b'), (1, 'c'), (9, 'd')]
+        engine = self.engine({'/db': listing}, 2)
+
+        buckets = engine.plan([('/db', '/db')])
+
+        self.assertEqual(buckets[0], {0: ['d']})
+        self.assertEqual(engine.loads, [9, 3])
+
+
+    def test_no_empty_buckets(self):
+        engine = self.engine({'/db': [(5, 'a'), (0, 'base')]}, 4)
+
+        buckets = engine.plan([('/db', '/db')])
+
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(engine.loads, [5, 0])
+
+        engine = self.engine({'/db': []}, 4)
+
+        self.assertEqual(engine.plan([('/db', '/db')]), [])
+        self.assertEqual(engine.loads, [])
+
+
+    def test_skip(self):
+        roots = [('/db', '/copy'), ('/ts', '/ts')]
+        engine = self.engine({
+            '/db': [(3, 'base/1'), (2, 'base/2'), (0, 'pg_tblspc')],
+            '/ts': [(4, 'base/1'), (1, 'base/2')],
+        }, 3)
+
+        buckets = engine.plan(roots, skip=set(['/db/base/1', '/ts/base/2']))
+
+        self.assertPlanned(buckets, roots, [
+            ('/db', 'base/2'), ('/db', 'pg_tblspc'), ('/ts', 'base/1')
+        ])
+        self.assertEqual(sum(engine.loads), 6)
+
+
+class CheckpointTest(TestCase):
+    """
+    Make sure copied files recorded by a rebuild are remembered
+    """
+
+    def test_copied(self):
+        today = date.today()
+        stamps = dict(created_dt=today, modified_dt=today)
+
+        herd = Herd.objects.create(base_name='db', herd_name='herd',
+            herd_descr='', db_port=5432, pgdata='/db', vhost='vhost', **stamps
+        )
+        server = Server.objects.create(hostname='host', **stamps)
+        primary = Instance.objects.create(herd=herd, server=server, **stamps)
+        replica = Instance.objects.create(herd=herd, server=server,
+            master=primary, **stamps
+        )
+
+        checkpoint = RebuildCheckpoint.objects.create(instance=replica,
+            source=primary, method='rsync'
+        )
+        checkpoint.add_copied(['/db/base/1', '/db/base/2'])
+        checkpoint.add_copied(['/db/base/3'])
+        checkpoint.add_copied([])
+
+        checkpoint = RebuildCheckpoint.objects.get(pk=checkpoint.pk)
+        self.assertEqual(checkpoint.copied(),
+            set(['/db/base/1', '/db/base/2', '/db/base/3'])
+        )
+
+        checkpoint.reset('backup')
+        checkpoint = RebuildCheckpoint.objects.get(pk=checkpoint.pk)
+        self.assertEqual(checkpoint.copied(), set())
+
+
+@override_settings(REBUILD_PER_SOURCE=4, REBUILD_PER_TARGET=4,
+    REBUILD_FROM_PEERS=False)
+class ClaimTest(TestCase):
+    """
+    Make sure queued copies never share the exclusive backup of a master
+    """
+
+    def setUp(self):
+        today = date.today()
+        stamps = dict(created_dt=today, modified_dt=today)
+
+        self.herd = Herd.objects.create(base_name='db', herd_name='herd',
+            herd_descr='', db_port=5432, pgdata='/db', vhost='vhost',
+            sync_method='rsync', **stamps
+        )
+        self.primary = Instance.objects.create(herd=self.herd,
+            server=Server.objects.create(hostname='primary', **stamps),
+            is_online=True, xlog_pos=1024, **stamps
+        )
+        self.replicas = [
+            Instance.objects.create(herd=self.herd,
+                server=Server.objects.create(hostname='replica%d' % n,
+                    **stamps
+                ),
+                master=self.primary, is_online=True, xlog_pos=1024, **stamps
+            ) for n in range(3)
+        ]
+
+
+    def claimed(self):
+        jobs = []
+
+        while True:
+            job = claim()
+            if not job:
+                return jobs
+            jobs.append(job)
+
+
+    def test_rsync(self):
+        enqueue('rebuild', self.replicas)
+
+        self.assertEqual(len(self.claimed()), 1)
+
+        Job.objects.filter(status='running').update(status='success')
+
+        self.assertEqual(len(self.claimed()), 1)
+
+
+    def test_basebackup(self):
+        Herd.objects.filter(pk=self.herd.pk).update(sync_method='basebackup')
+        enqueue('rebuild', self.replicas)
+
+        self.assertEqual(len(self.claimed()), 3)
+
+
+    def test_demote(self):
+        enqueue('demote', [self.primary])
+        enqueue('rebuild', self.replicas)
+
+        self.assertEqual([j.action for j in self.claimed()], ['demote'])
+
+
+    @override_settings(REBUILD_FROM_PEERS=True)
+    def test_peers(self):
+        enqueue('rebuild', self.replicas)
+
+        sources = [j.source_id for j in self.claimed()]
+
+        self.assertEqual(len(sources), 2)
+        self.assertEqual(sources.count(self.primary.pk), 1)
+
+
+class DiscoveryTest(TestCase):
+    """
+    Make sure server scans read probes correctly, and respect primaries
+    """
+
+    def setUp(self):
+        today = date.today()
+        self.stamps = dict(created_dt=today, modified_dt=today)
+
+        self.herd = Herd.objects.create(base_name='db', herd_name='herd',
+            herd_descr='', db_port=5432, pgdata='/db/main', vhost='vhost',
+            **self.stamps
+        )
+        self.probes = {}
+        self.execute = discovery.execute_remote_cmd
+        discovery.execute_remote_cmd = lambda host, script: self.probes[host]
+
+
+    def tearDown(self):
+        discovery.execute_remote_cmd = self.execute
+
+
+    def server(self, hostname, *clusters):
+        self.probes[hostname] = ''.join(
+            '\t'.join(cluster) + '\n' for cluster in clusters
+        )
+        return Server.objects.create(hostname=hostname, **self.stamps)
+
+
+    def test_probe(self):
+        server = self.server('host',
+            ('/db/main/', '9.6', '5432', '1', 'f', '0/3000060'),
+            ('/db/old', '9.4', '', '0', 't', ''),
+            ('/db/broken', '9.6'),
+        )
+
+        self.assertEqual(discovery.probe_server(server, ['/db']), [
+            dict(pgdata='/db/main', version='9.6', port=5432, is_online=True,
+                in_recovery=False, xlog_pos=0x3000060),
+            dict(pgdata='/db/old', version='9.4', port=None,
+                is_online=False, in_recovery=True, xlog_pos=None),
+        ])
+
+
+    def test_second_primary(self):
+        primary = Instance.objects.create(herd=self.herd,
+            server=self.server('primary'), is_online=True, **self.stamps
+        )
+        stale = self.server('stale',
+            ('/db/main', '9.6', '5432', '1', 'f', '0/100'),
+        )
+        replica = self.server('replica',
+            ('/db/main', '9.6', '5432', '1', 't', '0/200'),
+        )
+
+        report = discovery.scan_servers([stale, replica])
+
+        self.assertEqual([(s, h) for s, c, h in report['conflicts']],
+            [(stale, self.herd)]
+        )
+        self.assertEqual([(i.server, i.master) for i in report['created']],
+            [(replica, primary)]
+        )
+        self.assertFalse(Instance.objects.filter(server=stale).exists())
+
+
+    def test_new_herd(self):
+        offline = self.server('offline',
+            ('/db/main', '9.6', '5432', '0', 'f', ''),
+        )
+        online = self.server('online',
+            ('/db/main', '9.6', '5432', '1', 'f', '0/100'),
+        )
+        replica = self.server('replica',
+            ('/db/main', '9.6', '5432', '1', 't', '0/100'),
+        )
+
+        report = discovery.scan_servers([offline, online, replica])
+
+        primary = Instance.objects.get(master__isnull=True)
+
+        self.assertEqual(primary.server, online)
+        self.assertEqual([s for s, c, h in report['conflicts']], [offline])
+        self.assertEqual(Instance.objects.get(server=replica).master,
+            primary
+        )
+
+
+class InventoryTest(TestCase):
+    """
+    Make sure inventories import in order, and survive a round trip
+    """
+
+    herd = dict(kind='herd', herd_name='herd', environment='prod',
+        base_name='db', db_port=5432, pgdata='/db', vhost='vhost'
+    )
+
+    def records(self, *instances):
+        records = [
+            dict(kind='environment', env_name='prod', env_descr=''),
+            self.herd,
+        ]
+
+        for server, master in instances:
+            records += [
+                dict(kind='server', hostname=server, environment='prod'),
+                dict(kind='instance', herd='herd', environment='prod',
+                    server=server, master=master),
+            ]
+
+        return records
+
+
+    def masters(self):
+        return dict(
+            (i.server.hostname, i.master.server.hostname if i.master else '')
+            for i in Instance.objects.select_related('server',
+                'master__server'
+            )
+        )
+
+
+    def test_masters_first(self):
+        chain = [('leaf', 'middle'), ('middle', 'root'), ('root', '')]
+
+        summary = inventory.import_records(self.records(*chain), check=False)
+
+        self.assertEqual(summary['instance'], (3, 0))
+        self.assertEqual(self.masters(), dict(chain))
+
+        summary = inventory.import_records(self.records(*chain), check=False)
+
+        self.assertEqual(summary['instance'], (0, 0))
+
+
+    def test_missing_master(self):
+        records = self.records(('replica', 'nowhere'), ('root', ''))
+
+        with self.assertRaisesMessage(Exception, 'no master on nowhere'):
+            inventory.import_records(records, check=False)
+
+        self.assertFalse(Herd.objects.exists())
+
+
+    def test_no_environment(self):
+        herd = dict(self.herd, environment='')
+        records = [herd,
+            dict(kind='server', hostname='root', environment=''),
+            dict(kind='instance', herd='herd', environment='', server='root',
+                master=''),
+            dict(kind='server', hostname='replica'),
+            dict(kind='instance', herd='herd', server='replica',
+                master='root'),
+        ]
+
+        inventory.import_records(records, check=False)
+
+        self.assertEqual(Herd.objects.get().environment, None)
+        self.assertEqual(self.masters(), dict(root='', replica='root'))
+
+        for export, format in ((inventory.export_json, 'json'),
+            (inventory.export_csv, 'csv')):
+            data = ''.join(export(inventory.export_records()))
+
+            Instance.objects.all().delete()
+            Server.objects.all().delete()
+            Herd.objects.all().delete()
+
+            inventory.import_records(
+                inventory.read_records(StringIO(data), format), check=False
+            )
+
+            self.assertEqual(Herd.objects.get().environment, None)
+            self.assertEqual(self.masters(), dict(root='', replica='root'))
+
+
+class CommandTemplateTest(SimpleTestCase):
+    """
+    Make sure commands render as they always did, and bad ones are caught
+    """
+
+    debian = {
+        'base': 'pg_ctlcluster {version[0]}.{version[1]} '
+            '{inst.herd.base_name}',
+        'start': '{COMMANDS[base]} start',
+        'stop': '{COMMANDS[base]} stop -m fast',
+        'init': 'pg_createcluster {version[0]}.{version[1]} '
+            '{inst.herd.base_name} -D {pgdata} -p {inst.herd.db_port}',
+    }
+
+    pg_ctl = {
+        'base': '/usr/pgsql-{version[0]}.{version[1]}/bin/pg_ctl -D {pgdata}',
+        'promote': '{COMMANDS[base]} promote',
+        'controldata': '/usr/pgsql-{version[0]}.{version[1]}/bin/'
+            'pg_controldata {pgdata}',
+    }
+
+    def setUp(self):
+        herd = Herd(base_name='main', db_port=5433, pgdata='/db/main')
+        self.instances = [
+            Instance(herd=herd, server=Server(hostname='host'),
+                version='9.6.3'),
+            Instance(herd=herd, server=Server(hostname='host'),
+                version='10.1', local_pgdata='/alt/main'),
+        ]
+
+
+    def legacy(self, commands, name, inst):
+        """
+        Render a command the way PGUtility did before templates
+        """
+
+        command = commands.get(name, '')
+
+        try:
+            command = command.format(COMMANDS = commands)
+        except KeyError:
+            pass
+
+        return command.format(inst = inst,
+            pgdata = (inst.local_pgdata or inst.herd.pgdata),
+            version = inst.version.split('.')
+        )
+
+
+    def assertInvalid(self, commands, name, message):
+        with self.assertRaisesMessage(ImproperlyConfigured, message):
+            CommandTemplate(name, commands)
+
+
+    def test_same_as_before(self):
+        for commands in (self.debian, self.pg_ctl):
+            for name in commands:
+                template = CommandTemplate(name, commands)
+
+                for inst in self.instances:
+                    self.assertEqual(template.render(inst),
+                        self.legacy(commands, name, inst)
+                    )
+
+
+    def test_macros(self):
+        commands = dict(self.pg_ctl,
+            status='{COMMANDS[base]} -p {inst.herd.db_port} status',
+            braces='echo {{{inst.server.hostname}}}',
+        )
+
+        self.assertEqual(
+            CommandTemplate('status', commands).render(self.instances[1]),
+            '/usr/pgsql-10.1/bin/pg_ctl -D /alt/main -p 5433 status'
+        )
+        self.assertEqual(
+            CommandTemplate('braces', commands).render(self.instances[0]),
+            'echo {host}'
+        )
+
+
+    def test_macro_loop(self):
+        self.assertInvalid({'a': '{COMMANDS[b]}', 'b': 'x {COMMANDS[a]}'},
+            'a', 'macro loop through a -> b -> a.'
+        )
+        self.assertInvalid({'a': '{COMMANDS[a]}'}, 'a',
+            'macro loop through a -> a.'
+        )
+
+
+    def test_bad_macro(self):
+        self.assertInvalid({'a': '{COMMANDS[nope]}'}, 'a',
+            'no such command: nope.'
+        )
+        self.assertInvalid({'a': '{COMMANDS.base}'}, 'a',
+            'macros must look like {COMMANDS[name]}.'
+        )
+
+
+    def test_unknown_variable(self):
+        self.assertInvalid({'a': 'echo {host}'}, 'a', 'unknown variable host.')
+        self.assertInvalid({'a': 'echo {}'}, 'a', 'positional fields')
+
+
+    def test_unknown_field(self):
+        self.assertInvalid({'a': '{inst.herd.nope}'}, 'a',
+            'Herd has no field nope in {inst.herd.nope}.'
+        )
+        self.assertInvalid({'a': '{inst.sever.hostname}'}, 'a',
+            'Instance has no field sever'
+        )
+        self.assertInvalid({'a': '{version.major}'}, 'a',
+            'no attribute major in {version.major}.'
+        )
+        self.assertInvalid({'a': '{version[major]}'}, 'a',
+            'cannot look up [major] in {version[major]}.'
+        )
+        self.assertInvalid({'a': '{pgdata!x}'}, 'a', 'unknown conversion !x.')
@@ -0,0 +1,181 @@
+import re
+import threading
+import time
+
+from django.utils import timezone
+
+from haas.models import TraceSpan
+
+
+__all__ = ['add_bytes', 'current', 'record_command', 'rsync_bytes', 'span',
+    'within',
+]
+
+_local = threading.local()
+
+
+def current():
+    """
+    Get the innermost span the current thread is working in
+
+    :return: A span, or None if nothing is being traced.
+    """
+
+    return getattr(_local, 'span', None)
+
+
+class span(object):
+    """
+    Record one phase of a job as a TraceSpan
+
+    Used as a context manager. The span is saved as soon as it starts, so
+    phases still in progress can be seen, and completed when it ends.
+    Spans opened inside another span, even in threads started by FanOut,
+    become part of it and belong to the same job. Outside of any span,
+    nothing is recorded unless a job is given, so actions run without a
+    job aren't traced at all.
+
+    A phase that raises an exception still ends, and keeps the error.
+    """
+
+    def __init__(self, name, host=None, job=None):
+        """
+        Initialize a span
+
+        :param name: Short phase name, such as 'stop' or 'base_rsync'.
+        :param host: Host the phase mainly runs on, if any.
+        :param job: Job to record the span for. Defaults to the job of the
+            enclosing span.
+        """
+
+        self.name = name
+        self.host = host or ''
+        self.job = job
+        self.record = None
+        self.bytes = None
+        self.commands = 0
+        self.exit_status = None
+        self._lock = threading.Lock()
+
+
+    def __enter__(self):
+        self.parent = current()
+
+        job_id = self.job.pk if self.job else None
+        if not job_id and self.parent:
+            job_id = self.parent.record.job_id
+
+        if not job_id:
+            return self
+
+        self.record = TraceSpan.objects.create(job_id=job_id,
+            parent=self.parent.record if self.parent else None,
+            name=self.name, host=self.host, started_dt=timezone.now()
+        )
+
+        self.started = time.time()
+        _local.span = self
+
+        return self
+
+
+    def __exit__(self, kind, exc, tb):
+        if not self.record:
+            return
+
+        _local.span = self.parent
+
+        with self._lock:
+            TraceSpan.objects.filter(pk=self.record.pk).update(
+                seconds=round(time.time() - self.started, 3),
+                bytes=self.bytes, commands=self.commands,
+                exit_status=self.exit_status,
+                error=str(exc).strip() if exc else ''
+            )
+
+
+    def add_bytes(self, nbytes):
+        """
+        Count bytes copied during this span and every span enclosing it
+        """
+
+        node = self
+
+        while node:
+            with node._lock:
+                node.bytes = (node.bytes or 0) + nbytes
+            node = node.parent
+
+
+class within(object):
+    """
+    Continue a span in another thread
+
+    Used as a context manager by FanOut, so work done by its threads is
+    traced in whatever span started it. A span of None does nothing.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+
+
+    def __enter__(self):
+        if self.parent:
+            self.previous = current()
+            _local.span = self.parent
+
+
+    def __exit__(self, *exc):
+        if self.parent:
+            _local.span = self.previous
+
+
+def record_command(status):
+    """
+    Count a remote command in the current span, if any
+
+    The span keeps the exit status of the last command it ran. When a
+    phase fails, that's the command which failed it.
+
+    :param status: Exit status of the command.
+    """
+
+    node = current()
+
+    if node:
+        with node._lock:
+            node.commands += 1
+            node.exit_status = status
+
+
+def add_bytes(nbytes):
+    """
+    Count bytes copied in the current span, if any
+
+    :param nbytes: Number of bytes, or None if unknown.
+    """
+
+    if current() and nbytes is not None:
+        current().add_bytes(nbytes)
+
+
+def rsync_bytes(output):
+    """
+    Find the number of bytes received in the output of rsync --stats
+
+    rsync runs on the receiving host, so this is the amount of data that
+    actually crossed the network, after any compression.
+
+    :param output: Output of an rsync command.
+
+    :return: Number of bytes, or None if rsync didn't report it.
+    """
+
+    match = re.search(r'^Total bytes received: ([\d,.]+)', output or '',
+        re.M
+    )
+
+    if not match:
+        return None
+
+    return int(re.sub(r'[,.]', '', match.group(1)))
@@ -1,17 +1,85 @@
 import os
 import re
-import paramiko
 import tempfile
+import threading
 import time
 
-from haas.models import Instance
+from haas import metrics, tracing
+from haas.cmdtemplate import render_command
+from haas.progress import ProgressFeed, stream_channel
+from haas.models import Instance, RebuildCheckpoint
+from haas.sshpool import ssh_pool
 from django.db.models import Count
 from django.conf import settings
 
 
-__all__ = ['execute_remote_cmd', 'PGUtility']
+__all__ = ['execute_remote_cmd', 'lsn_to_int', 'PGUtility',
+    'RSYNC_VANISHED_OK'
+]
 
-def execute_remote_cmd(hostname, command):
+# rsync exits with 24 when source files vanish while it runs. In a live data
+# directory that's routine, as temporary files and dropped relations are
+# removed, and the WAL replayed afterwards covers them anyway. Appended to
+# an rsync command, this treats that status as success. Warnings go to
+# standard output, so they don't count as errors either.
+
+RSYNC_VANISHED_OK = ' 2>&1 || { status=$?; ' \
+    '[ $status -eq 24 ] || exit $status; }'
+
+def lsn_to_int(lsn):
+    """
+    Convert a Postgres LSN like '16/B374D848' into a comparable integer
+
+    :param lsn: String LSN as reported by Postgres.
+
+    :return: Integer byte position of the LSN, or None if not an LSN.
+    """
+
+    try:
+        high, low = lsn.strip().split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+def wait_for(check, timeout, what):
+    """
+    Poll a check function with backoff until it succeeds or time runs out
+
+    The first retry comes quickly, since most waits are short when things
+    are healthy. After that, the delay doubles up to a five second cap so
+    we don't hammer a server that's still busy.
+
+    :param check: Function returning a true value once the wait is over.
+        Exceptions are treated as "not yet".
+    :param timeout: Seconds to wait before giving up.
+    :param what: Description of the wait, for the timeout error.
+
+    :raise: Exception if the deadline passes before check succeeds.
+    :return: The first true value returned by check.
+    """
+
+    deadline = time.time() + timeout
+    delay = 0.25
+
+    while True:
+        try:
+            result = check()
+            if result:
+                return result
+        except Exception:
+            pass
+
+        if time.time() + delay > deadline:
+            raise Exception('Timed out after %ds waiting for %s.' % (
+                timeout, what
+            ))
+
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+def execute_remote_cmd(hostname, command, name=None, progress=None):
     """
     Execute a command on a host via SSH
 
@@ -19,24 +87,56 @@ def execute_remote_cmd(hostname, command):
     For now, we also assume the postgres system user will be running
     these commands on the remote hosts.
 
+    Commands run on a new channel of a pooled connection to the host, so
+    only the first command sent to a host pays for the SSH handshake.
+    Every command is timed and counted in haas.metrics, and its exit status
+    is kept by the current trace span, if any.
+
+    Long commands may stream their output instead. Lines are passed to a
+    progress function as they arrive, and only the last few lines are kept
+    for the result, so memory use doesn't grow with the output. See
+    haas.progress.
+
     :param command: Full command to execute remotely.
+    :param name: Name of the command, for metrics. Defaults to the name of
+        the program being run.
+    :param progress: Function called with each line of output as it
+        arrives. Streams the output if given.
 
     :raise: Exception output obtained from STDERR, if any.
     """
 
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname, username='postgres')
-    stdin, stdout, stderr = client.exec_command(command)
-    err = stderr.read()
-    client.close()
+    name = name or metrics.command_name(command)
+
+    with ssh_pool.session(hostname) as client:
+        started = time.time()
+        failed = True
+
+        try:
+            stdin, stdout, stderr = client.exec_command(command)
+
+            if progress:
+                out, err, status = stream_channel(stdout.channel, progress)
+            else:
+                out = stdout.read()
+                err = stderr.read()
+                status = stdout.channel.recv_exit_status()
+
+            stdout.channel.close()
+            failed = bool(err) or status > 0
+        finally:
+            metrics.record_command(hostname, name, time.time() - started,
+                failed
+            )
+
+    tracing.record_command(status)
 
     if err:
         raise Exception(err)
-    elif stdout.channel.recv_exit_status() > 0:
-        raise Exception(stdout.read())
+    elif status > 0:
+        raise Exception(out)
 
-    return stdout.read()
+    return out
 
 
 class PGUtility():
@@ -53,8 +153,9 @@ class PGUtility():
     """
 
     instance = None
+    job = None
 
-    def __init__(self, instance):
+    def __init__(self, instance, job=None):
         """
         Initialize an admin utility
 
@@ -62,8 +163,44 @@ class PGUtility():
         model. Actions must always affect an instance in some way.
         
         :param instance: Django instance model to tie to admin actions.
+        :param job: Background job to report progress to, if any.
         """
         self.instance = instance
+        self.job = job
+
+
+    def report(self, progress, message):
+        """
+        Report progress of a long-running operation to our job, if any
+
+        Any output from the previous step is cleared, since it no longer
+        describes what the job is doing.
+
+        :param progress: Approximate percentage complete.
+        :param message: Short description of the current step.
+        """
+
+        if self.job:
+            self.job.report(progress, message, output='')
+
+
+    def trace(self, name, host=None):
+        """
+        Trace one phase of an operation on this instance
+
+        Phases are only recorded for operations running as a job, or
+        within a phase of one. See haas.tracing.span.
+
+        :param name: Short phase name.
+        :param host: Host the phase runs on. Defaults to the host of this
+            instance.
+
+        :return: A span, to be used as a context manager.
+        """
+
+        return tracing.span(name, host or self.instance.server.hostname,
+            self.job
+        )
 
 
     def __get_cmd(self, cmd_name):
@@ -81,50 +218,287 @@ class PGUtility():
         * COMMANDS: The COMMANDS dict itself, in case the user defined
               their own macros.
 
+        Templates are compiled and checked once at startup, so this only
+        fills in the variables. See haas.cmdtemplate.
+
         :param cmd_name: Name of the configured command to retrieve
 
         :return: String output of the command, if any, or an empty string.
         """
 
-        full_cmd = ''
+        return render_command(cmd_name, self.instance)
 
-        if cmd_name in settings.COMMANDS:
-            full_cmd = settings.COMMANDS[cmd_name]
 
-        inst = self.instance
+    def __run_cmd(self, command, name=None, progress=None):
+        """
+        Execute a command on this instance's host via SSH
+
+        This is mainly just a wrapper for execute_command that subs the
+        host name of the current instance.
+
+        :param command: Full command to execute remotely.
+        :param name: Name of the command in COMMANDS, if it came from there.
+        :param progress: Function called with each line of output, for
+            commands that should stream it.
+
+        :raise: Exception output obtained from STDERR, if any.
+        :return: String output from the command, if any.
+        """
+
+        return execute_remote_cmd(self.instance.server.hostname, command,
+            name, progress
+        )
+
+
+    def __rsync_progress(self):
+        """
+        Get the rsync options and progress function for a long copy
+
+        rsync reports its overall progress if RSYNC_PROGRESS is enabled,
+        and the output is streamed to our job, if any. Output is streamed
+        even without a job, so it never piles up in memory.
+
+        :return: Tuple of extra rsync options, and a ProgressFeed.
+        """
+
+        options = ' --info=progress2' if settings.RSYNC_PROGRESS else ''
+        return (options, ProgressFeed(self.job))
+
+
+    def __query(self, query):
+        """
+        Run a query on this instance through psql over SSH
+
+        Like start_backup, this relies on the postgres OS user rather than
+        any specific database superuser.
+
+        :param query: SQL to execute. Must not contain double quotes.
+
+        :return: Unaligned, tuples-only query output.
+        """
+
+        return self.__run_cmd('psql -p %d -At -c "%s" postgres' % (
+            self.instance.herd.db_port, query
+        )).strip()
+
+
+    def __wal_function(self, modern, legacy):
+        """
+        Pick a WAL function name depending on the Postgres version
+
+        Postgres 10 renamed all of the xlog/location functions to wal/lsn.
+        """
 
-        # Start by injecting any defined macros so they're unrolled before
-        # we replace actual variables. Then it's safe to format the instance
-        # pgdata, and other provided variables.
+        return modern if self.__version() >= (10,) else legacy
+
+
+    def __version(self):
+        """
+        Get the Postgres version of this instance as a comparable tuple
+
+        :return: Tuple of version parts, such as (9, 6) or (10,), or (0,)
+            if the version is unknown.
+        """
 
         try:
-            full_cmd = full_cmd.format(COMMANDS = settings.COMMANDS)
-        except KeyError:
-            pass
+            return tuple(int(p) for p in self.instance.version.split('.'))
+        except (AttributeError, ValueError):
+            return (0,)
+
+
+    def get_replay_lsn(self):
+        """
+        Get the last WAL position replayed by this replica
+
+        :return: Integer LSN, or None if unknown.
+        """
 
-        full_cmd = full_cmd.format(
-            inst = inst,
-            pgdata = (inst.local_pgdata or inst.herd.pgdata),
-            version = inst.version.split('.')
+        func = self.__wal_function('pg_last_wal_replay_lsn',
+            'pg_last_xlog_replay_location'
         )
+        return lsn_to_int(self.__query('SELECT %s()' % func))
 
-        return full_cmd
 
+    def get_receive_lsn(self):
+        """
+        Get the last WAL position received by this replica
 
-    def __run_cmd(self, command):
+        :return: Integer LSN, or None if unknown.
         """
-        Execute a command on this instance's host via SSH
 
-        This is mainly just a wrapper for execute_command that subs the
-        host name of the current instance.
+        func = self.__wal_function('pg_last_wal_receive_lsn',
+            'pg_last_xlog_receive_location'
+        )
+        return lsn_to_int(self.__query('SELECT %s()' % func))
 
-        :param command: Full command to execute remotely.
 
-        :raise: Exception output obtained from STDERR, if any.
-        :return: String output from the command, if any.
+    def get_checkpoint_lsn(self):
         """
+        Get the location of the last checkpoint from the control file
+
+        After a clean shutdown, this is the shutdown checkpoint, which is
+        the very last thing the instance wrote. A replica that has replayed
+        past this point has everything the old primary ever had. Since we
+        read pg_controldata, this works while the instance is stopped.
+
+        :return: Integer LSN, or None if it could not be determined.
+        """
+
+        return self.__controldata().get('Latest checkpoint location')
+
+
+    def get_recovered_lsn(self):
+        """
+        Get a WAL position this replica has certainly replayed
+
+        Replicas running with hot_standby off can't be queried, so this
+        reads pg_controldata instead. Both the last restartpoint and the
+        minimum recovery point only ever trail the actual replay position,
+        so the result may be somewhat behind, but never ahead.
+
+        :return: Integer LSN, or None if it could not be determined.
+        """
+
+        control = self.__controldata()
+        found = [control.get('Latest checkpoint location'),
+            control.get('Minimum recovery ending location')
+        ]
+
+        return max(found) if any(found) else None
+
+
+    def __controldata(self):
+        """
+        Read every WAL position reported by pg_controldata
+
+        :return: Dict of integer LSNs keyed by their pg_controldata label.
+        """
+
+        inst = self.instance
+        cmd = self.__get_cmd('controldata') or 'pg_controldata %s' % (
+            inst.local_pgdata or inst.herd.pgdata
+        )
+
+        control = {}
+
+        for line in self.__run_cmd(cmd, 'controldata').splitlines():
+            label, sep, value = line.partition(':')
+            if sep and lsn_to_int(value) is not None:
+                control[label.strip()] = lsn_to_int(value)
+
+        return control
+
+
+    def create_slot(self):
+        """
+        Make sure our upstream master keeps a replication slot for us
+
+        A slot stops the master from recycling WAL this replica hasn't
+        received yet, so a replica that falls behind, or is stopped for a
+        while, can still catch up by streaming rather than be rebuilt.
+        Where possible, the slot reserves WAL as soon as it's created, so
+        nothing is lost while the replica is being rebuilt.
+
+        Nothing is done unless the herd uses slots, and the master is
+        recent enough to have them.
+
+        :raises: Exception if the slot could not be created.
+        :return: Name of the slot, or None if no slot is used.
+        """
+
+        inst = self.instance
+
+        if not inst.master or not inst.herd.use_slots:
+            return None
+
+        upstream = PGUtility(inst.master)
+
+        if upstream.__version() < (9, 4):
+            return None
+
+        reserve = ', true' if upstream.__version() >= (9, 6) else ''
+
+        upstream.__query(
+            "SELECT pg_create_physical_replication_slot('%s'%s)"
+            " WHERE NOT EXISTS (SELECT 1 FROM pg_replication_slots"
+            " WHERE slot_name = '%s')" % (inst.slot_name, reserve,
+                inst.slot_name
+            )
+        )
+
+        return inst.slot_name
+
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until this instance accepts connections
+
+        Replicas running with hot_standby off never accept connections, so
+        for those, a server that's up but rejecting connections is as ready
+        as it will get.
+
+        :param timeout: Seconds to wait. Defaults to the WAIT_READY_TIMEOUT
+            setting.
+
+        :raises: Exception if the instance isn't ready in time.
+        """
+
+        inst = self.instance
+
+        def ready():
+            try:
+                self.__run_cmd('pg_isready -p %d' % inst.herd.db_port)
+            except Exception, e:
+                if not inst.master_id or not 'rejecting' in str(e):
+                    raise
+
+            return True
+
+        wait_for(ready, timeout or settings.WAIT_READY_TIMEOUT,
+            '%s to accept connections' % inst
+        )
+
+
+    def wait_for_lsn(self, target=None, timeout=None):
+        """
+        Wait until this replica has replayed WAL up to a given position
+
+        If no target is given, we wait for the replica to replay everything
+        it has received so far. That's the best we can do when the upstream
+        is unreachable.
 
-        return execute_remote_cmd(self.instance.server.hostname, command)
+        If the replica can't be queried, because it runs with hot_standby
+        off, its progress is read from pg_controldata instead. That trails
+        the real replay position a bit, so this may wait longer than it
+        strictly has to. Without a target, there's no way to tell what
+        such a replica has received, so it's taken to have caught up once
+        it's reachable at all.
+
+        :param target: Integer LSN the replica must reach.
+        :param timeout: Seconds to wait. Defaults to the
+            WAIT_CATCHUP_TIMEOUT setting.
+
+        :raises: Exception if the replica is still behind at the deadline.
+        """
+
+        def caught_up():
+            try:
+                goal = target or self.get_receive_lsn()
+                replayed = self.get_replay_lsn()
+            except Exception:
+                recovered = self.get_recovered_lsn()
+                return recovered is not None and (
+                    not target or recovered >= target
+                )
+
+            return goal is not None and replayed >= goal
+
+        try:
+            wait_for(caught_up, timeout or settings.WAIT_CATCHUP_TIMEOUT,
+                '%s to catch up' % self.instance
+            )
+        except Exception:
+            raise Exception('%s is still behind its upstream!' % self.instance)
 
 
     def receive_file(self, source, dest):
@@ -134,6 +508,7 @@ class PGUtility():
         We transmit the indicated file to the target location. Any errors
         are simply passed along. In addition, the postgres system user is
         currently assumed as the target file owner.
+        The transfer is timed and counted in haas.metrics.
 
         :param source: Name of file to send to indicated host.
         :param dest: Full path on host to send file.
@@ -141,13 +516,19 @@ class PGUtility():
         :raise: Exception output obtained from secure transmission, if any.
         """
 
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(self.instance.server.hostname, username='postgres')
-        sftp = client.open_sftp()
-        sftp.put(source, dest)
-        sftp.close()
-        client.close()
+        hostname = self.instance.server.hostname
+
+        with ssh_pool.session(hostname) as client:
+            started = time.time()
+            sftp = client.open_sftp()
+            try:
+                sftp.put(source, dest)
+            finally:
+                sftp.close()
+
+        metrics.record_transfer(hostname, os.path.getsize(source),
+            time.time() - started
+        )
 
 
     def start(self):
@@ -165,7 +546,7 @@ class PGUtility():
             # we don't want to error out. Just act like it worked.
 
             try:
-                self.__run_cmd(self.__get_cmd('start'))
+                self.__run_cmd(self.__get_cmd('start'), 'start')
             except Exception, e:
                 if not 'already running' in str(e):
                     raise
@@ -225,7 +606,7 @@ class PGUtility():
             # online, we don't want to error out. Just act like it worked.
 
             try:
-                self.__run_cmd(self.__get_cmd('stop'))
+                self.__run_cmd(self.__get_cmd('stop'), 'stop')
             except Exception, e:
                 if not 'not running' in str(e) and not 'not exist' in str(e):
                     raise
@@ -234,6 +615,23 @@ class PGUtility():
         inst.save()
 
 
+    def backup_started(self):
+        """
+        Identify the exclusive backup running on this instance, if any
+
+        Every backup has its own start time, so if this changes, the
+        backup was stopped and started again in the meantime.
+
+        :return: Start time of the backup as reported by Postgres, or an
+            empty string if no backup is running, or we couldn't tell.
+        """
+
+        try:
+            return self.__query('SELECT pg_backup_start_time()')
+        except Exception:
+            return ''
+
+
     def stop_backup(self):
         """
         Take a running Postgres instance out of backup mode.
@@ -279,10 +677,10 @@ class PGUtility():
         if not inst.is_online:
             return
 
-        self.__run_cmd(self.__get_cmd('reload'))
+        self.__run_cmd(self.__get_cmd('reload'), 'reload')
 
 
-    def master_sync(self):
+    def master_sync(self, source=None):
         """
         Synchronize this instance with its upstream master
 
@@ -298,10 +696,55 @@ class PGUtility():
         purposes. This ensures the replication stream is as fresh as possible
         since a checkpoint took place before the sync started.
 
+        Herds may instead choose to always use rsync, or to stream a fresh
+        copy with pg_basebackup. See the herd sync_method field.
+
+        The bulk copy may also come from another replica of the same master
+        instead, to spare the master the extra reads. Replicas can't enter
+        backup mode, so such copies always use pg_basebackup, as do copies
+        for cascaded replicas whose master is itself a replica. The rebuilt
+        instance still follows its master, and catches up from it once
+        started.
+
+        Every completed phase is recorded in a RebuildCheckpoint, along
+        with every file copied by a parallel rsync. If the rebuild fails and
+        is tried again from the same source, completed phases are skipped,
+        and the copy continues where it stopped, so long as the master is
+        still in the same backup. When running as a job, every phase is
+        traced as well, along with the bytes each rsync received.
+
+        :param source: Instance to copy data from, if not the upstream
+            master.
+
         :raises: Exception if the instance could not be synchronized.
         """
 
         inst = self.instance
+        method = inst.herd.sync_method
+
+        if source and source.pk == inst.master_id:
+            source = None
+
+        # A cascaded replica copies from the replica it follows, which
+        # can't enter backup mode either.
+
+        if not source and inst.master.master_id:
+            source = inst.master
+
+        checkpoint = self.__checkpoint(source or inst.master, method)
+
+        # Copies with rsync need the master to be in backup mode, and it can
+        # only be in one backup at a time. If another copy is using it, say
+        # so now, rather than once this instance is already stopped.
+
+        if not source and method != 'basebackup' and \
+            not checkpoint.done('base') and not checkpoint.done('rewound'):
+            running = PGUtility(inst.master).backup_started()
+
+            if running and running != checkpoint.backup_start:
+                raise Exception('%s is already in backup mode for another '
+                    'copy.' % inst.master.server.hostname
+                )
 
         # If the instance is online, stop it so we don't synchronize open
         # files. That would be bad, Mmmkay? While we're at it, we should
@@ -309,7 +752,16 @@ class PGUtility():
         # which can slow down the transfers.
 
         if inst.is_online:
-            self.stop()
+            self.report(5, 'Stopping instance')
+            with self.trace('stop'):
+                self.stop()
+
+        # Create our slot before copying anything, so the master keeps all
+        # WAL written during the copy until we start streaming it.
+
+        if inst.herd.use_slots:
+            with self.trace('slot', inst.master.server.hostname):
+                self.create_slot()
 
         primary_dir = inst.master.local_pgdata or inst.herd.pgdata
         replica_dir = inst.local_pgdata or inst.herd.pgdata
@@ -320,42 +772,45 @@ class PGUtility():
         # down cleanly. That's a lot of caveats, but if it works, we save a
         # substantial amount of time and resources.
 
-        try:
-            rewind = "pg_rewind -D %s"
-            rewind += " --source-server='host=%s port=%s dbname=%s user=%s'"
+        rewound = checkpoint.done('rewound')
 
-            self.__run_cmd(rewind % (
-                replica_dir, inst.herd.vhost, inst.herd.db_port,
-                'postgres', 'replication'
-            ))
+        if method == 'rewind' and not checkpoint.done('rewind'):
+            try:
+                self.report(10, 'Attempting pg_rewind')
+                rewind = "pg_rewind -D %s"
+                rewind += " --source-server='host=%s port=%s dbname=%s user=%s'"
 
-        # If the rewind failed, revert to a standard rsync rebuild of the
-        # replica.
+                with self.trace('rewind'):
+                    self.__run_cmd(rewind % (
+                        replica_dir, inst.herd.vhost, inst.herd.db_port,
+                        'postgres', 'replication'
+                    ))
+                rewound = True
 
-        except:
+            # If the rewind failed, revert to a standard rsync rebuild of the
+            # replica.
 
-            master = PGUtility(inst.master)
+            except:
+                pass
 
-            xlog_mask = os.path.join('pg_xlog', '*')
+            if rewound:
+                checkpoint.complete('rewound')
+            checkpoint.complete('rewind')
 
-            sync = 'rsync -K -a --rsh=ssh -W --delete'
-            sync += ' --exclude=recovery.conf'
-            sync += ' --exclude=%s'
-            sync += ' --exclude=postmaster.*'
-            sync += ' postgres@%s:%s %s'
+        # A base backup can't be resumed part way through, so it's either
+        # done or started over.
 
-            # Put the master into backup mode before starting the sync. This
-            # triggers an implicit checkpoint so all dirty buffers are written
-            # before the sync starts.
+        if source and not rewound:
+            method = 'basebackup'
 
-            master.start_backup()
-
-            self.__run_cmd(sync % (
-                xlog_mask, inst.master.server.hostname, primary_dir, 
-                os.path.dirname(replica_dir)
-            ))
+        if rewound or checkpoint.done('base'):
+            pass
+        elif method == 'basebackup':
+            self.__basebackup_rebuild(replica_dir, source)
+        else:
+            self.__rsync_rebuild(primary_dir, replica_dir, checkpoint)
 
-            master.stop_backup()
+        checkpoint.complete('base')
 
         # Post sync, we need a new recovery.conf file. There's also a chance 
         # the sync is due to an upstream upgrade, in which case the new
@@ -363,7 +818,9 @@ class PGUtility():
         # we should copy the version from our primary before continuing.
         # This includes our own instance so methods get correct info.
 
-        self.update_stream_config()
+        with self.trace('recovery_conf'):
+            self.update_stream_config()
+
         inst.version = inst.master.version
         inst.save()
 
@@ -381,35 +838,296 @@ class PGUtility():
             os.sep, 'etc', 'postgresql', ver, inst.herd.base_name
         )
 
-        sync = 'rsync -a --rsh=ssh postgres@%s:%s %s'
+        sync = 'rsync -a --rsh=ssh --stats postgres@%s:%s %s'
 
-        self.__run_cmd(sync % (
-            inst.master.server.hostname, conf_dir, os.path.dirname(conf_dir)
-        ))
+        if not checkpoint.done('config'):
+            self.report(80, 'Synchronizing configuration files')
+            with self.trace('config_rsync'):
+                tracing.add_bytes(tracing.rsync_bytes(self.__run_cmd(sync % (
+                    inst.master.server.hostname, conf_dir,
+                    os.path.dirname(conf_dir)
+                ))))
+            checkpoint.complete('config')
 
         # Handle the pg_xlog data separately so we get all of the upstream
         # changes that might have happened during the transfer. go last. This
         # prevents rsync from complaining about missing files since xlog files
         # rotate frequently.
 
-        xlog_dir = os.path.join(primary_dir, 'pg_xlog')
+        # A base backup already streamed all the WAL it needs, so this is
+        # only necessary after rsync or pg_rewind.
 
-        sync = 'rsync -a --rsh=ssh -W --delete'
-        sync += ' postgres@%s:%s %s'
+        if method != 'basebackup' and not checkpoint.done('xlog'):
+            xlog_dir = os.path.join(primary_dir, 'pg_xlog')
 
-        self.__run_cmd(sync % (
-            inst.master.server.hostname, xlog_dir, replica_dir
-        ))
+            options, feed = self.__rsync_progress()
+
+            sync = 'rsync -a --rsh=ssh -W --delete --stats' + options
+            if inst.herd.sync_compress:
+                sync += ' -z'
+            if self.__bwlimit():
+                sync += ' --bwlimit=%d' % self.__bwlimit()
+            sync += ' postgres@%s:%s %s'
+
+            self.report(85, 'Synchronizing transaction logs')
+            with self.trace('xlog_rsync'):
+                tracing.add_bytes(tracing.rsync_bytes(self.__run_cmd(sync % (
+                    inst.master.server.hostname, xlog_dir, replica_dir
+                ), progress=feed)))
+            checkpoint.complete('xlog')
 
         # Once the process is complete, attempt to start the instance. Again,
         # this could fail and we'd go back to our caller with an exception.
-        # We should also pause temporarily to allow the replica to "catch up"
-        # before returning control to our caller, which may try to query
-        # the instance while it's still restoring.
+        # We should also wait for the replica to accept connections before
+        # returning control to our caller, which may try to query the
+        # instance while it's still restoring.
 
-        self.start()
+        self.report(90, 'Starting instance')
+        with self.trace('start'):
+            self.start()
+
+        self.report(95, 'Waiting for instance to accept connections')
+        with self.trace('wait'):
+            self.wait_ready()
+
+        checkpoint.delete()
+
+
+    def __checkpoint(self, source, method):
+        """
+        Get the checkpoint of an earlier rebuild attempt, or start a new one
+
+        Progress only carries over to a rebuild from the same source using
+        the same method. Anything else starts from scratch.
+
+        :param source: Instance the data will be copied from.
+        :param method: Rebuild method of the herd.
 
-        time.sleep(10)
+        :return: A RebuildCheckpoint for this instance.
+        """
+
+        inst = self.instance
+
+        checkpoint, created = RebuildCheckpoint.objects.get_or_create(
+            instance = inst, defaults = dict(source = source, method = method)
+        )
+
+        if created:
+            return checkpoint
+
+        if checkpoint.source_id != source.pk or checkpoint.method != method:
+            checkpoint.delete()
+            return RebuildCheckpoint.objects.create(
+                instance = inst, source = source, method = method
+            )
+
+        self.report(5, 'Resuming rebuild after %s' % (
+            checkpoint.phases.split(',')[-1] or 'start'
+        ))
+
+        return checkpoint
+
+
+    def __bwlimit(self):
+        """
+        Get the bandwidth one transfer from the upstream master may use
+
+        The REBUILD_BWLIMIT budget covers every transfer reading from a
+        single server. Since no more than REBUILD_PER_SOURCE of those run
+        at once, each gets an equal share.
+
+        :return: Limit in KB per second, or 0 for no limit.
+        """
+
+        if not settings.REBUILD_BWLIMIT:
+            return 0
+
+        return max(
+            settings.REBUILD_BWLIMIT / max(settings.REBUILD_PER_SOURCE, 1), 1
+        )
+
+
+    def __rsync_rebuild(self, primary_dir, replica_dir, checkpoint):
+        """
+        Copy the upstream master data directory to this instance with rsync
+
+        The master is placed in backup mode for the duration of the copy.
+        Transaction logs are not included, and must be copied afterwards.
+
+        If an earlier attempt already started the backup, and the master is
+        still in that same backup, we keep using it, and skip any files it
+        already copied. Backups are told apart by their start time. If the
+        master left backup mode in the meantime, or another rebuild started
+        a new backup, those files can't be trusted, and the copy starts
+        over. The same check is made once the copy is done.
+
+        :param primary_dir: Data directory of the upstream master.
+        :param replica_dir: Data directory of this instance.
+        :param checkpoint: RebuildCheckpoint recording progress.
+
+        :raises: Exception if the copy failed.
+        """
+
+        inst = self.instance
+        master = PGUtility(inst.master)
+
+        xlog_mask = os.path.join('pg_xlog', '*')
+
+        options, feed = self.__rsync_progress()
+
+        sync = 'rsync -K -a --rsh=ssh -W --delete --stats' + options
+        if inst.herd.sync_compress:
+            sync += ' -z'
+        if self.__bwlimit():
+            sync += ' --bwlimit=%d' % self.__bwlimit()
+        sync += ' --exclude=recovery.conf'
+        sync += ' --exclude=pg_replslot/*'
+        sync += ' --exclude=%s'
+        sync += ' --exclude=postmaster.*'
+        sync += ' postgres@%s:%s %s'
+
+        # Put the master into backup mode before starting the sync. This
+        # triggers an implicit checkpoint so all dirty buffers are written
+        # before the sync starts.
+
+        if checkpoint.done('backup') and (not checkpoint.backup_start or
+            master.backup_started() != checkpoint.backup_start):
+            checkpoint.reset('backup')
+
+        if not checkpoint.done('backup'):
+            self.report(15, 'Starting backup on upstream master')
+            with self.trace('backup_start', inst.master.server.hostname):
+                master.start_backup()
+                checkpoint.backup_start = master.backup_started()
+                checkpoint.save(update_fields=['backup_start'])
+            checkpoint.complete('backup')
+
+        # Large data directories copy much faster with several rsync
+        # streams at once, so use the parallel engine unless it was
+        # disabled by asking for a single stream.
+
+        self.report(20, 'Synchronizing data directory')
+        span = self.trace('base_rsync')
+
+        if settings.REBUILD_STREAMS > 1:
+            from haas.datasync import ParallelSync
+
+            lock = threading.Lock()
+
+            def copied(paths):
+                with lock:
+                    checkpoint.add_copied(paths)
+
+            engine = ParallelSync(
+                inst.master.server.hostname, inst.server.hostname,
+                compress=inst.herd.sync_compress, bwlimit=self.__bwlimit(),
+                progress=feed
+            )
+
+            with span:
+                engine.run(primary_dir, replica_dir, checkpoint.copied(),
+                    copied
+                )
+
+        else:
+            with span:
+                tracing.add_bytes(tracing.rsync_bytes(self.__run_cmd(sync % (
+                    xlog_mask, inst.master.server.hostname, primary_dir,
+                    os.path.dirname(replica_dir)
+                ) + RSYNC_VANISHED_OK, progress=feed)))
+
+        # Another rebuild from the same master may have stopped the backup
+        # and started a new one while we were copying. What we copied then
+        # spans two backups, and no backup label covers both.
+
+        if master.backup_started() != checkpoint.backup_start:
+            checkpoint.reset('backup')
+            raise Exception('Backup on %s restarted during the copy.' % (
+                inst.master.server.hostname
+            ))
+
+        with self.trace('backup_stop', inst.master.server.hostname):
+            master.stop_backup()
+
+
+    def __basebackup_rebuild(self, replica_dir, source=None):
+        """
+        Replace this instance with a base backup of another instance
+
+        Unlike rsync, pg_basebackup needs no exclusive backup mode on the
+        master, and WAL is streamed alongside the data so no separate
+        transaction log copy is needed. The old contents of the replica are
+        simply thrown away rather than compared against the master.
+
+        Tablespaces are restored to the same locations they occupy on the
+        master, so their old contents must be removed as well.
+
+        :param replica_dir: Data directory of this instance.
+        :param source: Instance to back up. Defaults to the upstream master.
+
+        :raises: Exception if the backup failed.
+        """
+
+        inst = self.instance
+        source = source or inst.master
+
+        # Make sure this host can actually reach the source before the data
+        # directory is wiped, or a firewall or a stopped source would leave
+        # the replica with nothing at all.
+
+        self.report(12, 'Checking connection to %s' % source.server.hostname)
+
+        with self.trace('check'):
+            try:
+                self.__run_cmd('pg_isready -h %s -p %d' % (
+                    source.server.hostname, inst.herd.db_port
+                ))
+            except Exception, e:
+                raise Exception('Cannot reach %s from %s: %s' % (
+                    source.server.hostname, inst.server.hostname,
+                    str(e).strip() or 'no response'
+                ))
+
+        self.report(15, 'Removing old data directory contents')
+
+        clean = 'if [ -d %s ]; then ' \
+            'for t in %s/*; do [ -L "$t" ] && ' \
+            'find "$(readlink "$t")" -mindepth 1 -delete; done; ' \
+            'find %s -mindepth 1 -delete; fi'
+
+        with self.trace('clean'):
+            self.__run_cmd(clean % (
+                replica_dir, os.path.join(replica_dir, 'pg_tblspc'),
+                replica_dir
+            ))
+
+        info = 'host=%s port=%s user=%s application_name=%s' % (
+            source.server.hostname, inst.herd.db_port, 'replication',
+            inst.herd.base_name + '_' + inst.server.hostname
+        )
+
+        backup = "pg_basebackup -D %s -X stream -c fast -d '%s'" % (
+            replica_dir, info
+        )
+
+        # Postgres 15 and up can compress the backup on the server, and
+        # pg_basebackup unpacks it again as it arrives. Older versions have
+        # no way to compress the stream at all.
+
+        if inst.herd.sync_compress and PGUtility(source).__version() >= (15,):
+            backup += ' --compress=server-gzip'
+
+        # The slowest rate pg_basebackup accepts is 32kB per second.
+
+        if self.__bwlimit():
+            backup += ' --max-rate=%dk' % max(self.__bwlimit(), 32)
+
+        self.report(20, 'Streaming base backup from %s' % (
+            source.server.hostname
+        ))
+
+        with self.trace('basebackup'):
+            self.__run_cmd(backup)
 
 
     def promote(self):
@@ -426,7 +1144,7 @@ class PGUtility():
 
         inst = self.instance
 
-        self.__run_cmd(self.__get_cmd('promote'))
+        self.__run_cmd(self.__get_cmd('promote'), 'promote')
 
         inst.master = None
         inst.save()
@@ -444,9 +1162,9 @@ class PGUtility():
         * Starting it up.
 
         We're basically just chaining creation of recovery.conf and calling
-        master_sync. Before we do that, we need to find the primary with
-        subscribers. We do this mostly because this tool doesn't yet
-        support replica chaining.
+        master_sync. Before we do that, we need to find an upstream to
+        follow. That's the primary with subscribers, unless the herd limits
+        replicas per upstream and the primary is full. See get_upstream.
 
         :raises: Exception if the instance could not be demoted.
         """
@@ -469,9 +1187,12 @@ class PGUtility():
         # the decision was made. If the config or sync failed, we should
         # try those again separately, or manually.
 
-        self.instance.master = self.get_herd_primary()
+        self.instance.master = self.get_upstream()
         self.instance.save()
-        self.update_stream_config()
+
+        with self.trace('recovery_conf'):
+            self.update_stream_config()
+
         self.master_sync()
 
 
@@ -479,8 +1200,9 @@ class PGUtility():
         """
         Get the primary for the herd of which this instance is a member
 
-        This utility doesn't yet support master chaining. As such, we take
-        our current herd and find all masters and their subscriber counts.
+        Replicas may follow other replicas, but the primary is always an
+        instance with no master. We take our current herd and find all
+        masters and their subscriber counts.
         This guarantees at least one result, provided a primary exists.
         Once we have that, we only need the top result if multiple rows
         match. This ensures newly promoted replicas don't get assigned
@@ -503,6 +1225,46 @@ class PGUtility():
             return None
 
 
+    def get_upstream(self):
+        """
+        Choose the instance a new replica in this herd should follow
+
+        Normally this is the herd primary. If the herd limits how many
+        replicas may stream from one instance, and the primary is already
+        full, we search the replication tree breadth first, and choose the
+        first replica with room to spare. That keeps the tree shallow, so
+        replicas don't fall too far behind the primary.
+
+        :return: An instance object, or None if the herd has no primary.
+        """
+
+        inst = self.instance
+        primary = self.get_herd_primary()
+        limit = inst.herd.max_fanout
+
+        if not primary or not limit:
+            return primary
+
+        children = {}
+
+        for member in Instance.objects.filter(herd_id = inst.herd_id).exclude(
+            pk = inst.pk).select_related('server'):
+            children.setdefault(member.master_id, []).append(member)
+
+        queue = [primary]
+
+        while queue:
+            node = queue.pop(0)
+            followers = children.get(node.pk, [])
+
+            if len(followers) < limit:
+                return node
+
+            queue.extend(f for f in followers if f.is_online)
+
+        return primary
+
+
     def get_version(self):
         """
         Get the version of an instance, or detect it if currently unknown.
@@ -538,7 +1300,9 @@ class PGUtility():
         For a streaming replica in Postgres to work, it must have a
         recovery.conf file detailing the upstream master connection
         parameters. This method ensures the file follows standard
-        conventions across this application.
+        conventions across this application. Cascaded replicas stream from
+        their upstream replica rather than the primary. If the herd uses
+        replication slots, our slot is created on the master as well.
 
         :raises: Exception in case of recovery.conf upload problems.
         """
@@ -554,14 +1318,27 @@ class PGUtility():
         rec_file = tempfile.NamedTemporaryFile(bufsize=0)
         rec_path = os.path.join(usedir, 'recovery.conf')
 
+        # Replicas of the primary connect through the herd vhost, so they
+        # follow it through a failover. Cascaded replicas connect directly
+        # to the replica they follow.
+
+        upstream = inst.herd.vhost
+        if inst.master and inst.master.master_id:
+            upstream = inst.master.server.hostname
+
         info = 'user=%s host=%s port=%s application_name=%s' % (
-            'replication', inst.herd.vhost, inst.herd.db_port,
+            'replication', upstream, inst.herd.db_port,
             inst.herd.base_name + '_' + inst.server.hostname
         )
 
+        slot = self.create_slot()
+
         rec_file.write("standby_mode = 'on'\n")
         rec_file.write("recovery_target_timeline = 'latest'\n")
         rec_file.write("primary_conninfo = '%s'\n" % info)
+
+        if slot:
+            rec_file.write("primary_slot_name = '%s'\n" % slot)
         self.receive_file(rec_file.name, rec_path)
         rec_file.close()
 
@@ -604,7 +1381,7 @@ class PGUtility():
             self.master_sync()
         else:
             try:
-                self.__run_cmd(self.__get_cmd('init'))
+                self.__run_cmd(self.__get_cmd('init'), 'init')
             except Exception, e:
 
                 # If this is a Debian/Ubuntu system, there's a bug when a port